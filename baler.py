@@ -1,22 +1,261 @@
 import ConfigParser
+import csv
 import datetime as dt
 import gzip
 import json
 import logging
 import os
-import re
-import requests
 import sys
+import threading
 import time
 import unicodecsv
-import threading
+from crits import Checkpoint, CRITsUploader
+from intermediate import iter_rows
+from json.encoder import encode_basestring_ascii as encode_string
 from logger import get_logger
+from metrics import metrics
 from Queue import Queue
 
 logger = get_logger('baler')
 
 
-def tiq_output(reg_file, enr_file):
+REGULAR_HEADER = ('entity', 'type', 'direction', 'source', 'notes', 'date')
+ENRICHED_HEADER = REGULAR_HEADER + ('asnumber', 'asname', 'country', 'host', 'rhost')
+# file extensions that differ from the output format's name; JSON Lines
+# output must not end up in harvest.json, which is the reaper's manifest
+EXTENSIONS = {'json': 'jsonl', 'json.gz': 'jsonl.gz'}
+FORMAT_NAMES = {'csv': 'CSV', 'json': 'JSON Lines'}
+
+
+class CompressingWriter(object):
+    """ file-like gzip writer that compresses on a thread of its own
+
+    Writes are collected into chunks of CHUNK_SIZE bytes and handed to
+    the thread, which spends most of its time in zlib with the GIL
+    released, so several of these compress in parallel.
+    """
+    CHUNK_SIZE = 1 << 20
+
+    def __init__(self, filename, compresslevel=9):
+        self.queue = Queue(4)
+        self.chunk = []
+        self.size = 0
+        self.error = None
+        self.thread = threading.Thread(target=self.compress, args=(filename, compresslevel))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def compress(self, filename, compresslevel):
+        try:
+            with gzip.open(filename, 'wb', compresslevel) as gzip_file:
+                for chunk in iter(self.queue.get, None):
+                    gzip_file.write(chunk)
+        except Exception as e:
+            self.error = e
+            # keep taking chunks so the writing side never blocks on a dead thread
+            for chunk in iter(self.queue.get, None):
+                pass
+
+    def write(self, data):
+        self.chunk.append(data)
+        self.size += len(data)
+        if self.size >= self.CHUNK_SIZE:
+            self.hand_over()
+
+    def hand_over(self):
+        if self.error is not None:
+            raise self.error
+        self.queue.put(''.join(self.chunk))
+        self.chunk = []
+        self.size = 0
+
+    def close(self):
+        if self.chunk:
+            self.hand_over()
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+
+def discard(partial):
+    if os.path.exists(partial):
+        os.remove(partial)
+
+
+class CsvBale(object):
+    """ write rows to a (optionally gziped) csv file as they arrive
+
+    Rows go to output_file.partial, which only replaces output_file once
+    closed cleanly, so a failed harvest never looks like a complete one.
+    With threaded, the gzip compression runs on a CompressingWriter thread.
+    """
+
+    def __init__(self, output_file, header, compress=False, compresslevel=9, threaded=False):
+        self.output_file = output_file
+        self.partial = output_file + '.partial'
+        if compress and threaded:
+            self.csv_file = CompressingWriter(self.partial, compresslevel)
+        elif compress:
+            self.csv_file = gzip.open(self.partial, 'wb', compresslevel)
+        else:
+            self.csv_file = open(self.partial, 'wb')
+        self.bale_writer = unicodecsv.writer(self.csv_file, quoting=unicodecsv.QUOTE_ALL)
+        self.csv_writer = csv.writer(self.csv_file, quoting=csv.QUOTE_ALL)
+
+        # header row
+        self.bale_writer.writerow(header)
+
+    def write(self, row):
+        # rows of strings (and Nones, written as empty fields like unicodecsv does) are
+        # encoded in one go instead of field by field; numbers or a NUL in the data
+        # go through unicodecsv
+        try:
+            fields = u'\0'.join([u'' if value is None else value for value in row]).encode('utf8').split('\0')
+        except (TypeError, UnicodeError):
+            fields = None
+        if fields is None or len(fields) != len(row):
+            self.bale_writer.writerow(row)
+        else:
+            self.csv_writer.writerow(fields)
+
+    def close(self):
+        self.csv_file.close()
+        os.rename(self.partial, self.output_file)
+
+    def abort(self):
+        """ give up on the file after an error upstream, without raising one of our own"""
+        try:
+            self.csv_file.close()
+        except Exception as e:
+            logger.error('Could not close %s after an error: %s' % (self.partial, e))
+        discard(self.partial)
+
+
+class JsonLinesBale(object):
+    """ write rows as JSON Lines (optionally gziped), one object per row keyed by the header
+
+    Like CsvBale, rows go to output_file.partial until closed cleanly. It
+    is flushed about once a second, so a consumer can start reading the
+    partial file while the export is still running.
+    """
+    FLUSH_INTERVAL = 1.0
+    CHECK_EVERY = 1000
+
+    def __init__(self, output_file, header, compress=False):
+        self.output_file = output_file
+        self.partial = output_file + '.partial'
+        if compress:
+            self.json_file = gzip.open(self.partial, 'wb')
+        else:
+            self.json_file = open(self.partial, 'wb')
+        # one template per schema; values are escaped with json's C string encoder
+        self.template = '{' + ', '.join('%s: %%s' % json.dumps(name) for name in header) + '}\n'
+        self.rows = 0
+        self.flushed = time.time()
+
+    def write(self, row):
+        self.json_file.write(self.template % tuple([encode_string(value) if isinstance(value, basestring) else
+                                                    'null' if value is None else json.dumps(value)
+                                                    for value in row]))
+        self.rows += 1
+        if self.rows % self.CHECK_EVERY == 0 and time.time() - self.flushed >= self.FLUSH_INTERVAL:
+            # a gzip flush ends the deflate block, so readers can decompress what was written so far
+            self.json_file.flush()
+            self.flushed = time.time()
+
+    def close(self):
+        self.json_file.close()
+        os.rename(self.partial, self.output_file)
+
+    def abort(self):
+        try:
+            self.json_file.close()
+        except Exception as e:
+            logger.error('Could not close %s after an error: %s' % (self.partial, e))
+        discard(self.partial)
+
+
+class CRITsBale(object):
+    """ push rows to CRITs as they arrive, from the uploader's threads
+
+    Nothing is held beyond the uploader's bounded queue. If the harvest
+    fails, abort() stops the upload and the checkpoint in output_file
+    keeps what was already added for the next run.
+    """
+
+    def __init__(self, output_file):
+        self.uploader = open_CRITs(output_file)
+        if self.uploader is not None:
+            self.uploader.start()
+
+    def write(self, row):
+        if self.uploader is not None:
+            self.uploader.add(row)
+
+    def close(self):
+        if self.uploader is not None:
+            try:
+                self.uploader.finish()
+            finally:
+                count_CRITs(self.uploader)
+
+    def abort(self):
+        if self.uploader is not None:
+            self.uploader.abort()
+            count_CRITs(self.uploader)
+
+
+class TiqBale(object):
+    """ split regular and enriched rows into the tiq-test directory layout
+
+    Each of the four partitions is compressed on its own thread, at
+    compresslevel.
+    """
+
+    def __init__(self, tiq_dir, today, compresslevel=6):
+        logger.info('Preparing tiq directory structure under %s' % tiq_dir)
+        if not os.path.isdir(tiq_dir):
+            os.makedirs(os.path.join(tiq_dir, 'raw', 'public_inbound'))
+            os.makedirs(os.path.join(tiq_dir, 'raw', 'public_outbound'))
+            os.makedirs(os.path.join(tiq_dir, 'enriched', 'public_inbound'))
+            os.makedirs(os.path.join(tiq_dir, 'enriched', 'public_outbound'))
+
+        self.bales = {}
+        for kind, header in (('raw', REGULAR_HEADER), ('enriched', ENRICHED_HEADER)):
+            for direction in ('inbound', 'outbound'):
+                output_file = os.path.join(tiq_dir, kind, 'public_' + direction, today + '.csv.gz')
+                logger.info('Output %s data as GZip CSV to %s' % (kind, output_file))
+                self.bales[kind, direction] = CsvBale(output_file, header, compress=True,
+                                                      compresslevel=compresslevel, threaded=True)
+
+    def write_regular(self, row):
+        if ('raw', row[2]) in self.bales:
+            self.bales['raw', row[2]].write(row)
+
+    def write_enriched(self, row):
+        if ('enriched', row[2]) in self.bales:
+            self.bales['enriched', row[2]].write(row)
+
+    def abort(self):
+        for bale in self.bales.values():
+            bale.abort()
+
+    def close(self):
+        """ close every partition, then report the first one that failed"""
+        error = None
+        for (kind, direction), bale in sorted(self.bales.items()):
+            try:
+                bale.close()
+            except Exception as e:
+                logger.error('Could not write %s %s tiq-test data: %s' % (kind, direction, e))
+                error = error or e
+        if error is not None:
+            raise error
+
+
+def open_tiq():
+    """ open the tiq-test writers for today, or return None without a usable config"""
     config = ConfigParser.SafeConfigParser()
     cfg_success = config.read('combine.cfg')
     if not cfg_success:
@@ -26,176 +265,131 @@ def tiq_output(reg_file, enr_file):
 
     tiq_dir = os.path.join(config.get('Baler', 'tiq_directory'), 'data')
     today = dt.datetime.today().strftime('%Y%m%d')
+    compresslevel = 6
+    if config.has_option('Baler', 'tiq_compression') and config.get('Baler', 'tiq_compression'):
+        compresslevel = config.getint('Baler', 'tiq_compression')
+    return TiqBale(tiq_dir, today, compresslevel)
 
-    with open(reg_file, 'rb') as f:
-        reg_data = json.load(f)
-
-    with open(enr_file, 'rb') as f:
-        enr_data = json.load(f)
-    logger.info('Preparing tiq directory structure under %s' % tiq_dir)
-    if not os.path.isdir(tiq_dir):
-        os.makedirs(os.path.join(tiq_dir, 'raw', 'public_inbound'))
-        os.makedirs(os.path.join(tiq_dir, 'raw', 'public_outbound'))
-        os.makedirs(os.path.join(tiq_dir, 'enriched', 'public_inbound'))
-        os.makedirs(os.path.join(tiq_dir, 'enriched', 'public_outbound'))
 
-    inbound_data = [row for row in reg_data if row[2] == 'inbound']
-    outbound_data = [row for row in reg_data if row[2] == 'outbound']
-
-    try:
-        bale_reg_csvgz(inbound_data, os.path.join(tiq_dir, 'raw', 'public_inbound', today + '.csv.gz'))
-        bale_reg_csvgz(outbound_data, os.path.join(tiq_dir, 'raw', 'public_outbound', today + '.csv.gz'))
-    except:
-        pass
-
-    inbound_data = [row for row in enr_data if row[2] == 'inbound']
-    outbound_data = [row for row in enr_data if row[2] == 'outbound']
+def tiq_output(reg_file, enr_file):
+    """ one pass over each input, every row going straight to its partition"""
+    tiq = open_tiq()
+    if tiq is None:
+        return
 
     try:
-        bale_enr_csvgz(inbound_data, os.path.join(tiq_dir, 'enriched', 'public_inbound', today + '.csv.gz'))
-        bale_enr_csvgz(outbound_data, os.path.join(tiq_dir, 'enriched', 'public_outbound', today + '.csv.gz'))
-    except:
-        pass
+        for row in iter_rows(reg_file):
+            tiq.write_regular(row)
+        for row in iter_rows(enr_file):
+            tiq.write_enriched(row)
+    except Exception as e:
+        logger.error('tiq_output: could not write tiq-test data: %s' % e)
+        tiq.abort()
+        raise
+    tiq.close()
 
 
-# oh my god this is such a hack
-
 def bale_reg_csvgz(harvest, output_file):
     """ bale the data as a gziped csv file"""
     logger.info('Output regular data as GZip CSV to %s' % output_file)
-    with gzip.open(output_file, 'wb') as csv_file:
-        bale_writer = unicodecsv.writer(csv_file, quoting=unicodecsv.QUOTE_ALL)
-
-        # header row
-        bale_writer.writerow(('entity', 'type', 'direction', 'source', 'notes', 'date'))
-        bale_writer.writerows(harvest)
+    bale_rows(harvest, CsvBale(output_file, REGULAR_HEADER, compress=True))
 
 
 def bale_reg_csv(harvest, output_file):
     """ bale the data as a csv file"""
     logger.info('Output regular data as CSV to %s' % output_file)
-    with open(output_file, 'wb') as csv_file:
-        bale_writer = unicodecsv.writer(csv_file, quoting=unicodecsv.QUOTE_ALL)
-
-        # header row
-        bale_writer.writerow(('entity', 'type', 'direction', 'source', 'notes', 'date'))
-        bale_writer.writerows(harvest)
+    bale_rows(harvest, CsvBale(output_file, REGULAR_HEADER))
 
 
 def bale_enr_csv(harvest, output_file):
     """ output the data as an enriched csv file"""
     logger.info('Output enriched data as CSV to %s' % output_file)
-    with open(output_file, 'wb') as csv_file:
-        bale_writer = unicodecsv.writer(csv_file, quoting=unicodecsv.QUOTE_ALL)
-
-        # header row
-        bale_writer.writerow(('entity', 'type', 'direction', 'source', 'notes', 'date', 'asnumber', 'asname', 'country', 'host', 'rhost'))
-        bale_writer.writerows(harvest)
+    bale_rows(harvest, CsvBale(output_file, ENRICHED_HEADER))
 
 
 def bale_enr_csvgz(harvest, output_file):
     """ output the data as an enriched gziped csv file"""
     logger.info('Output enriched data as GZip CSV to %s' % output_file)
-    with gzip.open(output_file, 'wb') as csv_file:
-        bale_writer = unicodecsv.writer(csv_file, quoting=unicodecsv.QUOTE_ALL)
+    bale_rows(harvest, CsvBale(output_file, ENRICHED_HEADER, compress=True))
 
-        # header row
-        bale_writer.writerow(('entity', 'type', 'direction', 'source', 'notes', 'date', 'asnumber', 'asname', 'country', 'host', 'rhost'))
-        bale_writer.writerows(harvest)
-
-
-def bale_CRITs_indicator(base_url, data, indicator_que):
-    """ One thread of adding indicators to CRITs"""
-    while not indicator_que.empty():
-        indicator = indicator_que.get()
-        if indicator[1] == 'IPv4':
-            # using the IP API
-            url = base_url + 'ips/'
-            data['add_indicator'] = "true"
-            data['ip'] = indicator[0]
-            data['ip_type'] = 'Address - ipv4-addr'
-            data['reference'] = indicator[3]
-            # getting the source automatically:
-            source = re.findall(r'\/\/(.*?)\/', data['reference'])
-            if source:
-                data['source'] = source[0]
-            res = requests.post(url, data=data, verify=False)
-            if not res.status_code in [201, 200, 400]:
-                logger.info("Issues with adding: %s" % data['ip'])
-        elif indicator[1] == "FQDN":
-            # using the Domain API
-            url = base_url + 'domains/'
-            data['add_indicator'] = "true"
-            data['domain'] = indicator[0]
-            data['reference'] = indicator[3]
-            # getting the source automatically:
-            source = re.findall(r'\/\/(.*?)\/', data['reference'])
-            if source:
-                data['source'] = source[0]
-            res = requests.post(url, data=data, verify=False)
-            if not res.status_code in [201, 200, 400]:
-                logger.info("Issues with adding: %s" % data['domain'])
-        else:
-            logger.info("don't yet know what to do with: %s[%s]" % (indicator[1], indicator[0]))
+
+def bale_rows(harvest, bale):
+    """ write every row of harvest to bale, which is only closed if they all got there"""
+    try:
+        for row in harvest:
+            bale.write(row)
+    except:
+        bale.abort()
+        raise
+    bale.close()
 
 
 def bale_CRITs(harvest, filename):
-    """ taking the output from combine and pushing it to the CRITs web API"""
+    """ taking the output from combine and pushing it to the CRITs web API
+
+    Uploaded indicators are checkpointed in filename, so running the same
+    export again after an interruption only sends the rest.
+    """
+    bale_rows(harvest, CRITsBale(filename))
+
+
+def count_CRITs(uploader):
+    metrics.count('crits_uploaded', uploader.uploaded)
+    metrics.count('crits_failed', uploader.failed)
+
+
+def open_CRITs(filename):
+    """ CRITsUploader configured by combine.cfg, checkpointing in filename; None without a combine.cfg"""
     # checking the minimum requirements for parameters
     # it would be nice to have some metadata on the feeds that can be imported in the intel library:
     #   -> confidence
     #   -> type of feed (bot vs spam vs ddos, you get the picture)
-    data = {'confidence': 'medium'}
-    start_time = time.time()
     config = ConfigParser.SafeConfigParser()
     cfg_success = config.read('combine.cfg')
     if not cfg_success:
         logger.error('tiq_output: Could not read combine.cfg.\n')
         logger.error('HINT: edit combine-example.cfg and save as combine.cfg.\n')
-        return
-    if config.has_option('Baler', 'crits_username'):
-        data['username'] = config.get('Baler', 'crits_username')
-    else:
-        raise 'Please check the combine.cnf file for the crits_username field in the [Baler] section'
-    if config.has_option('Baler', 'crits_api_key'):
-        data['api_key'] = config.get('Baler', 'crits_api_key')
-    else:
-        raise 'Please check the combine.cnf file for the crits_api_key field in the [Baler] section'
+        return None
+    for option in ('crits_username', 'crits_api_key', 'crits_url'):
+        if not config.has_option('Baler', option):
+            raise ValueError('Please check the combine.cfg file for the %s field in the [Baler] section' % option)
     if config.has_option('Baler', 'crits_campaign'):
-        data['campaign'] = config.get('Baler', 'crits_campaign')
+        campaign = config.get('Baler', 'crits_campaign')
     else:
         logger.info('Lacking a campaign name, we will default to "combine." Errors might ensue if it does not exist in CRITs')
-        data['campaign'] = 'combine'
-    if config.has_option('Baler', 'crits_url'):
-        base_url = config.get('Baler', 'crits_url')
-    else:
-        raise 'Please check the combine.cnf file for the crits_url field in the [Baler] section'
+        campaign = 'combine'
     if config.has_option('Baler', 'crits_maxThreads'):
         maxThreads = int(config.get('Baler', 'crits_maxThreads'))
     else:
         logger.info('No number of maximum Threads has been given, defaulting to 10')
         maxThreads = 10
+    retries = config.getint('Baler', 'crits_retries') if config.has_option('Baler', 'crits_retries') else 3
 
-    data['source'] = 'Combine'
-    data['method'] = 'trawl'
+    return CRITsUploader(config.get('Baler', 'crits_url'), config.get('Baler', 'crits_username'),
+                         config.get('Baler', 'crits_api_key'), campaign, maxThreads, retries,
+                         checkpoint=Checkpoint(filename))
 
-    # initializing the Queue to the list of indicators in the harvest
-    ioc_queue = Queue()
-    for indicator in harvest:
-        ioc_queue.put(indicator)
-    total_iocs = ioc_queue.qsize()
 
-    for x in range(maxThreads):
-        th = threading.Thread(target=bale_CRITs_indicator, args=(base_url, data, ioc_queue))
-        th.start()
+def output_extension(output_format):
+    return EXTENSIONS.get(output_format, output_format)
 
-    for x in threading.enumerate():
-        if x.name == "MainThread":
-            continue
-        x.join()
 
-    logger.info('Output %d indicators to CRITs using %d threads. Operation tool %d seconds\n' %
-                (total_iocs, maxThreads, time.time() - start_time))
+def open_bale(output_file, output_format, is_regular):
+    """ open a writer that takes rows one at a time for the given output format"""
+    # TODO: also need plugins here (cf. #23)
+    if output_format == 'crits':
+        return CRITsBale(output_file)
+    compress = output_format.endswith('.gz')
+    base_format = output_format[:-len('.gz')] if compress else output_format
+    if base_format not in FORMAT_NAMES:
+        raise ValueError('Unsupported output format: %s' % output_format)
+
+    kind, header = ('regular', REGULAR_HEADER) if is_regular else ('enriched', ENRICHED_HEADER)
+    logger.info('Output %s data as %s%s to %s' % (kind, 'GZip ' if compress else '', FORMAT_NAMES[base_format],
+                                                 output_file))
+    if base_format == 'json':
+        return JsonLinesBale(output_file, header, compress)
+    return CsvBale(output_file, header, compress)
 
 
 def bale(input_file, output_file, output_format, is_regular):
@@ -207,15 +401,7 @@ def bale(input_file, output_file, output_format, is_regular):
         return
 
     logger.info('Reading processed data from %s' % input_file)
-    with open(input_file, 'rb') as f:
-        harvest = json.load(f, encoding='utf8')
-
-    # TODO: also need plugins here (cf. #23)
-    if is_regular:
-        format_funcs = {'csv': bale_reg_csv, 'crits': bale_CRITs}
-    else:
-        format_funcs = {'csv': bale_enr_csv, 'crits': bale_CRITs}
-    format_funcs[output_format](harvest, output_file)
+    bale_rows(iter_rows(input_file), open_bale(output_file, output_format, is_regular))
 
 if __name__ == "__main__":
     bale('crop.json', 'harvest.csv', 'csv', True)
@@ -0,0 +1,413 @@
+#! /usr/bin/env python
+import argparse
+import datetime as dt
+import json
+import logging
+import os
+import platform
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import classifier
+from logger import get_logger
+
+logger = get_logger('benchmark')
+
+STUBS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'stubs.py')
+STAGES = ('parsers', 'classifier', 'geo', 'enrichment', 'balers', 'intermediates', 'reaper', 'crits')
+SOURCE = 'http://127.0.0.1/feed.txt'
+DAY = '2015-03-30'
+# first octets without reserved or private blocks, so the winnower keeps every synthetic address
+PUBLIC_OCTETS = [octet for octet in range(1, 224) if octet not in (10, 100, 127, 169, 172, 192, 198, 203)]
+
+
+def random_ip(rand):
+    return '%d.%d.%d.%d' % (rand.choice(PUBLIC_OCTETS), rand.randint(0, 255), rand.randint(0, 255),
+                            rand.randint(0, 255))
+
+
+def random_name(rand):
+    return '%s%d.example.%s' % (rand.choice(('mail', 'cdn', 'c2', 'update')), rand.randint(0, 99999),
+                                rand.choice(('com', 'net', 'ru', 'cn', 'info')))
+
+
+def simple_list_feed(count, rand):
+    return '# synthetic feed\n' + ''.join('%s\n' % (random_ip(rand) if rand.random() < 0.7 else random_name(rand))
+                                          for n in xrange(count))
+
+
+def sans_feed(count, rand):
+    return '# source ip\treports\ttargets\tfirst seen\tlast seen\n' + ''.join(
+        '%03d.%03d.%03d.%03d\t%d\t%d\t2015-03-01\t%s\n' % (rand.randint(1, 223), rand.randint(0, 255),
+                                                          rand.randint(0, 255), rand.randint(0, 255),
+                                                          rand.randint(1, 999), rand.randint(1, 99), DAY)
+        for n in xrange(count))
+
+
+def virbl_feed(count, rand):
+    return 'Export date %s\n' % DAY + ''.join('%s\n' % random_ip(rand) for n in xrange(count))
+
+
+def drg_feed(count, rand):
+    return '#   ASN  |  ASname  |  ipaddr  |  lastseen  |  category\n' + ''.join(
+        '%d  |  AS%d Networks  |  %s  |  %s 12:00:00  |  sshpwauth\n' % (rand.randint(1, 65535), n,
+                                                                        random_ip(rand), DAY)
+        for n in xrange(count))
+
+
+def alienvault_feed(count, rand):
+    notes = ('Scanning Host', 'Spamming', 'Malware IP', 'C&C', 'Malicious Host')
+    return ''.join('%s#4#2#%s#CN##35.0,105.0#3\n' % (random_ip(rand), rand.choice(notes)) for n in xrange(count))
+
+
+def rulez_feed(count, rand):
+    return '# rulez blocklist\n' + ''.join('%s # %s 12:00:00 ssh bruteforce\n' % (random_ip(rand), DAY)
+                                           for n in xrange(count))
+
+
+def packetmail_feed(count, rand):
+    return '# packetmail ip reputation\n' + ''.join('%s; %s 12:00:00; honeypot hits\n' % (random_ip(rand), DAY)
+                                                    for n in xrange(count))
+
+
+def autoshun_feed(count, rand):
+    return 'Shunlist as of %s\n' % DAY + ''.join('%s,%s 12:00:00,Shellcode detected\n' % (random_ip(rand), DAY)
+                                                 for n in xrange(count))
+
+
+def haleys_feed(count, rand):
+    return '# the-haleys ssh blacklist\n' + ''.join('ALL : %s\n' % random_ip(rand) for n in xrange(count))
+
+
+def project_honeypot_feed(count, rand):
+    items = ''.join('<item><title>%s | Suspicious</title><link>http://www.projecthoneypot.org/</link>'
+                    '<description>Event: Bad Event | Total: 1 | First: %s | Last: %s</description></item>\n' %
+                    (random_ip(rand), DAY, DAY) for n in xrange(count))
+    return ('<?xml version="1.0" encoding="utf-8"?>\n<rss version="2.0"><channel><title>Project Honey Pot</title>\n' +
+            items + '</channel></rss>\n')
+
+
+def malwaregroup_feed(count, rand):
+    rows = ''.join('<tr><td>%s</td><td>%s</td><td>%s</td></tr>\n' % (random_ip(rand), random_name(rand), DAY)
+                   for n in xrange(count))
+    return '<html><body><table><tr><th>IP</th><th>Domain</th><th>Date</th></tr>\n' + rows + '</table></body></html>\n'
+
+
+# parser name -> generator of a synthetic feed in its format
+FEEDS = {'simple_list': simple_list_feed,
+         'sans': sans_feed,
+         'virbl': virbl_feed,
+         'drg': drg_feed,
+         'alienvault': alienvault_feed,
+         'rulez': rulez_feed,
+         'packetmail': packetmail_feed,
+         'autoshun': autoshun_feed,
+         'haleys': haleys_feed,
+         'project_honeypot': project_honeypot_feed,
+         'malwaregroup': malwaregroup_feed}
+
+
+def synthetic_crop(count, seed=0):
+    """ crop rows as the thresher makes them; some names resolve with the DNSDB stand-in"""
+    rand = random.Random(seed)
+    crop = []
+    for n in xrange(count):
+        if rand.random() < 0.7:
+            crop.append((random_ip(rand), 'IPv4', rand.choice(('inbound', 'outbound')), SOURCE, '', DAY))
+        else:
+            name = ('evil%d.example.com' % n) if rand.random() < 0.5 else random_name(rand)
+            crop.append((name, 'FQDN', 'outbound', SOURCE, '', DAY))
+    return crop
+
+
+def synthetic_enriched(count, seed=0):
+    rand = random.Random(seed)
+    return [row + ((str(rand.randint(1, 65535)), 'AS Networks', 'US', None, 'host.example.net') if n % 2 else
+                   (None, None, 'CN', row[0], None))
+            for n, row in enumerate(synthetic_crop(count, seed))]
+
+
+def synthetic_asn_csv(filename, count=100000, seed=0):
+    """ a stand-in for MaxMind's GeoIPASNum2.csv: count adjacent ranges over the whole address space"""
+    rand = random.Random(seed)
+    bounds = sorted(rand.sample(xrange(1, 1 << 32), count - 1)) + [1 << 32]
+    with open(filename, 'wb') as f:
+        start = 0
+        for end in bounds:
+            f.write('%d,%d,"AS%d Synthetic Networks %d"\n' % (start, end - 1, rand.randint(1, 65535), start))
+            start = end
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+class Stub(object):
+    """ one of the stand-in servers of stubs.py, running in a process of its own"""
+
+    def __init__(self, service, *args):
+        self.port = free_port()
+        with open(os.devnull, 'wb') as devnull:
+            self.process = subprocess.Popen([sys.executable, STUBS, service, '--port', str(self.port)] + list(args),
+                                            stdout=devnull, stderr=devnull)
+        deadline = time.time() + 10
+        while True:
+            try:
+                socket.create_connection(('127.0.0.1', self.port), 1).close()
+                break
+            except socket.error:
+                if time.time() > deadline or self.process.poll() is not None:
+                    self.close()
+                    raise RuntimeError('The %s stand-in did not start' % service)
+                time.sleep(0.05)
+        self.url = 'http://127.0.0.1:%d/' % self.port
+
+    def close(self):
+        if self.process.poll() is None:
+            self.process.terminate()
+        self.process.wait()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class Benchmark(object):
+    """ time every stage at every size, keeping the best of repeat runs"""
+
+    def __init__(self, sizes, repeat=3, workdir=None):
+        self.sizes = sizes
+        self.repeat = repeat
+        self.workdir = workdir
+        self.results = []
+
+    def measure(self, stage, name, size, function, repeat=None):
+        best = None
+        for n in range(repeat or self.repeat):
+            start = time.time()
+            function()
+            elapsed = time.time() - start
+            best = elapsed if best is None else min(best, elapsed)
+        self.results.append({'stage': stage, 'name': name, 'size': size, 'seconds': round(best, 6),
+                             'per_second': round(size / best, 1) if best else None})
+        logger.info('%-13s %-20s %9d  %9.4fs  %12.0f/s' % (stage, name, size, best, size / best if best else 0))
+
+    def parsers(self):
+        from parsers import registry
+        for size in self.sizes:
+            for name in sorted(FEEDS):
+                body = FEEDS[name](size, random.Random(size)).decode('utf8')
+                parser = registry.load(name)
+                self.measure('parsers', name, size, lambda: parser(body, SOURCE, 'inbound'))
+
+    def classifier(self):
+        for size in self.sizes:
+            feed = classifier.synthetic_feed(size)
+            self.measure('classifier', 'indicator_type', size,
+                         lambda: [classifier.indicator_type(indicator) for indicator in feed])
+            self.measure('classifier', 'indicator_types', size, lambda: classifier.indicator_types(feed))
+
+    def load_databases(self):
+        """ open the winnower's databases, with a synthetic ASN csv when data/ has no MaxMind one"""
+        import winnower
+        if winnower.asn_index is None and not (os.path.isfile(winnower.ASN_CSV) or
+                                               os.path.isfile(winnower.ASN_DB)):
+            filename = os.path.join(self.workdir, 'GeoIPASNum2.csv')
+            logger.info('No %s, using a synthetic one' % winnower.ASN_CSV)
+            synthetic_asn_csv(filename)
+            winnower.load_gi_org(filename)
+        winnower.load_databases()
+
+    def geo(self):
+        import winnower
+        from netaddr import IPAddress
+        self.load_databases()
+        for size in self.sizes:
+            rand = random.Random(size)
+            addresses = [random_ip(rand) for n in xrange(size)]
+            parsed = [IPAddress(address) for address in addresses]
+            values = [int(address) for address in parsed]
+            self.measure('geo', 'org_by_addr', size, lambda: [winnower.org_by_addr(address) for address in parsed])
+            self.measure('geo', 'orgs_by_addrs', size, lambda: winnower.orgs_by_addrs(values))
+            self.measure('geo', 'country_by_addr', size,
+                         lambda: [winnower.country_by_addr(address) for address in addresses])
+
+    def enrichment(self):
+        import winnower
+        from enricher import EnrichmentEngine, PooledDnsdbClient
+        self.load_databases()
+
+        def winnow(crop, enrich_ip, enrich_dns, dnsdb, workers):
+            engine = EnrichmentEngine(workers)
+            try:
+                for result in winnower.EnrichmentPlan(enrich_ip, enrich_dns, dnsdb, engine).winnow(crop):
+                    pass
+            finally:
+                engine.close()
+
+        with Stub('dnsdb') as dnsdb_stub:
+            for size in self.sizes:
+                crop = synthetic_crop(size, size)
+                self.measure('enrichment', 'local', size, lambda: winnow(crop, True, False, None, 1))
+                dnsdb = PooledDnsdbClient(dnsdb_stub.url, 'key', concurrency=8)
+                try:
+                    self.measure('enrichment', 'dnsdb_8_workers', size, lambda: winnow(crop, True, True, dnsdb, 8))
+                finally:
+                    dnsdb.close()
+
+    def balers(self):
+        from baler import open_bale, TiqBale
+        for size in self.sizes:
+            crop = synthetic_crop(size, size)
+            enriched = synthetic_enriched(size, size)
+            for output_format in ('csv', 'csv.gz', 'json', 'json.gz'):
+                def bale():
+                    bale = open_bale(os.path.join(self.workdir, 'bale'), output_format, True)
+                    for row in crop:
+                        bale.write(row)
+                    bale.close()
+                self.measure('balers', output_format, size, bale)
+
+            def tiq():
+                tiq = TiqBale(os.path.join(self.workdir, 'tiq'), '20150330')
+                for row in crop:
+                    tiq.write_regular(row)
+                for row in enriched:
+                    tiq.write_enriched(row)
+                tiq.close()
+            self.measure('balers', 'tiq', size, tiq)
+
+    def intermediates(self):
+        from intermediate import dump_rows, iter_rows
+        for size in self.sizes:
+            enriched = synthetic_enriched(size, size)
+            for fmt in ('json', 'binary'):
+                filename = os.path.join(self.workdir, 'enrich.' + fmt)
+                self.measure('intermediates', 'write_' + fmt, size, lambda: dump_rows(enriched, filename, fmt))
+                self.measure('intermediates', 'read_' + fmt, size, lambda: sum(1 for row in iter_rows(filename)))
+
+    def reaper(self):
+        # reaper monkey patches sockets for gevent on import, so it only comes in now
+        import reaper
+        from thresher import harvest_rows
+        feed_dir = os.path.join(self.workdir, 'feeds')
+        store_dir = os.path.join(self.workdir, 'harvest')
+        for directory in (feed_dir, store_dir):
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+        with Stub('feeds', feed_dir) as feeds_stub:
+            for size in self.sizes:
+                for name in FEEDS:
+                    with open(os.path.join(feed_dir, name), 'wb') as f:
+                        f.write(FEEDS[name](size, random.Random(size)))
+                feeds = [(feeds_stub.url + name, 'inbound') for name in sorted(FEEDS)]
+                entries = []
+
+                def fetch():
+                    entries[:] = reaper.FetchScheduler(store_dir, {}).run(feeds)
+                self.measure('reaper', 'fetch_all_feeds', size * len(FEEDS), fetch)
+                jobs = [(name, entry) for name, entry in zip(sorted(FEEDS), entries)]
+                self.measure('reaper', 'thresh_all_feeds', size * len(FEEDS),
+                             lambda: sum(1 for row in harvest_rows(jobs, 1)))
+
+    def crits(self):
+        from crits import CRITsUploader
+        with Stub('crits') as crits_stub:
+            for size in self.sizes:
+                crop = synthetic_crop(size, size)
+                uploader = CRITsUploader(crits_stub.url + 'api/v1/', 'user', 'key', 'combine', 10)
+                self.measure('crits', 'upload_10_threads', size, lambda: uploader.upload(crop), repeat=1)
+
+    def run(self, stages):
+        for stage in stages:
+            logger.info('Benchmarking %s' % stage)
+            getattr(self, stage)()
+
+    def report(self):
+        return {'created': dt.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'),
+                'commit': git_commit(),
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'sizes': self.sizes,
+                'repeat': self.repeat,
+                'results': self.results}
+
+
+def git_commit():
+    try:
+        with open(os.devnull, 'wb') as devnull:
+            return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=devnull,
+                                           cwd=os.path.dirname(STUBS)).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(old_file, new_file, threshold):
+    """ log how every measurement changed between two result files, returning the regressions"""
+    with open(old_file, 'rb') as f:
+        old = json.load(f)
+    with open(new_file, 'rb') as f:
+        new = json.load(f)
+    before = dict(((result['stage'], result['name'], result['size']), result['seconds']) for result in old['results'])
+    regressions = []
+    logger.info('Comparing %s (%s) with %s (%s)' % (old_file, old.get('commit'), new_file, new.get('commit')))
+    for result in new['results']:
+        key = (result['stage'], result['name'], result['size'])
+        if key not in before or not before[key]:
+            continue
+        ratio = result['seconds'] / before[key]
+        flag = ''
+        if ratio > 1 + threshold:
+            flag = '  REGRESSION'
+            regressions.append(key)
+        elif ratio < 1 - threshold:
+            flag = '  faster'
+        logger.info('%-13s %-20s %9d  %9.4fs -> %9.4fs  %5.2fx%s' % (key + (before[key], result['seconds'],
+                                                                           ratio, flag)))
+    logger.info('%d regressions slower by more than %d%%' % (len(regressions), threshold * 100))
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time every stage of combine on synthetic feeds. Run it from the "
+                                                 "directory holding data/; without the MaxMind ASN list there, "
+                                                 "a synthetic one is used.")
+    parser.add_argument('--sizes', default='1000,10000', help="Comma separated numbers of indicators")
+    parser.add_argument('--stages', default=','.join(STAGES), help="Comma separated stages out of %s" % (STAGES,))
+    parser.add_argument('--repeat', type=int, default=3, help="Runs per measurement, the fastest one counts")
+    parser.add_argument('--output', default='benchmark.json', help="Where to save the results")
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help="Compare two result files instead")
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help="With --compare, slowdowns beyond this fraction count as regressions")
+    args = parser.parse_args()
+
+    if args.compare:
+        sys.exit(1 if compare(args.compare[0], args.compare[1], args.threshold) else 0)
+
+    stages = args.stages.split(',')
+    for stage in stages:
+        if stage not in STAGES:
+            sys.exit('Unknown stage %s, choose from %s' % (stage, STAGES))
+    # only the measurements are worth reading, not what every stage logs along the way
+    logging.getLogger('combine').setLevel(logging.WARNING)
+    logger.setLevel(logging.INFO)
+    workdir = tempfile.mkdtemp(prefix='combine-benchmark-')
+    try:
+        benchmark = Benchmark([int(size) for size in args.sizes.split(',')], args.repeat, workdir)
+        benchmark.run(stages)
+    finally:
+        shutil.rmtree(workdir)
+    with open(args.output, 'wb') as f:
+        json.dump(benchmark.report(), f, indent=2, sort_keys=True)
+    logger.info('Saved %d measurements to %s' % (len(benchmark.results), args.output))
@@ -0,0 +1,311 @@
+import argparse
+import random
+import re
+import time
+from logger import get_logger
+
+logger = get_logger('classifier')
+
+# top level domains known when the thresher regex was last updated (cf. #131);
+# use load_tlds() to replace them with a current TLD or public suffix list
+DEFAULT_TLDS = (
+    'abbott', 'abogado', 'ac', 'academy', 'accountant', 'accountants', 'active', 'actor', 'ad',
+    'ads', 'adult', 'ae', 'aero', 'af', 'afl', 'ag', 'agency', 'ai', 'airforce', 'al',
+    'allfinanz', 'alsace', 'am', 'amsterdam', 'an', 'android', 'ao', 'apartments', 'aq',
+    'aquarelle', 'ar', 'archi', 'army', 'arpa', 'as', 'asia', 'associates', 'at', 'attorney',
+    'au', 'auction', 'audio', 'autos', 'aw', 'ax', 'axa', 'az', 'ba', 'band', 'bank', 'bar',
+    'barclaycard', 'barclays', 'bargains', 'bayern', 'bb', 'bbc', 'bd', 'be', 'beer', 'berlin',
+    'best', 'bf', 'bg', 'bh', 'bi', 'bid', 'bike', 'bingo', 'bio', 'biz', 'bj', 'black',
+    'blackfriday', 'bloomberg', 'blue', 'bm', 'bmw', 'bn', 'bnpparibas', 'bo', 'boats', 'bond',
+    'boo', 'boutique', 'br', 'brussels', 'bs', 'bt', 'budapest', 'build', 'builders',
+    'business', 'buzz', 'bv', 'bw', 'by', 'bz', 'bzh', 'ca', 'cab', 'cal', 'camera', 'camp',
+    'cancerresearch', 'canon', 'capetown', 'capital', 'caravan', 'cards', 'care', 'career',
+    'careers', 'cartier', 'casa', 'cash', 'casino', 'cat', 'catering', 'cbn', 'cc', 'cd',
+    'center', 'ceo', 'cern', 'cf', 'cfd', 'cg', 'ch', 'channel', 'chat', 'cheap', 'chloe',
+    'christmas', 'chrome', 'church', 'ci', 'citic', 'city', 'ck', 'cl', 'claims', 'cleaning',
+    'click', 'clinic', 'clothing', 'club', 'cm', 'cn', 'co', 'coach', 'codes', 'coffee',
+    'college', 'cologne', 'com', 'community', 'company', 'computer', 'condos', 'construction',
+    'consulting', 'contractors', 'cooking', 'cool', 'coop', 'country', 'courses', 'cr',
+    'credit', 'creditcard', 'cricket', 'crs', 'cruises', 'cu', 'cuisinella', 'cv', 'cw', 'cx',
+    'cy', 'cymru', 'cz', 'dabur', 'dad', 'dance', 'date', 'dating', 'datsun', 'day', 'dclk',
+    'de', 'deals', 'degree', 'delivery', 'democrat', 'dental', 'dentist', 'desi', 'design',
+    'dev', 'diamonds', 'diet', 'digital', 'direct', 'directory', 'discount', 'dj', 'dk', 'dm',
+    'dnp', 'do', 'docs', 'doha', 'domains', 'doosan', 'download', 'durban', 'dvag', 'dz', 'eat',
+    'ec', 'edu', 'education', 'ee', 'eg', 'email', 'emerck', 'energy', 'engineer',
+    'engineering', 'enterprises', 'epson', 'equipment', 'er', 'erni', 'es', 'esq', 'estate',
+    'et', 'eu', 'eurovision', 'eus', 'events', 'everbank', 'exchange', 'expert', 'exposed',
+    'fail', 'faith', 'fan', 'fans', 'farm', 'fashion', 'feedback', 'fi', 'film', 'finance',
+    'financial', 'firmdale', 'fish', 'fishing', 'fit', 'fitness', 'fj', 'fk', 'flights',
+    'florist', 'flowers', 'flsmidth', 'fly', 'fm', 'fo', 'foo', 'football', 'forex', 'forsale',
+    'foundation', 'fr', 'frl', 'frogans', 'fund', 'furniture', 'futbol', 'ga', 'gal', 'gallery',
+    'garden', 'gb', 'gbiz', 'gd', 'gdn', 'ge', 'gent', 'gf', 'gg', 'ggee', 'gh', 'gi', 'gift',
+    'gifts', 'gives', 'gl', 'glass', 'gle', 'global', 'globo', 'gm', 'gmail', 'gmo', 'gmx',
+    'gn', 'gold', 'goldpoint', 'golf', 'goo', 'goog', 'google', 'gop', 'gov', 'gp', 'gq', 'gr',
+    'graphics', 'gratis', 'green', 'gripe', 'gs', 'gt', 'gu', 'guge', 'guide', 'guitars',
+    'guru', 'gw', 'gy', 'hamburg', 'hangout', 'haus', 'healthcare', 'help', 'here', 'hermes',
+    'hiphop', 'hiv', 'hk', 'hm', 'hn', 'holdings', 'holiday', 'homes', 'horse', 'host',
+    'hosting', 'house', 'how', 'hr', 'ht', 'hu', 'ibm', 'id', 'ie', 'ifm', 'il', 'im', 'immo',
+    'immobilien', 'in', 'industries', 'infiniti', 'info', 'ing', 'ink', 'institute', 'insure',
+    'int', 'international', 'investments', 'io', 'iq', 'ir', 'irish', 'is', 'it', 'iwc', 'java',
+    'jcb', 'je', 'jetzt', 'jm', 'jo', 'jobs', 'joburg', 'jp', 'juegos', 'kaufen', 'kddi', 'ke',
+    'kg', 'kh', 'ki', 'kim', 'kitchen', 'kiwi', 'km', 'kn', 'koeln', 'komatsu', 'kp', 'kr',
+    'krd', 'kred', 'kw', 'ky', 'kyoto', 'kz', 'la', 'lacaixa', 'land', 'lat', 'latrobe',
+    'lawyer', 'lb', 'lc', 'lds', 'lease', 'leclerc', 'legal', 'lgbt', 'li', 'lidl', 'life',
+    'lighting', 'limited', 'limo', 'link', 'lk', 'loan', 'loans', 'london', 'lotte', 'lotto',
+    'lr', 'ls', 'lt', 'ltda', 'lu', 'luxe', 'luxury', 'lv', 'ly', 'ma', 'madrid', 'maif',
+    'maison', 'management', 'mango', 'market', 'marketing', 'markets', 'marriott', 'mc', 'md',
+    'me', 'media', 'meet', 'melbourne', 'meme', 'memorial', 'menu', 'mg', 'mh', 'miami', 'mil',
+    'mini', 'mk', 'ml', 'mm', 'mma', 'mn', 'mo', 'mobi', 'moda', 'moe', 'monash', 'money',
+    'mormon', 'mortgage', 'moscow', 'motorcycles', 'mov', 'movie', 'mp', 'mq', 'mr', 'ms', 'mt',
+    'mtn', 'mtpc', 'mu', 'museum', 'mv', 'mw', 'mx', 'my', 'mz', 'na', 'nagoya', 'name', 'navy',
+    'nc', 'ne', 'net', 'network', 'neustar', 'new', 'news', 'nexus', 'nf', 'ng', 'ngo', 'nhk',
+    'ni', 'nico', 'ninja', 'nissan', 'nl', 'no', 'np', 'nr', 'nra', 'nrw', 'ntt', 'nu', 'nyc',
+    'nz', 'okinawa', 'om', 'one', 'ong', 'onl', 'online', 'ooo', 'oracle', 'org', 'organic',
+    'osaka', 'otsuka', 'ovh', 'pa', 'page', 'panerai', 'paris', 'partners', 'parts', 'party',
+    'pe', 'pf', 'pg', 'ph', 'pharmacy', 'photo', 'photography', 'photos', 'physio', 'piaget',
+    'pics', 'pictet', 'pictures', 'pink', 'pizza', 'pk', 'pl', 'place', 'plumbing', 'plus',
+    'pm', 'pn', 'pohl', 'poker', 'porn', 'post', 'pr', 'praxi', 'press', 'pro', 'prod',
+    'productions', 'prof', 'properties', 'property', 'ps', 'pt', 'pub', 'pw', 'py', 'qa',
+    'qpon', 'quebec', 're', 'realtor', 'recipes', 'red', 'redstone', 'rehab', 'reise', 'reisen',
+    'reit', 'ren', 'rentals', 'repair', 'report', 'republican', 'rest', 'restaurant', 'review',
+    'reviews', 'rich', 'rio', 'rip', 'ro', 'rocks', 'rodeo', 'rs', 'rsvp', 'ru', 'ruhr', 'rw',
+    'ryukyu', 'sa', 'saarland', 'sale', 'samsung', 'sap', 'sarl', 'saxo', 'sb', 'sc', 'sca',
+    'scb', 'schmidt', 'school', 'schule', 'schwarz', 'science', 'scot', 'sd', 'se', 'services',
+    'sew', 'sexy', 'sg', 'sh', 'shiksha', 'shoes', 'shriram', 'si', 'singles', 'site', 'sj',
+    'sk', 'sky', 'sl', 'sm', 'sn', 'so', 'social', 'software', 'sohu', 'solar', 'solutions',
+    'soy', 'space', 'spiegel', 'spreadbetting', 'sr', 'st', 'study', 'style', 'su', 'sucks',
+    'supplies', 'supply', 'support', 'surf', 'surgery', 'suzuki', 'sv', 'sx', 'sy', 'sydney',
+    'systems', 'sz', 'taipei', 'tatar', 'tattoo', 'tax', 'tc', 'td', 'tech', 'technology',
+    'tel', 'temasek', 'tennis', 'tf', 'tg', 'th', 'tickets', 'tienda', 'tips', 'tires', 'tirol',
+    'tj', 'tk', 'tl', 'tm', 'tn', 'to', 'today', 'tokyo', 'tools', 'top', 'toshiba', 'tours',
+    'town', 'toys', 'tr', 'trade', 'trading', 'training', 'travel', 'trust', 'tt', 'tui', 'tv',
+    'tw', 'tz', 'ua', 'ug', 'uk', 'university', 'uno', 'uol', 'us', 'uy', 'uz', 'va',
+    'vacations', 'vc', 've', 'vegas', 'ventures', 'versicherung', 'vet', 'vg', 'vi', 'viajes',
+    'video', 'villas', 'vision', 'vlaanderen', 'vn', 'vodka', 'vote', 'voting', 'voto',
+    'voyage', 'vu', 'wales', 'wang', 'watch', 'webcam', 'website', 'wed', 'wedding', 'wf',
+    'whoswho', 'wien', 'wiki', 'williamhill', 'win', 'wme', 'work', 'works', 'world', 'ws',
+    'wtc', 'wtf', 'xin', 'xn--1qqw23a', 'xn--30rr7y', 'xn--3bst00m', 'xn--3ds443g',
+    'xn--3e0b707e', 'xn--45brj9c', 'xn--45q11c', 'xn--4gbrim', 'xn--55qw42g', 'xn--55qx5d',
+    'xn--6frz82g', 'xn--6qq986b3xl', 'xn--80adxhks', 'xn--80ao21a', 'xn--80asehdb',
+    'xn--80aswg', 'xn--90a3ac', 'xn--90ais', 'xn--9et52u', 'xn--b4w605ferd', 'xn--c1avg',
+    'xn--cg4bki', 'xn--clchc0ea0b2g2a9gcd', 'xn--czr694b', 'xn--czrs0t', 'xn--czru2d',
+    'xn--d1acj3b', 'xn--d1alf', 'xn--fiq228c5hs', 'xn--fiq64b', 'xn--fiqs8s', 'xn--fiqz9s',
+    'xn--flw351e', 'xn--fpcrj9c3d', 'xn--fzc2c9e2c', 'xn--gecrj9c', 'xn--h2brj9c',
+    'xn--hxt814e', 'xn--i1b6b1a6a2e', 'xn--io0a7i', 'xn--j1amh', 'xn--j6w193g', 'xn--kprw13d',
+    'xn--kpry57d', 'xn--kput3i', 'xn--l1acc', 'xn--lgbbat1ad8j', 'xn--mgb9awbf',
+    'xn--mgba3a4f16a', 'xn--mgbaam7a8h', 'xn--mgbab2bd', 'xn--mgbayh7gpa', 'xn--mgbbh1a71e',
+    'xn--mgbc0a9azcg', 'xn--mgberp4a5d4ar', 'xn--mgbx4cd0ab', 'xn--mxtq1m', 'xn--ngbc5azd',
+    'xn--node', 'xn--nqv7f', 'xn--nqv7fs00ema', 'xn--o3cw4h', 'xn--ogbpf8fl', 'xn--p1acf',
+    'xn--p1ai', 'xn--pgbs0dh', 'xn--q9jyb4c', 'xn--qcka1pmc', 'xn--rhqv96g', 'xn--s9brj9c',
+    'xn--ses554g', 'xn--unup4y', 'xn--vermgensberater-ctb', 'xn--vermgensberatung-pwb',
+    'xn--vhquv', 'xn--vuq861b', 'xn--wgbh1c', 'xn--wgbl6a', 'xn--xhq521b', 'xn--xkc2al3hye2a',
+    'xn--xkc2dl3a5ee0h', 'xn--yfro4i67o', 'xn--ygbi2ammx', 'xn--zfr164b', 'xxx', 'xyz',
+    'yachts', 'yandex', 'ye', 'yodobashi', 'yoga', 'yokohama', 'youtube', 'yt', 'za', 'zip',
+    'zm', 'zone', 'zuerich', 'zw',
+)
+
+IPV4_REGEX = re.compile(r'^(?:(?:25[0-5]|2[0-4][0-9]|[01]?[0-9][0-9]?)\.){3}(?:25[0-5]|2[0-4][0-9]|[01]?[0-9][0-9]?)$')
+# the characters the labels in front of the TLD may use, as in the thresher regex
+LABEL_CHARS = re.compile(r'[-\w.]*')
+# the regex let a run of labels have hyphens in its first 254 characters only
+HYPHEN_REACH = 253
+
+
+def is_ipv4(indicator):
+    return IPV4_REGEX.match(indicator) is not None
+
+
+class SuffixIndex(object):
+    """ trie of TLDs (or public suffixes) keyed on their characters"""
+
+    def __init__(self, suffixes=()):
+        self.root = {}
+        self.count = 0
+        for suffix in suffixes:
+            self.add(suffix)
+
+    def add(self, suffix):
+        node = self.root
+        for char in suffix.lower().strip('.'):
+            node = node.setdefault(char, {})
+        if '' not in node:
+            node[''] = True
+            self.count += 1
+
+    def __len__(self):
+        return self.count
+
+    def starts(self, text, position):
+        """ whether a known suffix starts at text[position], ignoring ASCII case"""
+        node = self.root
+        for char in text[position:]:
+            # the regex only folded ASCII letters
+            node = node.get(char.lower() if ord(char) < 128 else char)
+            if node is None:
+                return False
+            if '' in node:
+                return True
+        return False
+
+    @classmethod
+    def load(cls, filename):
+        """ read an IANA TLD list or a publicsuffix.org list"""
+        index = cls()
+        with open(filename, 'rb') as f:
+            for line in f:
+                rule = line.decode('utf8').split()[0] if line.strip() else ''
+                if not rule or rule.startswith('#') or rule.startswith('//'):
+                    continue
+                # exceptions and wildcards still sit under a listed suffix
+                rule = rule.lstrip('!')
+                if rule.startswith('*.'):
+                    rule = rule[2:]
+                index.add(rule)
+                try:
+                    index.add(rule.encode('idna'))
+                except UnicodeError:
+                    pass
+        return index
+
+
+def labels_run(text, start, end):
+    """ whether text[start:end] is one run of labels the thresher regex took in front of a dot"""
+    if end - start < 2 or text[start] == '-' or text[end - 1] == '-':
+        return False
+    return text.rfind('-', start, end) - start <= HYPHEN_REACH
+
+
+class IndicatorClassifier(object):
+    """ tells IPv4 addresses and hostnames apart the way the thresher regex did
+
+    That regex took anything that starts with runs of labels, each closed
+    by a dot, followed by a known TLD, without looking at what comes after
+    it: evil.com/path and foo.com:8080 are hostnames to it. Rather than
+    trying ~900 alternatives at every dot, the TLDs sit in a SuffixIndex
+    that is walked once per dot.
+    """
+
+    def __init__(self, suffixes=None):
+        if suffixes is None:
+            suffixes = SuffixIndex(DEFAULT_TLDS)
+        self.suffixes = suffixes
+
+    def classify(self, indicator):
+        if IPV4_REGEX.match(indicator):
+            return "IPv4"
+        end = LABEL_CHARS.match(indicator).end()
+        # positions the labels in front of a dot can be taken from
+        starts = [0]
+        position = indicator.find('.', 0, end)
+        while position >= 0:
+            if any(labels_run(indicator, start, position) for start in starts):
+                if self.suffixes.starts(indicator, position + 1):
+                    return "FQDN"
+                starts.append(position + 1)
+            position = indicator.find('.', position + 1, end)
+        return None
+
+    def classify_batch(self, indicators):
+        """ classify a whole list of candidates in one call
+
+        Same answers as classify(), with every distinct value classified
+        only once; feeds repeat the same indicators a lot.
+        """
+        seen = {}
+        classify = self.classify
+        result = []
+        append = result.append
+        for indicator in indicators:
+            try:
+                append(seen[indicator])
+            except KeyError:
+                i_type = seen[indicator] = classify(indicator)
+                append(i_type)
+        return result
+
+
+default_classifier = IndicatorClassifier()
+
+
+def load_tlds(filename):
+    """ replace the built-in TLD list for every later indicator_type() call"""
+    global default_classifier
+    default_classifier = IndicatorClassifier(SuffixIndex.load(filename))
+    logger.info('Loaded %d top level domains from %s' % (len(default_classifier.suffixes), filename))
+    return default_classifier
+
+
+def indicator_type(indicator):
+    return default_classifier.classify(indicator)
+
+
+def indicator_types(indicators):
+    return default_classifier.classify_batch(indicators)
+
+
+def legacy_indicator_type(indicator):
+    """ the regex based classifier thresher used before the suffix index"""
+    ip_regex = r'^(25[0-5]|2[0-4][0-9]|[01]?[0-9][0-9]?)\.(25[0-5]|2[0-4][0-9]|[01]?[0-9][0-9]?)\.(25[0-5]|2[0-4][0-9]|[01]?[0-9][0-9]?)\.(25[0-5]|2[0-4][0-9]|[01]?[0-9][0-9]?)$'
+    domain_regex = r'(www\.)?(?P<address>([\d\w.][-\d\w.]{0,253}[\d\w.]+\.)+(%s))' % LEGACY_TLD_ALTERNATION
+
+    if re.match(ip_regex, indicator):
+        return "IPv4"
+    elif re.match(domain_regex, indicator, re.IGNORECASE):
+        return "FQDN"
+    else:
+        return None
+
+LEGACY_TLD_ALTERNATION = '|'.join(sorted(DEFAULT_TLDS, key=len, reverse=True))
+
+
+def synthetic_feed(lines, seed=0):
+    """ a feed-like mix of addresses, hostnames and junk"""
+    rand = random.Random(seed)
+    tlds = DEFAULT_TLDS
+    feed = []
+    for n in xrange(lines):
+        kind = rand.random()
+        if kind < 0.5:
+            feed.append('%d.%d.%d.%d' % tuple(rand.randint(0, 255) for _ in range(4)))
+        elif kind < 0.85:
+            feed.append('%s%d.example.%s' % (rand.choice(('mail', 'cdn', 'c2', 'update')), rand.randint(0, 99999),
+                                              rand.choice(tlds)))
+        else:
+            feed.append(rand.choice(('Export date 2015-03-30', 'not-an-indicator', '300.1.2.3', 'http://',
+                                     'host_without_tld', '192.168.1', 'evil.com/path', 'foo.com:8080', '-bad.com')))
+    return feed
+
+
+def benchmark(lines):
+    feed = synthetic_feed(lines)
+    logger.info('Classifying %d synthetic indicators' % lines)
+
+    start = time.time()
+    legacy = [legacy_indicator_type(indicator) for indicator in feed]
+    legacy_time = time.time() - start
+
+    start = time.time()
+    single = [indicator_type(indicator) for indicator in feed]
+    single_time = time.time() - start
+
+    start = time.time()
+    batch = indicator_types(feed)
+    batch_time = time.time() - start
+
+    assert single == batch
+    changed = sum(1 for old, new in zip(legacy, single) if old != new)
+    logger.info('regex:        %.2fs' % legacy_time)
+    logger.info('suffix index: %.2fs (%.1fx)' % (single_time, legacy_time / single_time))
+    logger.info('batch:        %.2fs (%.1fx)' % (batch_time, legacy_time / batch_time))
+    logger.info('%d indicators classified differently from the regex' % changed)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--tld-file', help="TLD or public suffix list to load instead of the built-in TLDs")
+    parser.add_argument('--benchmark', type=int, metavar='LINES', default=1000000,
+                        help="Size of the synthetic feed to classify")
+    args = parser.parse_args()
+    if args.tld_file:
+        load_tlds(args.tld_file)
+    benchmark(args.benchmark)
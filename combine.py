@@ -6,23 +6,46 @@ import sys
 import logging
 
 # Combine components
-from logger import get_logger
-from reaper import reap
+from logger import get_logger, log_duration
+from pipeline import stream
+from reaper import clean_store, reap
 from thresher import thresh
-from baler import bale, tiq_output
+from baler import bale, output_extension, tiq_output
+from dedup import dedup
 from winnower import winnow
+from intermediate import FORMATS, intermediate_file
+from delta import Delta, bale_removed, diff
+from history import open_history, record
+from metrics import metrics
+import profiling
 
 logger = get_logger()
 
 parser = argparse.ArgumentParser()
-parser.add_argument('-t', '--type', help="Specify output type. Currently supported: CSV and exporting to CRITs")
+parser.add_argument('-t', '--type', help="Specify output type. Currently supported: CSV, JSON Lines (json), either one gziped (csv.gz, json.gz) and exporting to CRITs")
 parser.add_argument('-f', '--file', help="Specify output file. Defaults to harvest.FILETYPE")
-parser.add_argument('-d', '--delete', help="Delete intermediate files", action="store_true")
+parser.add_argument('-d', '--delete', help="Delete intermediate files and the raw feed bodies no conditional request can reuse", action="store_true")
 parser.add_argument('-e', '--enrich', help="Enrich data", action="store_true")
 parser.add_argument('--tiq-test', help="Output in tiq-test format", action="store_true")
+parser.add_argument('--workers', help="Number of processes used to parse feeds", type=int)
+parser.add_argument('--dedup', help="Collapse indicators reported by several feeds into one row", action="store_true")
+parser.add_argument('--stream', help="Pass indicators between stages in memory instead of through JSON files", action="store_true")
+parser.add_argument('--shards', help="Number of processes used to winnow and enrich indicators", type=int, default=1)
+parser.add_argument('--intermediates', help="With --stream, still write the crop and enrich intermediates for debugging", action="store_true")
+parser.add_argument('--intermediate-format', help="Format of the crop and enrich intermediates: json (crop.json, enrich.json) or a compact binary one (crop.rows, enrich.rows)", choices=FORMATS, default='json')
+parser.add_argument('--delta', help="Only process and export indicators that are new since the previous --delta run, writing the ones that went away to removed.FILETYPE", action="store_true")
+parser.add_argument('--history', help="Record the indicators in the history store, see history.py", action="store_true")
+parser.add_argument('--delta-state', help="Where --delta keeps the indicators of the previous run. Defaults to delta_state.rows", default='delta_state.rows')
+parser.add_argument('--metrics-json', help="Write a JSON report of per-stage and per-feed metrics of the run to this file")
+parser.add_argument('--metrics-prom', help="Write the metrics of the run to this file for the Prometheus node exporter's textfile collector")
+parser.add_argument('--profile', help="Profile every stage, see --profile-stage", action="store_true")
+parser.add_argument('--profile-stage', help="Profile this stage, into one file per stage and, for thresh, per feed and, for winnow on shards, per shard. Can be given several times", action="append", choices=profiling.STAGES)
+parser.add_argument('--profile-format', help="pstats files (.prof) or sampled collapsed stacks for flamegraph.pl (.collapsed)", choices=profiling.FORMATS, default='pstats')
+parser.add_argument('--profile-memory', help="Also save a tracemalloc snapshot of every profiled stage", action="store_true")
+parser.add_argument('--profile-dir', help="Directory for the profiles. Defaults to profiles", default='profiles')
 args = parser.parse_args()
 
-possible_types = ['csv', 'json','crits']
+possible_types = ['csv', 'csv.gz', 'json', 'json.gz', 'crits']
 
 if not args.type:
     out_type = 'csv'
@@ -34,21 +57,83 @@ else:
 if args.file:
     out_file = args.file
 else:
-    out_file = 'harvest.'+out_type
+    out_file = 'harvest.'+output_extension(out_type)
 
-reap('harvest.json')
-thresh('harvest.json', 'crop.json')
-bale('crop.json', out_file, out_type, True)
+fmt = args.intermediate_format
+crop_file = intermediate_file('crop', fmt)
+enr_file = intermediate_file('enrich', fmt)
 
-if args.enrich or args.tiq_test:
-    winnow('crop.json', 'crop.json', 'enrich.json')
-    bale('enrich.json', 'enriched.'+out_type, out_type, False)
+if args.profile_stage:
+    if args.stream:
+        # the stages after the thresher run interleaved in one chain of generators, only shard workers stand apart
+        profiled = ('reap', 'thresh', 'stream') + (('winnow',) if args.shards > 1 else ())
+    else:
+        profiled = tuple(stage for stage in profiling.STAGES if stage != 'stream')
+    unprofiled = [stage for stage in args.profile_stage if stage not in profiled]
+    if unprofiled:
+        parser.error('--profile-stage %s: nothing to profile %s --stream, choose from %s' %
+                     (', '.join(unprofiled), 'with' if args.stream else 'without', ', '.join(profiled)))
+if args.profile or args.profile_stage:
+    profiling.configure(profiling.STAGES if args.profile else args.profile_stage, args.profile_dir,
+                        args.profile_format, args.profile_memory)
 
-if args.tiq_test:
-    tiq_output('crop.json', 'enrich.json')
+delta = Delta(args.delta_state) if args.delta else None
+# CRITs can't be told to remove indicators, so those go to a CSV
+removed_type = 'csv' if out_type == 'crits' else out_type
+removed_file = 'removed.'+output_extension(removed_type)
+
+with log_duration(logger, 'Reaping'), metrics.stage('reap'), profiling.stage('reap'):
+    harvest = reap('harvest.json')
+
+if args.stream:
+    with log_duration(logger, 'Streaming'), metrics.stage('stream'), profiling.stage('stream'):
+        stream('harvest.json', out_file, out_type, args.enrich, args.tiq_test, args.workers, args.intermediates,
+               args.dedup, args.shards, fmt, delta, open_history() if args.history else None)
+else:
+    with log_duration(logger, 'Threshing'), metrics.stage('thresh'), profiling.stage('thresh'):
+        thresh('harvest.json', crop_file, args.workers, fmt)
+    if args.dedup:
+        with log_duration(logger, 'Deduplicating'), metrics.stage('dedup'), profiling.stage('dedup'):
+            dedup(crop_file, crop_file, fmt)
+    if args.history:
+        with log_duration(logger, 'Recording history'), metrics.stage('history'), profiling.stage('history'):
+            record(crop_file, open_history())
+    if delta:
+        with log_duration(logger, 'Diffing'), metrics.stage('diff'), profiling.stage('diff'):
+            diff(delta, crop_file, crop_file, fmt)
+    with log_duration(logger, 'Baling'), metrics.stage('bale'), profiling.stage('bale'):
+        bale(crop_file, out_file, out_type, True)
+
+    if args.enrich or args.tiq_test:
+        with log_duration(logger, 'Winnowing on %d shards' % args.shards), metrics.stage('winnow'), profiling.stage('winnow'):
+            winnow(crop_file, crop_file, enr_file, args.shards, fmt)
+        with log_duration(logger, 'Baling enriched indicators'), metrics.stage('bale_enriched'), profiling.stage('bale', 'enriched'):
+            bale(enr_file, 'enriched.'+output_extension(out_type), out_type, False)
+
+    if args.tiq_test:
+        with log_duration(logger, 'Writing tiq-test output'), metrics.stage('tiq_test'), profiling.stage('bale', 'tiq_test'):
+            tiq_output(crop_file, enr_file)
+
+if delta:
+    with metrics.stage('bale_removed'), profiling.stage('bale', 'removed'):
+        compared = bale_removed(delta, removed_file, removed_type, bool(harvest))
+    if not compared:
+        logger.error('No indicators this run, keeping the previous state in %s' % args.delta_state)
+    elif out_type == 'crits' and os.path.exists(out_file):
+        # the upload checkpoint is only left behind when some indicators failed,
+        # keep the old state so they are new again next time
+        logger.error('Not all indicators made it to CRITs, keeping the previous state in %s' % args.delta_state)
+    else:
+        delta.save()
 
 if args.delete:
-    # be careful with this when we support a JSON output type
-    os.remove('harvest.json')
-    os.remove('crop.json')
-    os.remove('enrich.json')
+    # JSON output is written to .jsonl files, so none of these is ever a bale
+    for intermediate in ('harvest.json', crop_file, enr_file):
+        if os.path.exists(intermediate):
+            os.remove(intermediate)
+    clean_store()
+
+if args.metrics_json:
+    metrics.write_json(args.metrics_json)
+if args.metrics_prom:
+    metrics.write_prometheus(args.metrics_prom)
@@ -0,0 +1,235 @@
+import argparse
+import os
+import re
+import requests
+import threading
+import time
+from Queue import Queue
+from requests.adapters import HTTPAdapter
+
+from logger import get_logger
+
+logger = get_logger('crits')
+
+# CRITs answers 400 for indicators it already has, which is as good as adding them
+DONE_STATUS = (200, 201, 400)
+RETRY_STATUS = (429, 500, 502, 503, 504)
+# where the CRITs API takes each indicator type and how it names it
+ENDPOINTS = {
+    'IPv4': ('ips/', 'ip', {'ip_type': 'Address - ipv4-addr'}),
+    'FQDN': ('domains/', 'domain', {}),
+}
+
+
+class Checkpoint(object):
+    """ indicators already uploaded, appended to a file as they are done
+
+    An interrupted upload skips them when it is run again, and the file is
+    removed once an upload completes without failures.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.done = set()
+        if os.path.isfile(filename):
+            with open(filename, 'rb') as f:
+                self.done.update(line.rstrip('\n').decode('utf8') for line in f)
+            logger.info('Resuming CRITs upload, %d indicators were already uploaded' % len(self.done))
+        self.lock = threading.Lock()
+        self.checkpoint_file = open(filename, 'ab')
+
+    @staticmethod
+    def key(indicator):
+        # formatted rather than joined, so junk rows with None fields still have a key
+        return u'%s\t%s\t%s' % (indicator[1], indicator[0], indicator[3])
+
+    def __contains__(self, indicator):
+        return self.key(indicator) in self.done
+
+    def add(self, indicator):
+        key = self.key(indicator)
+        with self.lock:
+            self.done.add(key)
+            self.checkpoint_file.write(key.encode('utf8') + '\n')
+            self.checkpoint_file.flush()
+
+    def close(self, complete):
+        self.checkpoint_file.close()
+        if complete:
+            os.remove(self.filename)
+
+
+class CRITsUploader(object):
+    """ add indicators to CRITs from a pool of threads
+
+    Every thread has its own keep-alive Session and builds a fresh payload
+    for every indicator. The CRITs API takes one indicator per request, so
+    there is nothing to batch; failed requests are retried with exponential
+    backoff instead.
+    """
+
+    def __init__(self, base_url, username, api_key, campaign, threads=10, retries=3, backoff=1.0, timeout=60,
+                 checkpoint=None):
+        self.base_url = base_url
+        self.payload = (('username', username), ('api_key', api_key), ('campaign', campaign),
+                        ('confidence', 'medium'), ('method', 'trawl'), ('add_indicator', 'true'))
+        self.threads = threads
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.checkpoint = checkpoint
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.uploaded = 0
+        self.failed = 0
+
+    def session(self):
+        if not hasattr(self.local, 'session'):
+            session = requests.Session()
+            session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=1))
+            session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=1))
+            session.verify = False
+            self.local.session = session
+        return self.local.session
+
+    def request(self, indicator):
+        """ (url, payload) for one indicator, None for types CRITs can't take"""
+        (entity, i_type, direction, reference) = indicator[:4]
+        if i_type not in ENDPOINTS:
+            return None
+        endpoint, field, extra = ENDPOINTS[i_type]
+        payload = dict(self.payload)
+        payload.update(extra)
+        payload[field] = entity
+        payload['reference'] = reference
+        # getting the source automatically:
+        source = re.findall(r'\/\/(.*?)\/', reference)
+        payload['source'] = source[0] if source else 'Combine'
+        return self.base_url + endpoint, payload
+
+    def post(self, url, payload):
+        """ status of the POST, after retrying busy servers and dropped connections"""
+        for attempt in range(self.retries + 1):
+            try:
+                status = self.session().post(url, data=payload, timeout=self.timeout).status_code
+            except requests.RequestException as e:
+                status = e
+            retry = isinstance(status, Exception) or status in RETRY_STATUS
+            if not retry or attempt == self.retries:
+                break
+            time.sleep(self.backoff * 2 ** attempt)
+        return status
+
+    def upload_one(self, indicator):
+        request = self.request(indicator)
+        if request is None:
+            logger.info("don't yet know what to do with: %s[%s]" % (indicator[1], indicator[0]))
+            return
+        status = self.post(*request)
+        if status in DONE_STATUS:
+            with self.lock:
+                self.uploaded += 1
+            if self.checkpoint is not None:
+                self.checkpoint.add(indicator)
+        else:
+            with self.lock:
+                self.failed += 1
+            logger.info("Issues with adding: %s (%s)" % (indicator[0], status))
+
+    def work(self, queue):
+        while True:
+            indicator = queue.get()
+            if indicator is None:
+                break
+            if self.aborted:
+                continue
+            try:
+                self.upload_one(indicator)
+            except Exception as e:
+                with self.lock:
+                    self.failed += 1
+                logger.error('Could not add %s: %s' % (indicator[0], e))
+
+    def start(self):
+        """ start the upload threads; indicators are then add()ed as they come, until finish() or abort()"""
+        self.started = time.time()
+        self.skipped = 0
+        self.aborted = False
+        # bounded, so the rows waiting for a thread are never more than a few batches
+        self.queue = Queue(self.threads * 100)
+        self.workers = [threading.Thread(target=self.work, args=(self.queue,)) for x in range(self.threads)]
+        for worker in self.workers:
+            worker.daemon = True
+            worker.start()
+
+    def add(self, indicator):
+        """ queue one indicator, unless CRITs can't take its type or the checkpoint has it"""
+        if indicator[1] not in ENDPOINTS:
+            logger.info("don't yet know what to do with: %s[%s]" % (indicator[1], indicator[0]))
+            return
+        if self.checkpoint is not None and indicator in self.checkpoint:
+            self.skipped += 1
+            return
+        self.queue.put(indicator)
+
+    def stop(self):
+        for worker in self.workers:
+            self.queue.put(None)
+        for worker in self.workers:
+            worker.join()
+
+    def finish(self):
+        """ wait for the queued indicators, returning whether all of them were added"""
+        self.stop()
+        elapsed = time.time() - self.started
+        logger.info('Output %d indicators to CRITs using %d threads in %.2f seconds (%.1f indicators/second), '
+                    '%d failed, %d already uploaded' % (self.uploaded, self.threads, elapsed,
+                                                        self.uploaded / elapsed if elapsed else 0, self.failed,
+                                                        self.skipped))
+        if self.checkpoint is not None:
+            self.checkpoint.close(self.failed == 0)
+        return self.failed == 0
+
+    def abort(self):
+        """ drop the queued indicators; the checkpoint keeps those already added for the next run"""
+        self.aborted = True
+        self.stop()
+        logger.error('CRITs upload aborted after %d indicators' % self.uploaded)
+        if self.checkpoint is not None:
+            self.checkpoint.close(False)
+
+    def upload(self, harvest):
+        """ add every indicator of harvest that the checkpoint doesn't have yet"""
+        self.start()
+        try:
+            for indicator in harvest:
+                self.add(indicator)
+        except:
+            self.abort()
+            raise
+        return self.finish()
+
+
+def benchmark(count, threads, port):
+    """ upload count synthetic indicators to the stub CRITs server of stubs.py"""
+    import stubs
+    server = stubs.make_server(stubs.CRITsHandler, port)
+    threading.Thread(target=server.serve_forever).start()
+    try:
+        harvest = [('10.%d.%d.%d' % (i >> 16 & 255, i >> 8 & 255, i & 255), 'IPv4', 'inbound',
+                    'http://example.com/feed.txt', '', '2014-06-01') if i % 2 else
+                   ('host%d.example.com' % i, 'FQDN', 'outbound', 'http://example.com/feed.txt', '', '2014-06-01')
+                   for i in range(count)]
+        uploader = CRITsUploader('http://127.0.0.1:%d/api/v1/' % port, 'user', 'key', 'combine', threads)
+        uploader.upload(harvest)
+    finally:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--benchmark', type=int, default=10000, help="Number of indicators to upload")
+    parser.add_argument('--threads', type=int, default=10)
+    parser.add_argument('--port', type=int, default=8766, help="Port for the stub CRITs server")
+    args = parser.parse_args()
+    benchmark(args.benchmark, args.threads, args.port)
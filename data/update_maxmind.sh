@@ -10,3 +10,6 @@
 wget -q http://geolite.maxmind.com/download/geoip/database/GeoLiteCountry/GeoIP.dat.gz && gunzip -f GeoIP.dat.gz
 
 wget -q http://download.maxmind.com/download/geoip/database/asnum/GeoIPASNum2.zip && unzip -qqo GeoIPASNum2.zip && rm GeoIPASNum2.zip
+
+# rebuild the binary ASN database winnower maps at startup
+python "$(dirname "$0")/../geodb.py" compile GeoIPASNum2.csv GeoIPASNum2.bin
@@ -0,0 +1,175 @@
+from array import array
+from intermediate import iter_rows, dump_rows
+from logger import get_logger
+
+logger = get_logger('dedup')
+
+SOURCE_SEPARATOR = u' '
+NOTE_SEPARATOR = u'; '
+FIRST_SEEN = u'first seen %s'
+EMPTY = -1
+
+
+class SlotIndex(object):
+    """ open addressing table from the hash of a key to its slot
+
+    The 8-byte hashes and the slots sit in two flat arrays probed
+    linearly, grown to twice the size once they are half full. Two keys
+    can share a hash, so a hit is only taken once same_key confirms it
+    against the row stored in the slot.
+    """
+
+    def __init__(self, same_key, capacity=1024):
+        self.same_key = same_key
+        self.used = 0
+        self.allocate(capacity)
+
+    def allocate(self, capacity):
+        self.digests = array('l', [0]) * capacity
+        self.slots = array('l', [EMPTY]) * capacity
+        self.mask = capacity - 1
+
+    def find(self, digest, key):
+        """ (position, slot) of key, or the empty position it would go into and EMPTY"""
+        slots, digests, mask = self.slots, self.digests, self.mask
+        position = digest & mask
+        while True:
+            slot = slots[position]
+            if slot == EMPTY or (digests[position] == digest and self.same_key(slot, key)):
+                return position, slot
+            position = (position + 1) & mask
+
+    def insert(self, position, digest, slot):
+        self.digests[position] = digest
+        self.slots[position] = slot
+        self.used += 1
+        if 2 * self.used > len(self.slots):
+            self.grow()
+
+    def grow(self):
+        entries = [(digest, slot) for digest, slot in zip(self.digests, self.slots) if slot != EMPTY]
+        self.allocate(2 * len(self.slots))
+        slots, mask = self.slots, self.mask
+        for digest, slot in entries:
+            position = digest & mask
+            while slots[position] != EMPTY:
+                position = (position + 1) & mask
+            self.digests[position] = digest
+            slots[position] = slot
+
+
+class Deduplicator(object):
+    """ collapse rows on (entity, type, direction), merging where they were seen
+
+    Every distinct key gets one slot, found through a SlotIndex of key
+    hashes. Strings other than the entity are interned, and slots are kept
+    in flat arrays, with a list only for the few indicators that more than
+    one source or note points at.
+    """
+
+    def __init__(self):
+        self.index = SlotIndex(self.same_key)
+        self.strings = []
+        self.string_ids = {}
+        self.entities = []
+        self.types = array('l')
+        self.directions = array('l')
+        self.sources = array('l')
+        self.notes = array('l')
+        self.first = array('l')
+        self.last = array('l')
+        self.extra_sources = {}
+        self.extra_notes = {}
+        self.rows_seen = 0
+
+    def intern(self, value):
+        try:
+            return self.string_ids[value]
+        except KeyError:
+            self.string_ids[value] = len(self.strings)
+            self.strings.append(value)
+            return self.string_ids[value]
+
+    def same_key(self, slot, key):
+        (entity, i_type, direction) = key
+        return self.entities[slot] == entity and self.types[slot] == i_type and self.directions[slot] == direction
+
+    def add(self, row):
+        (entity, i_type, direction, source, note, date) = row
+        self.rows_seen += 1
+        i_type, direction = self.intern(i_type), self.intern(direction)
+        source, note, date = self.intern(source), self.intern(note), self.intern(date)
+        key = (entity, i_type, direction)
+        # hash() of the tuple is a C long, the same width as the digests array
+        digest = hash(key)
+        position, slot = self.index.find(digest, key)
+        if slot == EMPTY:
+            self.index.insert(position, digest, len(self.entities))
+            self.entities.append(entity)
+            self.types.append(i_type)
+            self.directions.append(direction)
+            self.sources.append(source)
+            self.notes.append(note)
+            self.first.append(date)
+            self.last.append(date)
+            return
+
+        self.merge(self.sources, self.extra_sources, slot, source)
+        self.merge(self.notes, self.extra_notes, slot, note)
+        # dates are compared as strings, which orders the YYYY-MM-DD feeds correctly
+        if self.strings[date] < self.strings[self.first[slot]]:
+            self.first[slot] = date
+        if self.strings[date] > self.strings[self.last[slot]]:
+            self.last[slot] = date
+
+    def merge(self, column, extra, slot, value):
+        if column[slot] == value:
+            return
+        values = extra.setdefault(slot, [column[slot]])
+        if value not in values:
+            values.append(value)
+
+    def values(self, column, extra, slot):
+        return [self.strings[value] for value in extra.get(slot, (column[slot],))]
+
+    def __len__(self):
+        return len(self.entities)
+
+    def sightings(self):
+        """ yield (entity, type, direction, sources, notes, first date, last date) per indicator"""
+        strings = self.strings
+        for slot, entity in enumerate(self.entities):
+            yield (entity, strings[self.types[slot]], strings[self.directions[slot]],
+                   self.values(self.sources, self.extra_sources, slot),
+                   [note for note in self.values(self.notes, self.extra_notes, slot) if note],
+                   strings[self.first[slot]], strings[self.last[slot]])
+
+    def rows(self):
+        """ yield one regular row per indicator, in the order they were first seen
+
+        The source and notes fields list every feed and note that reported
+        the indicator, and the date is the latest one reported. The rows
+        keep the regular schema, so an earlier first date goes last in the
+        notes, as FIRST_SEEN.
+        """
+        for (entity, i_type, direction, sources, notes, first, last) in self.sightings():
+            if first != last:
+                notes.append(FIRST_SEEN % first)
+            yield (entity, i_type, direction, SOURCE_SEPARATOR.join(sources), NOTE_SEPARATOR.join(notes), last)
+
+
+def dedup_rows(crop):
+    deduplicator = Deduplicator()
+    for row in crop:
+        deduplicator.add(row)
+    logger.info('Collapsed %d rows into %d unique indicators' % (deduplicator.rows_seen, len(deduplicator)))
+    return deduplicator.rows()
+
+
+def dedup(in_file, out_file, fmt='json'):
+    logger.info('Deduplicating indicators from %s into %s' % (in_file, out_file))
+    dump_rows(dedup_rows(iter_rows(in_file)), out_file, fmt)
+
+
+if __name__ == "__main__":
+    dedup('crop.json', 'crop.json')
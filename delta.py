@@ -0,0 +1,73 @@
+import os
+
+from baler import bale_rows, open_bale
+from intermediate import dump_rows, iter_rows
+from logger import get_logger
+
+logger = get_logger('delta')
+
+
+class Delta(object):
+    """ indicators added and removed since the run that saved state_file
+
+    The state is the previous run's crop, one row per (entity, type,
+    direction), in the binary intermediate format. It is loaded into a dict
+    that the new crop is hash joined against as it streams by; the new
+    state only replaces the old one on save(), once the run went through.
+    """
+
+    def __init__(self, state_file):
+        self.state_file = state_file
+        self.previous = {}
+        self.current = {}
+        self.added_rows = 0
+        if os.path.isfile(state_file):
+            for row in iter_rows(state_file):
+                self.previous[tuple(row[:3])] = row
+            logger.info('Loaded %d indicators of the previous run from %s' % (len(self.previous), state_file))
+        else:
+            logger.info('No previous run in %s, every indicator is new' % state_file)
+
+    def added(self, crop):
+        """ yield the rows of crop whose indicator the previous run didn't have"""
+        for row in crop:
+            key = tuple(row[:3])
+            self.current[key] = row
+            if key not in self.previous:
+                self.added_rows += 1
+                yield row
+
+    def removed(self):
+        """ the previous run's rows for indicators missing from the crop, once added() went through it"""
+        return [self.previous[key] for key in sorted(set(self.previous).difference(self.current))]
+
+    def report(self):
+        logger.info('%d of %d indicators are new, %d rows to process; %d indicators were removed' %
+                    (len(set(self.current).difference(self.previous)), len(self.current), self.added_rows,
+                     len(set(self.previous).difference(self.current))))
+
+    def save(self):
+        logger.info('Saving %d indicators to %s' % (len(self.current), self.state_file))
+        dump_rows(self.current.itervalues(), self.state_file, 'binary')
+
+
+def diff(delta, in_file, out_file, fmt='json'):
+    """ keep only the rows of in_file with new indicators, writing them to out_file"""
+    logger.info('Diffing %s against the previous run' % in_file)
+    dump_rows(delta.added(iter_rows(in_file)), out_file, fmt)
+
+
+def bale_removed(delta, output_file, output_format, reaped=True):
+    """ bale the indicators that went away, returning False when there was no crop to tell
+
+    After an empty or failed reap the crop is empty, and every indicator
+    of the previous run would look removed. The bale is left empty then,
+    and the caller should keep the previous state.
+    """
+    if not reaped or not delta.current:
+        logger.error('No indicators to compare with the previous run, reporting none as removed')
+        bale_rows([], open_bale(output_file, output_format, True))
+        return False
+    delta.report()
+    bale_rows(delta.removed(), open_bale(output_file, output_format, True))
+    return True
@@ -0,0 +1,190 @@
+import json
+import sqlite3
+import threading
+import time
+import urllib2
+
+import dnsdb_query
+from logger import get_logger
+from metrics import metrics
+
+logger = get_logger('dnsdb_cache')
+
+
+class DnsdbCache(object):
+    """ on-disk cache of DNSDB lookups keyed by query path
+
+    Answers with records live for ttl seconds, empty answers for
+    negative_ttl seconds. Once the cache holds more than max_entries
+    lookups, the oldest ones are evicted. Answers longer than max_records
+    are not cached at all.
+    """
+    COMMIT_EVERY = 100
+    EVICT_EVERY = 1000
+
+    def __init__(self, filename, ttl=86400, negative_ttl=3600, max_entries=500000, max_records=1000):
+        self.filename = filename
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self.max_records = max_records
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.pending = 0
+        self.puts = 0
+        # lookups may come from several enrichment threads at once, and
+        # sharded winnowing has several processes writing to the same file
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(filename, timeout=60, check_same_thread=False)
+        self.db.execute('CREATE TABLE IF NOT EXISTS lookups '
+                        '(path TEXT PRIMARY KEY, fetched REAL, empty INTEGER, records TEXT)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS lookups_fetched ON lookups (fetched)')
+
+    def get(self, path):
+        """ cached records for path, or None when it has to be asked for again"""
+        with self.lock:
+            return self._get(path)
+
+    def _get(self, path):
+        row = self.db.execute('SELECT fetched, empty, records FROM lookups WHERE path = ?', (path,)).fetchone()
+        if row:
+            fetched, empty, records = row
+            if time.time() - fetched < (self.negative_ttl if empty else self.ttl):
+                if empty:
+                    self.negative_hits += 1
+                    metrics.count('dnsdb_cache_negative_hits')
+                else:
+                    self.hits += 1
+                    metrics.count('dnsdb_cache_hits')
+                return json.loads(records)
+        self.misses += 1
+        metrics.count('dnsdb_cache_misses')
+        return None
+
+    def put(self, path, records):
+        with self.lock:
+            self._put(path, records)
+
+    def _put(self, path, records):
+        self.db.execute('INSERT OR REPLACE INTO lookups VALUES (?, ?, ?, ?)',
+                        (path, time.time(), 0 if records else 1, json.dumps(records)))
+        self.pending += 1
+        self.puts += 1
+        if self.pending >= self.COMMIT_EVERY:
+            self.commit()
+        if self.puts % self.EVICT_EVERY == 0:
+            self._evict()
+
+    def commit(self):
+        self.db.commit()
+        self.pending = 0
+
+    def evict(self):
+        with self.lock:
+            self._evict()
+
+    def _evict(self):
+        now = time.time()
+        self.db.execute('DELETE FROM lookups WHERE (empty = 0 AND fetched < ?) OR (empty = 1 AND fetched < ?)',
+                        (now - self.ttl, now - self.negative_ttl))
+        count = self.db.execute('SELECT COUNT(*) FROM lookups').fetchone()[0]
+        if count > self.max_entries:
+            self.db.execute('DELETE FROM lookups WHERE path IN '
+                            '(SELECT path FROM lookups ORDER BY fetched LIMIT ?)', (count - self.max_entries,))
+        self.commit()
+
+    def close(self):
+        self.evict()
+        self.db.close()
+        logger.info('DNSDB cache %s: %d hits, %d negative hits, %d misses' %
+                    (self.filename, self.hits, self.negative_hits, self.misses))
+
+
+class CachingDnsdbClient(dnsdb_query.DnsdbClient):
+    """ DnsdbClient that answers repeated lookups from a DnsdbCache
+
+    Records are streamed as they arrive. A lookup that fails is reported
+    and yields whatever arrived before the failure, like DnsdbClient does,
+    but it is never cached. Neither is a lookup whose caller stopped
+    reading early.
+    """
+    FETCH_ERRORS = (urllib2.HTTPError, urllib2.URLError)
+
+    def __init__(self, server, apikey, cache=None, limit=None):
+        super(CachingDnsdbClient, self).__init__(server, apikey, limit)
+        self.cache = cache
+
+    def _iter_query(self, path):
+        if self.limit:
+            path += '?limit=%d' % self.limit
+        if self.cache is not None:
+            records = self.cache.get(path)
+            if records is not None:
+                for record in records:
+                    yield record
+                return
+        stream = self._fetch(path)
+        kept = [] if self.cache is not None else None
+        try:
+            for record in stream:
+                kept = self.keep(kept, record)
+                yield record
+        except GeneratorExit:
+            # the caller has what it needs; reading on just to cache the rest
+            # would cost up to max_records per lookup, so leave it uncached
+            raise
+        except self.FETCH_ERRORS as e:
+            logger.error('DNSDB lookup %s failed: %s' % (path, e))
+            return
+        finally:
+            stream.close()
+        self.remember(path, kept)
+
+    def probe(self, rdata_name):
+        """ whether DNSDB answers a lookup for rdata_name with records, asked past the cache"""
+        path = self._rdata_name_path(rdata_name)
+        if self.limit:
+            path += '?limit=%d' % self.limit
+        stream = self._fetch(path)
+        try:
+            return next(stream, None) is not None
+        except self.FETCH_ERRORS as e:
+            logger.error('DNSDB lookup %s failed: %s' % (path, e))
+            return False
+        finally:
+            stream.close()
+
+    def keep(self, kept, record):
+        """ kept plus record, or None once the answer is too long to cache"""
+        if kept is None or len(kept) >= self.cache.max_records:
+            return None
+        kept.append(record)
+        return kept
+
+    def remember(self, path, kept):
+        if kept is not None:
+            self.cache.put(path, kept)
+
+    def _fetch(self, path):
+        """ yield DNSDB's own answer; a 404 is its answer for a lookup without results"""
+        url = '%s/lookup/%s' % (self.server, path)
+        req = urllib2.Request(url)
+        req.add_header('Accept', 'application/json')
+        req.add_header('X-Api-Key', self.apikey)
+        try:
+            http = urllib2.urlopen(req)
+        except urllib2.HTTPError as e:
+            if e.code == 404:
+                return
+            raise
+        try:
+            for line in http:
+                if line.strip():
+                    yield json.loads(line)
+        finally:
+            http.close()
+
+    def close(self):
+        if self.cache is not None:
+            self.cache.close()
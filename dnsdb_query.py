@@ -44,29 +44,48 @@ class DnsdbClient(object):
         self.limit = limit
 
     def query_rrset(self, oname, rrtype=None, bailiwick=None):
+        return self._query(self._rrset_path(oname, rrtype, bailiwick))
+
+    def query_rdata_name(self, rdata_name, rrtype=None):
+        return self._query(self._rdata_name_path(rdata_name, rrtype))
+
+    def query_rdata_ip(self, rdata_ip):
+        return self._query(self._rdata_ip_path(rdata_ip))
+
+    # the iter_* variants yield records as they are read off the connection,
+    # so a caller that stops early never reads the rest of the answer
+    def iter_rrset(self, oname, rrtype=None, bailiwick=None):
+        return self._iter_query(self._rrset_path(oname, rrtype, bailiwick))
+
+    def iter_rdata_name(self, rdata_name, rrtype=None):
+        return self._iter_query(self._rdata_name_path(rdata_name, rrtype))
+
+    def iter_rdata_ip(self, rdata_ip):
+        return self._iter_query(self._rdata_ip_path(rdata_ip))
+
+    def _rrset_path(self, oname, rrtype=None, bailiwick=None):
         if bailiwick:
             if not rrtype:
                 rrtype = 'ANY'
-            path = 'rrset/name/%s/%s/%s' % (oname, rrtype, bailiwick)
+            return 'rrset/name/%s/%s/%s' % (oname, rrtype, bailiwick)
         elif rrtype:
-            path = 'rrset/name/%s/%s' % (oname, rrtype)
+            return 'rrset/name/%s/%s' % (oname, rrtype)
         else:
-            path = 'rrset/name/%s' % oname
-        return self._query(path)
+            return 'rrset/name/%s' % oname
 
-    def query_rdata_name(self, rdata_name, rrtype=None):
+    def _rdata_name_path(self, rdata_name, rrtype=None):
         if rrtype:
-            path = 'rdata/name/%s/%s' % (rdata_name, rrtype)
+            return 'rdata/name/%s/%s' % (rdata_name, rrtype)
         else:
-            path = 'rdata/name/%s' % rdata_name
-        return self._query(path)
+            return 'rdata/name/%s' % rdata_name
 
-    def query_rdata_ip(self, rdata_ip):
-        path = 'rdata/ip/%s' % rdata_ip.replace('/', ',')
-        return self._query(path)
+    def _rdata_ip_path(self, rdata_ip):
+        return 'rdata/ip/%s' % rdata_ip.replace('/', ',')
 
     def _query(self, path):
-        res = []
+        return list(self._iter_query(path))
+
+    def _iter_query(self, path):
         url = '%s/lookup/%s' % (self.server, path)
         if self.limit:
             url += '?limit=%d' % self.limit
@@ -75,14 +94,16 @@ class DnsdbClient(object):
         req.add_header('X-Api-Key', self.apikey)
         try:
             http = urllib2.urlopen(req)
-            while True:
-                line = http.readline()
-                if not line:
-                    break
-                res.append(json.loads(line))
+            try:
+                while True:
+                    line = http.readline()
+                    if not line:
+                        break
+                    yield json.loads(line)
+            finally:
+                http.close()
         except (urllib2.HTTPError, urllib2.URLError), e:
             sys.stderr.write(str(e) + '\n')
-        return res
 
 def sec_to_text(ts):
     return time.strftime('%Y-%m-%d %H:%M:%S -0000', time.gmtime(ts))
@@ -153,37 +174,48 @@ def time_parse(s):
 
     raise ValueError('Invalid time: "%s"' % s)
 
-def filter_before(res_list, before_time):
-    before_time = time_parse(before_time)
-    new_res_list = []
-
-    for res in res_list:
-        if 'time_first' in res:
-            if res['time_first'] < before_time:
-                new_res_list.append(res)
-        elif 'zone_time_first' in res:
-            if res['zone_time_first'] < before_time:
-                new_res_list.append(res)
-        else:
-            new_res_list.append(res)
+class TimeWindow(object):
+    """records seen after and/or before a time; the bounds are parsed once"""
+
+    def __init__(self, after=None, before=None):
+        self.after = time_parse(after) if after is not None else None
+        self.before = time_parse(before) if before is not None else None
+
+    def __contains__(self, res):
+        if self.after is not None:
+            if 'time_last' in res:
+                if res['time_last'] <= self.after:
+                    return False
+            elif 'zone_time_last' in res:
+                if res['zone_time_last'] <= self.after:
+                    return False
+        if self.before is not None:
+            if 'time_first' in res:
+                if res['time_first'] >= self.before:
+                    return False
+            elif 'zone_time_first' in res:
+                if res['zone_time_first'] >= self.before:
+                    return False
+        return True
+
+    def filter(self, res_iter):
+        return (res for res in res_iter if res in self)
 
-    return new_res_list
+def filter_before(res_list, before_time):
+    return list(TimeWindow(before=before_time).filter(res_list))
 
 def filter_after(res_list, after_time):
-    after_time = time_parse(after_time)
-    new_res_list = []
-
-    for res in res_list:
-        if 'time_last' in res:
-            if res['time_last'] > after_time:
-                new_res_list.append(res)
-        elif 'zone_time_last' in res:
-            if res['zone_time_last'] > after_time:
-                new_res_list.append(res)
-        else:
-            new_res_list.append(res)
-
-    return new_res_list
+    return list(TimeWindow(after=after_time).filter(res_list))
+
+def max_count(res_iter):
+    """the record with the highest positive count, the first one on ties; None if there is none"""
+    best = None
+    best_count = 0
+    for res in res_iter:
+        if res['count'] > best_count:
+            best = res
+            best_count = res['count']
+    return best
 
 def main():
     global cfg
@@ -0,0 +1,118 @@
+import json
+import threading
+import time
+
+import requests
+from multiprocessing.pool import ThreadPool
+from requests.adapters import HTTPAdapter
+
+from dnsdb_cache import CachingDnsdbClient
+from logger import get_logger
+from metrics import metrics
+
+logger = get_logger('enricher')
+
+
+class RateLimiter(object):
+    """ token bucket shared by every thread: at most rate acquisitions per second"""
+
+    def __init__(self, rate, burst=1):
+        self.rate = float(rate)
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.time()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        if self.rate <= 0:
+            return
+        while True:
+            with self.lock:
+                now = time.time()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class PooledDnsdbClient(CachingDnsdbClient):
+    """ CachingDnsdbClient that talks to DNSDB over a shared keep-alive Session
+
+    Requests from all threads go through one RateLimiter. 429/503 answers,
+    and connections that fail or time out (a kept-alive connection the
+    server already closed, say), are retried with exponential backoff (or
+    after the server's Retry-After).
+    """
+    FETCH_ERRORS = (requests.RequestException, ValueError)
+    RETRY_STATUS = (429, 503)
+    RETRY_ERRORS = (requests.ConnectionError, requests.Timeout)
+
+    def __init__(self, server, apikey, cache=None, limit=None, concurrency=8, rate=0, retries=5, backoff=1.0,
+                 timeout=60):
+        super(PooledDnsdbClient, self).__init__(server, apikey, cache, limit)
+        self.limiter = RateLimiter(rate)
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=concurrency)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.session.headers.update({'Accept': 'application/json', 'X-Api-Key': apikey})
+
+    def _fetch(self, path):
+        url = '%s/lookup/%s' % (self.server.rstrip('/'), path)
+        for attempt in range(self.retries + 1):
+            self.limiter.acquire()
+            start = time.time()
+            try:
+                response = self.session.get(url, timeout=self.timeout, stream=True)
+            except self.RETRY_ERRORS as e:
+                if attempt == self.retries:
+                    raise
+                delay = self.backoff * 2 ** attempt
+                logger.info('DNSDB lookup %s failed: %s, retrying in %.1f seconds' % (path, e, delay))
+                time.sleep(delay)
+                continue
+            finally:
+                metrics.count('dnsdb_calls')
+                metrics.count('dnsdb_seconds', time.time() - start)
+            if response.status_code not in self.RETRY_STATUS or attempt == self.retries:
+                break
+            response.close()
+            delay = self.backoff * 2 ** attempt
+            if response.headers.get('Retry-After', '').isdigit():
+                delay = max(delay, int(response.headers['Retry-After']))
+            logger.info('DNSDB answered %d for %s, retrying in %.1f seconds' % (response.status_code, path, delay))
+            time.sleep(delay)
+        try:
+            # a 404 is DNSDB's answer for a lookup without results
+            if response.status_code == 404:
+                return
+            response.raise_for_status()
+            for line in response.iter_lines():
+                if line.strip():
+                    yield json.loads(line)
+        finally:
+            response.close()
+
+
+class EnrichmentEngine(object):
+    """ run lookups on a pool of threads, returning results in input order"""
+
+    def __init__(self, workers=8):
+        self.workers = workers
+        self.pool = ThreadPool(workers) if workers > 1 else None
+
+    def map(self, function, items):
+        if self.pool is None:
+            return [function(item) for item in items]
+        return self.pool.map(function, items)
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
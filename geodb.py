@@ -0,0 +1,166 @@
+import argparse
+import csv
+import mmap
+import numpy as np
+import os
+import struct
+
+from logger import get_logger
+
+logger = get_logger('geodb')
+
+MAGIC = 'CMBASN01'
+# magic, ranges, orgs, bytes of org names
+HEADER = struct.Struct('<8sIII')
+UINT32 = np.dtype('<u4')
+
+
+class OrgTable(object):
+    """ org names packed as one utf8 blob plus offsets, decoded on demand"""
+
+    def __init__(self, offsets, blob):
+        self.offsets = offsets
+        self.blob = blob
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, org_id):
+        start, end = self.offsets[org_id], self.offsets[org_id + 1]
+        return self.blob[start:end].decode('utf8')
+
+
+class ASNIndex(object):
+    """ ASN ranges as sorted uint32 start/end arrays plus an interned org table
+
+    Lookups are a binary search (numpy.searchsorted) on the start array,
+    either for one address or vectorized over a whole batch.
+    """
+
+    def __init__(self, starts, ends, org_ids, orgs):
+        self.starts = starts
+        self.ends = ends
+        self.org_ids = org_ids
+        self.orgs = orgs
+        self.as_info = {}
+
+    @staticmethod
+    def split_org(org):
+        as_num, sep, as_name = org.partition(' ')
+        as_num = as_num.replace("AS", "")  # Making sure the variable only has the number
+        return as_num, as_name
+
+    def org_info(self, org_id):
+        try:
+            return self.as_info[org_id]
+        except KeyError:
+            info = self.as_info[org_id] = self.split_org(self.orgs[org_id])
+            return info
+
+    @classmethod
+    def from_csv(cls, filename):
+        """ build the index from MaxMind's GeoIPASNum2.csv (start, end, org)"""
+        starts = []
+        ends = []
+        org_ids = []
+        orgs = []
+        interned = {}
+        with open(filename, 'rb') as f:
+            for start, end, org in csv.reader(f):
+                if org not in interned:
+                    interned[org] = len(orgs)
+                    orgs.append(unicode(org, errors='replace'))
+                starts.append(int(start))
+                ends.append(int(end))
+                org_ids.append(interned[org])
+
+        starts = np.array(starts, dtype=np.uint32)
+        order = np.argsort(starts, kind='mergesort')
+        return cls(starts[order], np.array(ends, dtype=np.uint32)[order],
+                   np.array(org_ids, dtype=np.uint32)[order], orgs)
+
+    @classmethod
+    def load(cls, filename):
+        """ map a file written by save() without reading or copying it
+
+        The arrays are views on the mapping, so the page cache is shared by
+        every process that loads the same file.
+        """
+        with open(filename, 'rb') as f:
+            mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(mapping) < HEADER.size or mapping[:len(MAGIC)] != MAGIC:
+            raise ValueError('%s is not a compiled ASN database' % filename)
+        magic, ranges, orgs, blob_size = HEADER.unpack_from(mapping)
+        offset = HEADER.size
+        arrays = []
+        for count in (ranges, ranges, ranges, orgs + 1):
+            arrays.append(np.frombuffer(mapping, dtype=UINT32, count=count, offset=offset))
+            offset += count * UINT32.itemsize
+        starts, ends, org_ids, name_offsets = arrays
+        blob = buffer(mapping, offset, blob_size)
+        return cls(starts, ends, org_ids, OrgTable(name_offsets, blob))
+
+    def save(self, filename):
+        names = [self.orgs[org_id].encode('utf8') for org_id in range(len(self.orgs))]
+        name_offsets = np.cumsum([0] + [len(name) for name in names]).astype(UINT32)
+        partial = filename + '.partial'
+        with open(partial, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, len(self.starts), len(names), int(name_offsets[-1])))
+            for array in (self.starts, self.ends, self.org_ids, name_offsets):
+                f.write(np.asarray(array, dtype=UINT32).tostring())
+            f.write(''.join(names))
+        os.rename(partial, filename)
+
+    def __len__(self):
+        return len(self.starts)
+
+    def find(self, addresses):
+        """ positions of the ranges holding each address (uint32 array), -1 where none does"""
+        addresses = np.asarray(addresses, dtype=np.uint32)
+        positions = np.searchsorted(self.starts, addresses, side='right') - 1
+        found = positions >= 0
+        found[found] = addresses[found] <= self.ends[positions[found]]
+        return np.where(found, positions, -1)
+
+    def lookup(self, address):
+        """ (as_num, as_name) for one integer address, (None, None) outside every range"""
+        # a uint32 key keeps numpy from upcasting the whole start array on every call
+        address = np.uint32(address)
+        position = self.starts.searchsorted(address, side='right') - 1
+        if position < 0 or address > self.ends[position]:
+            return None, None
+        return self.org_info(int(self.org_ids[position]))
+
+    def lookup_many(self, addresses):
+        """ (as_num, as_name) for every address in a batch of integer addresses"""
+        org_info = self.org_info
+        org_ids = self.org_ids
+        return [org_info(int(org_ids[position])) if position >= 0 else (None, None)
+                for position in self.find(addresses).tolist()]
+
+
+def open_asn_index(csv_file, compiled_file=None):
+    """ load the compiled database when it is at least as new as the csv, else parse the csv"""
+    if compiled_file is None:
+        compiled_file = os.path.splitext(csv_file)[0] + '.bin'
+    if os.path.isfile(compiled_file) and (not os.path.isfile(csv_file) or
+                                          os.path.getmtime(compiled_file) >= os.path.getmtime(csv_file)):
+        return ASNIndex.load(compiled_file)
+    logger.info('No up to date %s, parsing %s (run "geodb.py compile" to speed this up)' % (compiled_file, csv_file))
+    return ASNIndex.from_csv(csv_file)
+
+
+def compile_asn(csv_file, compiled_file):
+    index = ASNIndex.from_csv(csv_file)
+    index.save(compiled_file)
+    logger.info('Compiled %d ASN ranges from %s into %s' % (len(index), csv_file, compiled_file))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='command')
+    compile_parser = subparsers.add_parser('compile', help="Compile the MaxMind ASN csv into a binary database")
+    compile_parser.add_argument('csv_file', nargs='?', default='data/GeoIPASNum2.csv')
+    compile_parser.add_argument('compiled_file', nargs='?', default='data/GeoIPASNum2.bin')
+    args = parser.parse_args()
+    compile_asn(args.csv_file, args.compiled_file)
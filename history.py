@@ -0,0 +1,301 @@
+import argparse
+import ConfigParser
+import datetime as dt
+import hashlib
+import os
+import re
+import sqlite3
+import sys
+import unicodecsv
+
+from dedup import SOURCE_SEPARATOR
+from intermediate import BinaryRowWriter, iter_rows
+from logger import get_logger
+
+logger = get_logger('history')
+
+INDEX_FILE = 'index.sqlite'
+COMPACTED = 'compacted.rows'
+DAY = re.compile(r'\d{4}-\d{2}-\d{2}($|[ T])')
+# SQLite 3.24 and later can insert or update a sighting in one statement, about twice as fast
+UPSERT = sqlite3.sqlite_version_info >= (3, 24, 0)
+
+
+def partition_name(source):
+    """ file name for the partition of a feed: readable, and unique thanks to a hash of the whole URL"""
+    slug = re.sub(r'[^A-Za-z0-9.-]+', '_', source).strip('_')[:80]
+    return '%s-%s.rows' % (slug, hashlib.sha1(source.encode('utf8')).hexdigest()[:8])
+
+
+class HistoryIndex(object):
+    """ SQLite index of the history store
+
+    sightings holds the first and last day every (entity, type, direction)
+    was seen in each feed, keyed so that all sightings of an entity are
+    next to each other; partitions lists the file of every day and feed.
+    """
+
+    def __init__(self, filename):
+        self.db = sqlite3.connect(filename, timeout=60)
+        self.db.execute('CREATE TABLE IF NOT EXISTS sources (id INTEGER PRIMARY KEY, url TEXT UNIQUE)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS sightings '
+                        '(entity TEXT, type TEXT, direction TEXT, source INTEGER, first_seen TEXT, last_seen TEXT, '
+                        'PRIMARY KEY (entity, type, direction, source)) WITHOUT ROWID')
+        self.db.execute('CREATE TABLE IF NOT EXISTS partitions '
+                        '(day TEXT, source INTEGER, path TEXT, rows INTEGER, PRIMARY KEY (day, source, path))')
+        self.db.commit()
+
+    def source_id(self, url):
+        self.db.execute('INSERT OR IGNORE INTO sources (url) VALUES (?)', (url,))
+        return self.db.execute('SELECT id FROM sources WHERE url = ?', (url,)).fetchone()[0]
+
+    def add_days(self, days, sightings):
+        """ record the partition files of every day ({day: {source: (path, rows)}})
+        and the (day, entity, type, direction, source) seen, in one transaction"""
+        with self.db:
+            ids = dict((source, self.source_id(source)) for partitions in days.values() for source in partitions)
+            self.db.executemany('INSERT OR REPLACE INTO partitions VALUES (?, ?, ?, ?)',
+                                ((day, ids[source], path, rows) for day, partitions in days.items()
+                                 for source, (path, rows) in partitions.items()))
+            if UPSERT:
+                self.db.executemany('INSERT INTO sightings VALUES (?, ?, ?, ?, ?, ?) '
+                                    'ON CONFLICT (entity, type, direction, source) DO UPDATE SET '
+                                    'first_seen = min(first_seen, excluded.first_seen), '
+                                    'last_seen = max(last_seen, excluded.last_seen)',
+                                    ((entity, i_type, direction, ids[source], day, day)
+                                     for day, entity, i_type, direction, source in sightings))
+                return
+            self.db.executemany('INSERT OR IGNORE INTO sightings VALUES (?, ?, ?, ?, ?, ?)',
+                                ((entity, i_type, direction, ids[source], day, day)
+                                 for day, entity, i_type, direction, source in sightings))
+            self.db.executemany('UPDATE sightings SET first_seen = min(first_seen, ?), last_seen = max(last_seen, ?) '
+                                'WHERE entity = ? AND type = ? AND direction = ? AND source = ?',
+                                ((day, day, entity, i_type, direction, ids[source])
+                                 for day, entity, i_type, direction, source in sightings))
+
+    def lookup(self, entity):
+        return self.db.execute('SELECT type, direction, url, first_seen, last_seen FROM sightings '
+                               'JOIN sources ON sources.id = sightings.source WHERE entity = ? '
+                               'ORDER BY first_seen, url', (entity,)).fetchall()
+
+    def partitions(self, since=None, until=None, source=None):
+        """ (day, path) of the partitions between since and until (inclusive),
+        only those holding source when it is given"""
+        query = 'SELECT DISTINCT day, path FROM partitions JOIN sources ON sources.id = partitions.source WHERE 1'
+        args = []
+        for condition, value in (('day >= ?', since), ('day <= ?', until), ('url = ?', source)):
+            if value is not None:
+                query += ' AND ' + condition
+                args.append(value)
+        return self.db.execute(query + ' ORDER BY day, path', args).fetchall()
+
+    def replace_day(self, day, path, counts):
+        """ point every feed of day at the single file path, with counts rows each"""
+        with self.db:
+            self.db.execute('DELETE FROM partitions WHERE day = ?', (day,))
+            self.db.executemany('INSERT INTO partitions VALUES (?, ?, ?, ?)',
+                                ((day, self.source_id(source), path, rows) for source, rows in counts.items()))
+
+    def close(self):
+        self.db.close()
+
+
+class HistoryWriter(object):
+    """ append the rows of a run to the history store as day/feed partitions
+
+    Takes rows one at a time like the bales do. Rows of deduplicated
+    indicators are split up again, one per feed. Every row is filed under
+    its own date, so an old crop added later lands on the days it was
+    harvested; rows whose date is not a YYYY-MM-DD day go under today.
+    With day, every row is filed under that day instead. A second run on
+    the same day adds numbered partitions next to the first ones.
+    """
+
+    def __init__(self, directory, day=None):
+        self.directory = directory
+        self.day = day
+        self.today = dt.date.today().isoformat()
+        self.writers = {}
+        self.sightings = set()
+
+    def row_day(self, date):
+        if self.day is not None:
+            return self.day
+        if isinstance(date, basestring) and DAY.match(date):
+            return date[:10]
+        return self.today
+
+    def open_partition(self, day, source):
+        day_directory = os.path.join(self.directory, day)
+        if not os.path.isdir(day_directory):
+            os.makedirs(day_directory)
+        name = partition_name(source)
+        path = os.path.join(day, name)
+        part = 1
+        while os.path.exists(os.path.join(self.directory, path)):
+            path = os.path.join(day, '%s.%d.rows' % (name[:-len('.rows')], part))
+            part += 1
+        writer = self.writers[day, source] = BinaryRowWriter(os.path.join(self.directory, path))
+        writer.path = path
+        return writer
+
+    def write(self, row):
+        (entity, i_type, direction, sources, notes, date) = row[:6]
+        day = self.row_day(date)
+        for source in sources.split(SOURCE_SEPARATOR):
+            writer = self.writers.get((day, source)) or self.open_partition(day, source)
+            writer.write((entity, i_type, direction, source, notes, date))
+            self.sightings.add((day, entity, i_type, direction, source))
+
+    def abort(self):
+        """ drop the partitions of a run that failed, leaving the index as it was"""
+        for writer in self.writers.values():
+            writer.abort()
+        logger.error('Not recording the failed run in the history')
+
+    def close(self):
+        days = {}
+        for (day, source), writer in self.writers.items():
+            writer.close()
+            days.setdefault(day, {})[source] = (writer.path, writer.count)
+        index = HistoryIndex(os.path.join(self.directory, INDEX_FILE))
+        try:
+            index.add_days(days, self.sightings)
+        finally:
+            index.close()
+        logger.info('Added %d rows from %d feeds to the history of %s' %
+                    (sum(writer.count for writer in self.writers.values()),
+                     len(set(source for day, source in self.writers)), ', '.join(sorted(days)) or 'no day'))
+
+
+class History(object):
+    """ query the history store: point lookups from the index, range scans
+    that only open the partitions of the requested days and feed"""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.index = HistoryIndex(os.path.join(directory, INDEX_FILE))
+
+    def lookup(self, entity):
+        """ (type, direction, source, first_seen, last_seen) for every feed entity was seen in"""
+        return self.index.lookup(entity)
+
+    def scan(self, since=None, until=None, source=None, entity=None):
+        """ yield (day, row) for the rows seen between since and until,
+        optionally only from source or only for entity"""
+        for day, path in self.index.partitions(since, until, source):
+            for row in iter_rows(os.path.join(self.directory, path)):
+                if (source is None or row[3] == source) and (entity is None or row[0] == entity):
+                    yield day, row
+
+    def compact(self, before):
+        """ merge all partitions of every day before before into one file
+        per day, dropping rows repeated by several runs of that day"""
+        days = sorted(set(day for day, path in self.index.partitions(until=before) if day < before))
+        for day in days:
+            paths = sorted(set(path for partition_day, path in self.index.partitions(day, day)))
+            compacted = os.path.join(day, COMPACTED)
+            if paths == [compacted]:
+                continue
+            seen = set()
+            counts = {}
+            with BinaryRowWriter(os.path.join(self.directory, compacted)) as writer:
+                for path in paths:
+                    for row in iter_rows(os.path.join(self.directory, path)):
+                        row = tuple(row)
+                        if row not in seen:
+                            seen.add(row)
+                            writer.write(row)
+                            counts[row[3]] = counts.get(row[3], 0) + 1
+            self.index.replace_day(day, compacted, counts)
+            for path in paths:
+                if path != compacted:
+                    os.remove(os.path.join(self.directory, path))
+            logger.info('Compacted %d partitions of %s into %d rows' % (len(paths), day, len(seen)))
+        return len(days)
+
+    def close(self):
+        self.index.close()
+
+
+def history_directory():
+    """ [Baler] history_directory of combine.cfg, None when there is no combine.cfg"""
+    config = ConfigParser.SafeConfigParser()
+    cfg_success = config.read('combine.cfg')
+    if not cfg_success:
+        logger.error('history: Could not read combine.cfg.')
+        logger.error('HINT: edit combine-example.cfg and save as combine.cfg.')
+        return None
+    if config.has_option('Baler', 'history_directory'):
+        return config.get('Baler', 'history_directory')
+    return 'history'
+
+
+def open_history(day=None):
+    """ HistoryWriter filing rows under their own dates, or all under day"""
+    directory = history_directory()
+    if directory is None:
+        return None
+    return HistoryWriter(directory, day)
+
+
+def record(input_file, writer):
+    """ add the rows of an intermediate file to the history through writer"""
+    if writer is None:
+        return
+    logger.info('Recording %s in the history' % input_file)
+    try:
+        for row in iter_rows(input_file):
+            writer.write(row)
+    except:
+        writer.abort()
+        raise
+    writer.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--directory', help="History store. Defaults to history_directory of combine.cfg")
+    subparsers = parser.add_subparsers(dest='command')
+    lookup_parser = subparsers.add_parser('lookup', help="When and where an entity was seen")
+    lookup_parser.add_argument('entity')
+    scan_parser = subparsers.add_parser('scan', help="Rows seen between two days, as CSV")
+    scan_parser.add_argument('--since', help="First day, YYYY-MM-DD")
+    scan_parser.add_argument('--until', help="Last day, YYYY-MM-DD")
+    scan_parser.add_argument('--source', help="Only rows from this feed URL")
+    scan_parser.add_argument('--entity', help="Only rows for this entity")
+    compact_parser = subparsers.add_parser('compact', help="Merge the partitions of old days")
+    compact_parser.add_argument('--older-than', type=int, default=30, help="Days to leave alone")
+    add_parser = subparsers.add_parser('add', help="Add a crop file to the history")
+    add_parser.add_argument('input_file')
+    add_parser.add_argument('--day', help="Day to file all rows under. Defaults to the date of each row")
+    args = parser.parse_args()
+
+    directory = args.directory or history_directory()
+    if directory is None:
+        sys.exit(1)
+    if args.command == 'add':
+        record(args.input_file, HistoryWriter(directory, args.day))
+        sys.exit(0)
+
+    history = History(directory)
+    try:
+        if args.command == 'lookup':
+            sightings = history.lookup(args.entity.decode('utf8'))
+            if not sightings:
+                print('%s was never seen' % args.entity)
+            else:
+                print('%s first seen %s, last seen %s' % (args.entity, min(s[3] for s in sightings),
+                                                          max(s[4] for s in sightings)))
+                for (i_type, direction, source, first_seen, last_seen) in sightings:
+                    print('  %s %s %s: %s to %s' % (i_type, direction, source, first_seen, last_seen))
+        elif args.command == 'scan':
+            writer = unicodecsv.writer(sys.stdout, quoting=unicodecsv.QUOTE_ALL)
+            for day, row in history.scan(args.since, args.until, args.source,
+                                         args.entity.decode('utf8') if args.entity else None):
+                writer.writerow((day,) + tuple(row))
+        else:
+            before = (dt.date.today() - dt.timedelta(days=args.older_than)).isoformat()
+            logger.info('Compacted %d days' % history.compact(before))
+    finally:
+        history.close()
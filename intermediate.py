@@ -0,0 +1,357 @@
+import argparse
+import codecs
+import json
+import os
+import struct
+import sys
+import time
+import zlib
+from array import array
+from itertools import izip
+
+from logger import get_logger
+
+logger = get_logger('intermediate')
+
+CHUNK_SIZE = 64 * 1024
+WHITESPACE = ' \t\r\n'
+
+# binary intermediates: MAGIC, then zlib compressed blocks of up to BLOCK_ROWS rows
+MAGIC = 'COMBINE\x01'
+BLOCK_ROWS = 8192
+# type, direction, source, notes, date, and the ASN and country of enriched rows repeat a lot,
+# so they are stored as indices into a dictionary that grows along with the file
+DICTIONARY_COLUMNS = frozenset((1, 2, 3, 4, 5, 6, 7, 8))
+# past this many entries a column is stored plainly, it isn't repeating much
+MAX_DICTIONARY = 1 << 16
+FORMATS = ('json', 'binary')
+EXTENSIONS = {'json': 'json', 'binary': 'rows'}
+BIG_ENDIAN = sys.byteorder == 'big'
+
+
+class RowWriter(object):
+    """ write rows to a JSON list one row per line, without holding them in memory
+
+    Rows go to a partial file that only replaces filename once closed
+    cleanly, so a stage can read and rewrite the same file.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.partial = filename + '.partial'
+        self.f = open(self.partial, 'wb')
+        self.f.write('[')
+        self.count = 0
+
+    def write(self, row):
+        self.f.write(',\n' if self.count else '\n')
+        self.f.write(json.dumps(row))
+        self.count += 1
+
+    def close(self):
+        self.f.write('\n]\n')
+        self.f.close()
+        os.rename(self.partial, self.filename)
+
+    def abort(self):
+        self.f.close()
+        os.remove(self.partial)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def dump_rows(rows, filename, fmt='json'):
+    with open_rows(filename, fmt) as writer:
+        for row in rows:
+            writer.write(row)
+    return writer.count
+
+
+def iter_rows(filename):
+    """ yield the rows of an intermediate file one at a time, in either format
+
+    Binary files are told apart from JSON by their MAGIC.
+    """
+    with open(filename, 'rb') as f:
+        if f.read(len(MAGIC)) == MAGIC:
+            rows = iter_binary_rows(f)
+        else:
+            f.seek(0)
+            rows = iter_json_rows(f)
+        for row in rows:
+            yield row
+
+
+def iter_json_rows(f):
+    """ yield the rows of an open JSON list file one at a time
+
+    Works for any layout of the list, including the indented files written
+    by earlier versions, and never holds more than one row plus a read
+    chunk in memory.
+    """
+    filename = f.name
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder('utf8')()
+    buf = u''
+    pos = 0
+    eof = False
+    started = False
+    while True:
+        while pos < len(buf) and buf[pos] in WHITESPACE:
+            pos += 1
+        if pos < len(buf):
+            if not started:
+                if buf[pos] != '[':
+                    raise ValueError('%s does not hold a JSON list' % filename)
+                started = True
+                pos += 1
+                continue
+            if buf[pos] == ']':
+                return
+            if buf[pos] == ',':
+                pos += 1
+                continue
+            try:
+                row, pos = decoder.raw_decode(buf, pos)
+            except ValueError:
+                if eof:
+                    raise
+            else:
+                yield row
+                continue
+        elif eof:
+            raise ValueError('%s ends before its JSON list does' % filename)
+        chunk = f.read(CHUNK_SIZE)
+        eof = not chunk
+        buf = buf[pos:] + utf8.decode(chunk, final=eof)
+        pos = 0
+
+
+def little_endian(values):
+    if BIG_ENDIAN:
+        values.byteswap()
+    return values
+
+
+def encode_values(values):
+    """ a run of values, either NUL separated or, for values that are not all
+    strings or that contain NULs, length-prefixed
+
+    NUL separated values are decoded in one go; the positions of Nones among
+    them are kept apart. Length-prefixed values mark None with a length of
+    -1 and values that are not strings, stored as JSON, with other negative
+    lengths.
+    """
+    nones = array('I', [index for index, value in enumerate(values) if value is None] if None in values else [])
+    try:
+        data = u'\0'.join([u'' if value is None else value for value in values])
+    except (TypeError, UnicodeError):
+        data = None
+    if data is not None and data.count(u'\0') == max(len(values) - 1, 0):
+        data = data.encode('utf8')
+        return ('S' + struct.pack('<I', len(nones)) + little_endian(nones).tostring() +
+                struct.pack('<I', len(data)) + data)
+
+    lengths = array('i')
+    data = []
+    for value in values:
+        if value is None:
+            lengths.append(-1)
+            continue
+        if isinstance(value, unicode):
+            encoded = value.encode('utf8')
+            lengths.append(len(encoded))
+        elif isinstance(value, str):
+            encoded = value
+            lengths.append(len(encoded))
+        else:
+            encoded = json.dumps(value)
+            lengths.append(-2 - len(encoded))
+        data.append(encoded)
+    data = ''.join(data)
+    return 'L' + little_endian(lengths).tostring() + struct.pack('<I', len(data)) + data
+
+
+def decode_values(block, pos, count):
+    """ (values, position after them) for count values encoded at pos"""
+    kind = block[pos]
+    pos += 1
+    if kind == 'S':
+        (none_count,) = struct.unpack_from('<I', block, pos)
+        nones = array('I')
+        nones.fromstring(block[pos + 4:pos + 4 + 4 * none_count])
+        pos += 4 + 4 * none_count
+        (size,) = struct.unpack_from('<I', block, pos)
+        pos += 4
+        values = block[pos:pos + size].decode('utf8').split(u'\0') if count else []
+        for index in little_endian(nones):
+            values[index] = None
+        return values, pos + size
+    if kind != 'L':
+        raise ValueError('unknown kind of values %r' % kind)
+
+    lengths = array('i')
+    lengths.fromstring(block[pos:pos + 4 * count])
+    little_endian(lengths)
+    pos += 4 * count
+    (size,) = struct.unpack_from('<I', block, pos)
+    pos += 4
+    data = block[pos:pos + size]
+    values = []
+    append = values.append
+    start = 0
+    for length in lengths:
+        if length >= 0:
+            append(data[start:start + length].decode('utf8'))
+            start += length
+        elif length == -1:
+            append(None)
+        else:
+            length = -2 - length
+            append(json.loads(data[start:start + length]))
+            start += length
+    return values, pos + size
+
+
+class BinaryRowWriter(RowWriter):
+    """ write rows to a compact binary file, BLOCK_ROWS at a time
+
+    Every block holds its rows column by column: the columns in
+    DICTIONARY_COLUMNS as indices into a per-column dictionary (new entries
+    are stored in the block that first uses them), the others as
+    length-prefixed UTF-8. Blocks are compressed with zlib.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.partial = filename + '.partial'
+        self.f = open(self.partial, 'wb')
+        self.f.write(MAGIC)
+        self.count = 0
+        self.rows = []
+        self.dictionaries = {}
+
+    def write(self, row):
+        if self.rows and len(row) != len(self.rows[0]):
+            self.flush()
+        self.rows.append(row)
+        self.count += 1
+        if len(self.rows) >= BLOCK_ROWS:
+            self.flush()
+
+    def encode_column(self, index, column):
+        dictionary = self.dictionaries.get(index) if index in DICTIONARY_COLUMNS else None
+        if dictionary is None or len(dictionary) > MAX_DICTIONARY:
+            return 'P' + encode_values(column)
+        added = []
+        indices = array('I')
+        for value in column:
+            try:
+                position = dictionary[value]
+            except KeyError:
+                position = dictionary[value] = len(dictionary)
+                added.append(value)
+            except TypeError:
+                # unhashable values can't be looked up, forget what this block added
+                for value in added:
+                    del dictionary[value]
+                return 'P' + encode_values(column)
+            indices.append(position)
+        return 'D' + struct.pack('<I', len(added)) + encode_values(added) + little_endian(indices).tostring()
+
+    def flush(self):
+        if not self.rows:
+            return
+        width = len(self.rows[0])
+        for index in DICTIONARY_COLUMNS:
+            if index < width:
+                self.dictionaries.setdefault(index, {})
+        parts = [struct.pack('<II', len(self.rows), width)]
+        for index, column in enumerate(zip(*self.rows)):
+            parts.append(self.encode_column(index, column))
+        block = zlib.compress(''.join(parts), 1)
+        self.f.write(struct.pack('<I', len(block)))
+        self.f.write(block)
+        self.rows = []
+
+    def close(self):
+        self.flush()
+        self.f.close()
+        os.rename(self.partial, self.filename)
+
+
+def iter_binary_rows(f):
+    """ yield the rows of an open binary intermediate file, past its MAGIC"""
+    dictionaries = {}
+    while True:
+        header = f.read(4)
+        if not header:
+            return
+        if len(header) < 4:
+            raise ValueError('%s ends in the middle of a block' % f.name)
+        (size,) = struct.unpack('<I', header)
+        compressed = f.read(size)
+        if len(compressed) < size:
+            raise ValueError('%s ends in the middle of a block' % f.name)
+        block = zlib.decompress(compressed)
+        (count, width) = struct.unpack_from('<II', block)
+        pos = 8
+        columns = []
+        for index in range(width):
+            kind = block[pos]
+            pos += 1
+            if kind == 'P':
+                column, pos = decode_values(block, pos, count)
+            elif kind == 'D':
+                (added,) = struct.unpack_from('<I', block, pos)
+                entries, pos = decode_values(block, pos + 4, added)
+                dictionary = dictionaries.setdefault(index, [])
+                dictionary.extend(entries)
+                indices = array('I')
+                indices.fromstring(block[pos:pos + 4 * count])
+                pos += 4 * count
+                column = map(dictionary.__getitem__, little_endian(indices))
+            else:
+                raise ValueError('%s has a column of unknown kind %r' % (f.name, kind))
+            columns.append(column)
+        for row in izip(*columns):
+            yield row
+
+
+def open_rows(filename, fmt='json'):
+    """ RowWriter for filename in one of FORMATS"""
+    if fmt == 'binary':
+        return BinaryRowWriter(filename)
+    if fmt != 'json':
+        raise ValueError('Unknown intermediate format %s, use one of %s' % (fmt, FORMATS))
+    return RowWriter(filename)
+
+
+def intermediate_file(name, fmt='json'):
+    """ file name of the name intermediate (crop, enrich) in fmt"""
+    return '%s.%s' % (name, EXTENSIONS[fmt])
+
+
+def convert(in_file, out_file, fmt):
+    """ rewrite an intermediate file in fmt, e.g. a binary crop as JSON to look at it"""
+    start = time.time()
+    count = dump_rows(iter_rows(in_file), out_file, fmt)
+    logger.info('Converted %d rows from %s (%d bytes) to %s (%d bytes) in %.2f seconds' %
+                (count, in_file, os.path.getsize(in_file), out_file, os.path.getsize(out_file),
+                 time.time() - start))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('in_file', help="crop or enrich file, JSON or binary")
+    parser.add_argument('out_file')
+    parser.add_argument('--format', choices=FORMATS, default='json', help="Format to write")
+    args = parser.parse_args()
+    convert(args.in_file, args.out_file, args.format)
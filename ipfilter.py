@@ -0,0 +1,151 @@
+import argparse
+import numpy as np
+import random
+import time
+
+from netaddr import IPAddress, IPSet
+from netaddr.ip import IPV4_LINK_LOCAL, IPV4_PRIVATE, IPV4_RESERVED
+
+from logger import get_logger
+
+logger = get_logger('ipfilter')
+
+# a dotted quad is at most 15 characters; the 16th byte tells longer strings apart
+WIDTH = 16
+DOT = ord('.')
+ZERO = ord('0')
+
+
+def parse_ipv4(addresses):
+    """ parse dotted quads into a uint32 array in one pass over a byte matrix
+
+    Returns (values, valid): valid marks the strings that are IPv4 addresses
+    the way winnower.is_ipv4 accepts them (four dot separated decimal
+    octets of one to three digits, each at most 255), and values holds their
+    integer form (0 where valid is False).
+    """
+    try:
+        strings = np.array(addresses, dtype='S%d' % WIDTH)
+    except UnicodeError:
+        strings = np.array([address.encode('ascii', 'replace') for address in addresses], dtype='S%d' % WIDTH)
+    count = len(strings)
+    # one contiguous row per character position, so every step below is a plain vector operation
+    columns = np.ascontiguousarray(strings.view(np.uint8).reshape(count, WIDTH).T)
+
+    # a dotted quad is at most 15 characters, so the last byte has to be padding
+    valid = columns[WIDTH - 1] == 0
+    ended = np.zeros(count, dtype=bool)
+    dots = np.zeros(count, dtype=np.uint32)
+    octet = np.zeros(count, dtype=np.uint32)
+    run = np.zeros(count, dtype=np.uint32)
+    largest = np.zeros(count, dtype=np.uint32)
+    values = np.zeros(count, dtype=np.uint32)
+    # branch free: the masks are used as 0/1 factors, which is much cheaper than masked assignment
+    for column in columns[:WIDTH - 1]:
+        value = column.astype(np.uint32) - ZERO
+        digit = value <= 9
+        dot = column == DOT
+        padding = column == 0
+        # only digits, dots and trailing padding, and no empty octets
+        valid &= digit | dot | padding
+        valid &= ~(ended & ~padding)
+        valid &= ~(dot & (run == 0))
+        ended |= padding
+        # a dot shifts the octet into the address and starts the next one
+        digit = digit.astype(np.uint32)
+        dot = dot.astype(np.uint32)
+        kept = 1 - dot
+        values *= 1 + 255 * dot
+        values += octet * dot
+        octet *= 1 + 9 * digit
+        octet *= kept
+        octet += value * digit
+        run += digit
+        run *= kept
+        valid &= run <= 3
+        np.maximum(largest, octet, largest)
+        dots += dot
+    valid &= (dots == 3) & (run > 0) & (largest <= 255)
+    values = values * 256 + octet
+    values[~valid] = 0
+    return values, valid
+
+
+class RangeTable(object):
+    """ disjoint address ranges as sorted uint32 start/end arrays, searched in bulk"""
+
+    def __init__(self, ranges):
+        merged = []
+        for first, last in sorted(ranges):
+            if merged and first <= merged[-1][1] + 1:
+                merged[-1][1] = max(merged[-1][1], last)
+            else:
+                merged.append([first, last])
+        self.starts = np.array([first for first, last in merged], dtype=np.uint32)
+        self.ends = np.array([last for first, last in merged], dtype=np.uint32)
+
+    @classmethod
+    def from_networks(cls, networks):
+        """ build the table from netaddr IPNetwork, IPRange or IPSet objects"""
+        ranges = []
+        for network in networks:
+            for cidr in (network.iter_cidrs() if isinstance(network, IPSet) else [network]):
+                ranges.append((cidr.first, cidr.last))
+        return cls(ranges)
+
+    def __len__(self):
+        return len(self.starts)
+
+    def contains(self, values):
+        """ mask of the uint32 values that fall in one of the ranges"""
+        positions = np.searchsorted(self.starts, values, side='right') - 1
+        inside = positions >= 0
+        inside[inside] = values[inside] <= self.ends[positions[inside]]
+        return inside
+
+
+def reserved_table(extra_ranges=None):
+    """ every block winnower.reserved() rejects: netaddr's reserved, private and
+    link-local blocks plus extra_ranges (an IPSet)"""
+    networks = list(IPV4_RESERVED) + list(IPV4_PRIVATE) + [IPV4_LINK_LOCAL]
+    if extra_ranges is not None:
+        networks.append(extra_ranges)
+    return RangeTable.from_networks(networks)
+
+
+def filter_ipv4(addresses, table):
+    """ (keep, reject, values) for a batch of address strings
+
+    keep marks the valid addresses outside the table, reject the valid
+    ones inside it; strings that are not addresses are in neither.
+    """
+    values, valid = parse_ipv4(addresses)
+    inside = table.contains(values)
+    return valid & ~inside, valid & inside, values
+
+
+def benchmark(count):
+    """ time filter_ipv4 against the per-address netaddr checks it replaces"""
+    import winnower
+    addresses = ['%d.%d.%d.%d' % tuple(random.randint(0, 255) for i in range(4)) for i in range(count)]
+    table = reserved_table(winnower.reserved_ranges)
+
+    start = time.time()
+    keep, reject, values = filter_ipv4(addresses, table)
+    batch = time.time() - start
+
+    sample = addresses[:min(count, 100000)]
+    start = time.time()
+    expected = [winnower.is_ipv4(address) and not winnower.reserved(IPAddress(address)) for address in sample]
+    legacy = (time.time() - start) * count / len(sample)
+
+    assert expected == keep[:len(sample)].tolist()
+    logger.info('Filtered %d addresses in %.2f seconds (netaddr: about %.1f seconds), %d kept' %
+                (count, batch, legacy, keep.sum()))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--benchmark', type=int, default=1000000, help="Number of random addresses to filter")
+    args = parser.parse_args()
+    benchmark(args.benchmark)
@@ -1,4 +1,6 @@
 import logging
+import time
+from contextlib import contextmanager
 
 def get_logger(name=None):
     root_logger_name = 'combine'
@@ -22,4 +24,11 @@ def get_logger(name=None):
         formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
         ch.setFormatter(formatter)
         root_logger.addHandler(ch)
-        return logging.getLogger(name)
\ No newline at end of file
+        return logging.getLogger(name)
+
+@contextmanager
+def log_duration(logger, stage):
+    """ log how long the body of the with statement took"""
+    start = time.time()
+    yield
+    logger.info('%s took %.2f seconds' % (stage, time.time() - start))
@@ -0,0 +1,181 @@
+import json
+import os
+import resource
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+from logger import get_logger
+
+logger = get_logger('metrics')
+
+# ru_maxrss is in kilobytes on Linux and in bytes on OS X
+RSS_UNIT = 1 if sys.platform == 'darwin' else 1024
+
+# per feed field -> (Prometheus metric, help)
+FEED_METRICS = (('bytes', 'combine_feed_bytes', 'Bytes of the feed body fetched'),
+                ('fetch_seconds', 'combine_feed_fetch_seconds', 'Seconds spent fetching the feed'),
+                ('status', 'combine_feed_http_status', 'HTTP status of the last fetch'),
+                ('parse_seconds', 'combine_feed_parse_seconds', 'Seconds spent parsing the feed'),
+                ('rows', 'combine_feed_rows', 'Rows the parser produced'),
+                ('rejected', 'combine_feed_rejected_rows', 'Rows the winnower rejected'),
+                ('fetch_errors', 'combine_feed_fetch_errors', 'Fetch attempts that failed'))
+STAGE_METRICS = (('wall_seconds', 'combine_stage_wall_seconds', 'Wall clock seconds of the stage'),
+                 ('cpu_seconds', 'combine_stage_cpu_seconds',
+                  'CPU seconds of the stage, including worker processes that finished'),
+                 ('process_peak_rss_bytes', 'combine_stage_process_peak_rss_bytes',
+                  'Peak resident memory of the run when the stage ended, including finished worker processes'))
+COUNTER_HELP = {'dnsdb_calls': 'DNSDB requests made',
+                'dnsdb_seconds': 'Seconds spent waiting for DNSDB answers',
+                'dnsdb_cache_hits': 'DNSDB lookups answered from the cache',
+                'dnsdb_cache_negative_hits': 'DNSDB lookups answered from the cache without records',
+                'dnsdb_cache_misses': 'DNSDB lookups the cache could not answer',
+                'crits_uploaded': 'Indicators uploaded to CRITs',
+                'crits_failed': 'Indicators CRITs did not take'}
+
+
+def usage():
+    """ (cpu seconds, peak rss bytes) of this process plus its finished children
+
+    The peak is the highest the process got since it started, not what the
+    stage in progress used; it only rises.
+    """
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return (own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime,
+            max(own.ru_maxrss, children.ru_maxrss) * RSS_UNIT)
+
+
+def escape_label(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class RunMetrics(object):
+    """ what a run measured: per feed figures, per stage resource use and counters
+
+    Feed figures are set where the reaper and thresher handle a feed, and
+    counted where later stages touch its rows, always under the URL the
+    feed was requested from. Worker processes hand what they counted back
+    with drain(), for the parent to merge().
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.feeds = {}
+        self.stages = []
+        self.counters = {}
+        self.aliases = {}
+
+    def alias(self, url, feed):
+        """ count figures reported for url (where feed redirected to) under feed"""
+        with self.lock:
+            self.aliases[url] = feed
+
+    def feed(self, url, **values):
+        """ set figures of a feed"""
+        with self.lock:
+            self.feeds.setdefault(self.aliases.get(url, url), {}).update(values)
+
+    def add_feed(self, url, field, value=1):
+        """ add to a figure of a feed"""
+        with self.lock:
+            figures = self.feeds.setdefault(self.aliases.get(url, url), {})
+            figures[field] = figures.get(field, 0) + value
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    @contextmanager
+    def stage(self, name):
+        """ measure wall time and CPU time of the body of the with statement, and the peak RSS of the run after it"""
+        start = time.time()
+        cpu = usage()[0]
+        try:
+            yield
+        finally:
+            end_cpu, end_rss = usage()
+            with self.lock:
+                self.stages.append({'stage': name, 'wall_seconds': time.time() - start,
+                                    'cpu_seconds': end_cpu - cpu, 'process_peak_rss_bytes': end_rss})
+
+    def drain(self):
+        """ what was counted since the last drain, for a parent process to merge()"""
+        with self.lock:
+            snapshot = {'feeds': self.feeds, 'counters': self.counters}
+            self.feeds = {}
+            self.counters = {}
+        return snapshot
+
+    def merge(self, snapshot):
+        for url, figures in snapshot['feeds'].items():
+            for field, value in figures.items():
+                self.add_feed(url, field, value)
+        for name, value in snapshot['counters'].items():
+            self.count(name, value)
+
+    def report(self):
+        with self.lock:
+            counters = dict(self.counters)
+            report = {'started': self.started, 'duration_seconds': time.time() - self.started,
+                      'feeds': dict((url, dict(figures)) for url, figures in self.feeds.items()),
+                      'stages': list(self.stages), 'counters': counters}
+        lookups = sum(counters.get(name, 0) for name in
+                      ('dnsdb_cache_hits', 'dnsdb_cache_negative_hits', 'dnsdb_cache_misses'))
+        if lookups:
+            report['dnsdb_cache_hit_rate'] = float(lookups - counters.get('dnsdb_cache_misses', 0)) / lookups
+        if counters.get('dnsdb_calls'):
+            report['dnsdb_mean_latency_seconds'] = counters.get('dnsdb_seconds', 0) / counters['dnsdb_calls']
+        return report
+
+    def prometheus(self):
+        """ the report in the Prometheus text exposition format"""
+        report = self.report()
+        lines = []
+
+        def metric(name, help, samples):
+            lines.append('# HELP %s %s' % (name, help))
+            lines.append('# TYPE %s gauge' % name)
+            for labels, value in samples:
+                label_text = ','.join('%s="%s"' % (key, escape_label(label)) for key, label in labels)
+                lines.append('%s%s %s' % (name, '{%s}' % label_text if label_text else '', repr(float(value))))
+
+        metric('combine_run_start_timestamp_seconds', 'When the run started', [((), report['started'])])
+        metric('combine_run_duration_seconds', 'Seconds the run took', [((), report['duration_seconds'])])
+        for field, name, help in STAGE_METRICS:
+            metric(name, help, [((('stage', stage['stage']),), stage[field]) for stage in report['stages']])
+        for field, name, help in FEED_METRICS:
+            samples = [((('feed', url),), figures[field]) for url, figures in sorted(report['feeds'].items())
+                       if figures.get(field) is not None]
+            if samples:
+                metric(name, help, samples)
+        for counter, value in sorted(report['counters'].items()):
+            metric('combine_' + counter, COUNTER_HELP.get(counter, counter.replace('_', ' ')), [((), value)])
+        if 'dnsdb_cache_hit_rate' in report:
+            metric('combine_dnsdb_cache_hit_ratio', 'Share of DNSDB lookups answered from the cache',
+                   [((), report['dnsdb_cache_hit_rate'])])
+        if 'dnsdb_mean_latency_seconds' in report:
+            metric('combine_dnsdb_mean_latency_seconds', 'Mean seconds DNSDB took to answer',
+                   [((), report['dnsdb_mean_latency_seconds'])])
+        return '\n'.join(lines) + '\n'
+
+    def write(self, filename, text):
+        # written aside and renamed, so a collector never reads half a file
+        partial = filename + '.partial'
+        with open(partial, 'wb') as f:
+            f.write(text.encode('utf8') if isinstance(text, unicode) else text)
+        os.rename(partial, filename)
+
+    def write_json(self, filename):
+        logger.info('Writing the run report to %s' % filename)
+        self.write(filename, json.dumps(self.report(), indent=2, sort_keys=True))
+
+    def write_prometheus(self, filename):
+        logger.info('Writing Prometheus metrics to %s' % filename)
+        self.write(filename, self.prometheus())
+
+
+# the metrics of this run, shared by every stage
+metrics = RunMetrics()
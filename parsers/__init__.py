@@ -0,0 +1,98 @@
+import importlib
+import urlparse
+
+from logger import get_logger
+
+logger = get_logger('parsers')
+
+# parser name -> 'module:function'; modules are only imported once a feed needs them
+PARSERS = {'simple_list': 'parsers.lists:process_simple_list',
+           'sans': 'parsers.lists:process_sans',
+           'virbl': 'parsers.lists:process_virbl',
+           'drg': 'parsers.lists:process_drg',
+           'alienvault': 'parsers.lists:process_alienvault',
+           'rulez': 'parsers.lists:process_rulez',
+           'packetmail': 'parsers.lists:process_packetmail',
+           'autoshun': 'parsers.lists:process_autoshun',
+           'haleys': 'parsers.lists:process_haleys',
+           'project_honeypot': 'parsers.honeypot:process_project_honeypot',
+           'malwaregroup': 'parsers.malwaregroup:process_malwaregroup'}
+
+# feed URL, URL prefix or hostname -> parser name. A hostname entry also covers its subdomains, a URL
+# entry every URL that starts with it. Feeds can name their parser explicitly in the URL files instead (cf. #23).
+FEEDS = {'projecthoneypot.org': 'project_honeypot',
+         'openbl.org': 'simple_list',
+         'blocklist.de': 'simple_list',
+         'ciarmy.com': 'simple_list',
+         'alienvault.com': 'alienvault',
+         'rulez.sk': 'rulez',
+         'sans.edu': 'sans',
+         # only these nothink.org lists are simple lists
+         'http://www.nothink.org/blacklist/blacklist_ssh': 'simple_list',
+         'http://www.nothink.org/blacklist/blacklist_malware': 'simple_list',
+         'abuse.ch': 'simple_list',
+         'packetmail.net': 'packetmail',
+         'autoshun.org': 'autoshun',
+         'the-haleys.org': 'haleys',
+         'virbl.org': 'simple_list',
+         'dragonresearchgroup.org': 'drg',
+         'malwaregroup.com': 'malwaregroup',
+         'malc0de.com': 'simple_list'}
+
+# local files are simple lists unless they say otherwise
+SCHEMES = {'file': 'simple_list'}
+
+
+class ParserRegistry(object):
+
+    def __init__(self, parsers=None, feeds=None, schemes=None):
+        self.parsers = dict(PARSERS if parsers is None else parsers)
+        self.feeds = dict(FEEDS if feeds is None else feeds)
+        self.schemes = dict(SCHEMES if schemes is None else schemes)
+        self.loaded = {}
+
+    def register(self, feed, parser):
+        """ route a feed URL or hostname to a parser name or 'module:function'"""
+        self.feeds[feed] = parser
+
+    def resolve(self, url, parser=None):
+        """ name of the parser for url: explicit choice, exact URL, URL prefix, hostname, then scheme"""
+        if parser:
+            return parser
+        if url in self.feeds:
+            return self.feeds[url]
+        # the longest registered URL the feed's URL starts with
+        prefix = ''
+        for feed in self.feeds:
+            if '://' in feed and url.startswith(feed) and len(feed) > len(prefix):
+                prefix = feed
+        if prefix:
+            return self.feeds[prefix]
+        parts = urlparse.urlsplit(url)
+        labels = (parts.hostname or '').split('.')
+        for n in range(len(labels) - 1):
+            name = '.'.join(labels[n:])
+            if name in self.feeds:
+                return self.feeds[name]
+        return self.schemes.get(parts.scheme)
+
+    def load(self, name):
+        """ import the parser behind a name (or a 'module:function' spec) on first use"""
+        if name not in self.loaded:
+            module_name, _, function_name = self.parsers.get(name, name).partition(':')
+            self.loaded[name] = getattr(importlib.import_module(module_name), function_name)
+        return self.loaded[name]
+
+    def dispatch_table(self, entries):
+        """ map every manifest URL to its parser once per run"""
+        table = {}
+        for entry in entries:
+            name = self.resolve(entry['url'], entry.get('parser'))
+            if name:
+                table[entry['url']] = name
+            else:
+                logger.error('No parser registered for %s', entry['url'])
+        return table
+
+
+registry = ParserRegistry()
@@ -0,0 +1,11 @@
+import feedparser
+from classifier import indicator_type
+
+
+def process_project_honeypot(response, source, direction):
+    data = []
+    for entry in feedparser.parse(response).entries:
+        i = entry.title.partition(' ')[0]
+        i_date = entry.description.split(' ')[-1]
+        data.append((i, indicator_type(i), direction, source, '', i_date))
+    return data
@@ -0,0 +1,108 @@
+import datetime
+import re
+from classifier import indicator_type
+from csv import reader
+from itertools import ifilter
+
+
+def process_simple_list(response, source, direction):
+    data = []
+    current_date = str(datetime.date.today())
+    for line in response.splitlines():
+        if not line.startswith('#') and not line.startswith('/') and not line.startswith('Export date') and len(line) > 0:
+            i = line.split()[0]
+            data.append((i, indicator_type(i), direction, source, '', current_date))
+    return data
+
+
+def process_sans(response, source, direction):
+    data = []
+    for line in response.splitlines():
+        if not line.startswith('#') and len(line) > 0:
+            # Because SANS zero-pads their addresses
+            i = re.sub(r'\.0{1,2}', '.', line.split()[0].lstrip('0'))
+            date = line.split()[-1]
+            data.append((i, indicator_type(i), direction, source, '', date))
+    return data
+
+
+def process_virbl(response, source, direction):
+    data = []
+    current_date = str(datetime.date.today())
+    for line in response.splitlines():
+        if not line.startswith('E') and len(line) > 0:
+            i = line.split()[0]
+            data.append((i, indicator_type(i), direction, source, '', current_date))
+    return data
+
+
+def process_drg(response, source, direction):
+    data = []
+    current_date = str(datetime.date.today())
+    for line in response.splitlines():
+        if not line.startswith('#') and len(line) > 0:
+            i = line.split('|')[2].strip()
+            data.append((i, indicator_type(i), direction, source, '', current_date))
+    return data
+
+
+def process_alienvault(response, source, direction):
+    data = []
+    current_date = str(datetime.date.today())
+    for line in response.splitlines():
+        if not line.startswith('#') and len(line) > 0:
+            i = line.partition('#')[0].strip()
+            note = line.split('#')[3].strip()
+            if 'Scanning Host' in note or 'Spamming' in note:
+                direction = 'inbound'
+            elif 'Malware' in note or 'C&C' in note or 'APT' in note:
+                direction = 'outbound'
+            data.append((i, indicator_type(i), direction, source, note, current_date))
+    return data
+
+
+def process_rulez(response, source, direction):
+    data = []
+    for line in response.splitlines():
+        if not line.startswith('#') and len(line) > 0:
+            i = line.partition('#')[0].strip()
+            date = line.partition('#')[2].split(' ')[1]
+            data.append((i, indicator_type(i), direction, source, '', date))
+    return data
+
+
+def process_packetmail(response, source, direction):
+    data = []
+    filter_comments = lambda x: not x[0].startswith('#')
+    try:
+        for line in ifilter(filter_comments,
+                            reader(response.splitlines(), delimiter=';')):
+            i = line[0]
+            date = line[1].split(' ')[1]
+            data.append((i, indicator_type(i), direction, source, '', date))
+    except (IndexError, AttributeError):
+        pass
+    return data
+
+
+def process_autoshun(response, source, direction):
+    data = []
+    if response.startswith("Couldn't select database"):
+        return data
+    for line in response.splitlines():
+        if not line.startswith('S') and len(line) > 0:
+            i = line.partition(',')[0].strip()
+            date = line.split(',')[1].split()[0]
+            note = line.split(',')[-1]
+            data.append((i, indicator_type(i), direction, source, note, date))
+    return data
+
+
+def process_haleys(response, source, direction):
+    data = []
+    current_date = str(datetime.date.today())
+    for line in response.splitlines():
+        if not line.startswith('#') and len(line) > 0:
+            i = line.partition(':')[2].strip()
+            data.append((i, indicator_type(i), direction, source, '', current_date))
+    return data
@@ -0,0 +1,13 @@
+import bs4
+from classifier import indicator_type
+
+
+def process_malwaregroup(response, source, direction):
+    data = []
+    soup = bs4.BeautifulSoup(response)
+    for row in soup.find_all('tr'):
+        if row.td:
+            i = row.td.text
+            date = row.contents[-1].text
+            data.append((i, indicator_type(i), direction, source, '', date))
+    return data
@@ -0,0 +1,90 @@
+from baler import open_bale, open_tiq, output_extension
+from dedup import dedup_rows
+from intermediate import intermediate_file, open_rows
+from logger import get_logger
+from thresher import thresh_rows
+from winnower import winnow_rows
+
+logger = get_logger('pipeline')
+
+
+def tap(rows, *writers):
+    """ pass rows through unchanged, copying each one to every writer on the way"""
+    for row in rows:
+        for writer in writers:
+            writer.write(row)
+        yield row
+
+
+def stream(manifest_file, out_file, out_type, enrich=False, tiq_test=False, workers=None, intermediates=False,
+           dedup=False, shards=1, intermediate_format='json', delta=None, history=None):
+    """ run thresh, winnow and bale in one process, passing rows along as generators
+
+    Only the reaper's manifest is read from disk. The crop and enrich
+    intermediates are written only when requested, for debugging. With a
+    Delta, only the indicators it hasn't seen go past the thresher. With a
+    HistoryWriter, the whole crop is recorded in the history first.
+    """
+    crop = thresh_rows(manifest_file, workers)
+    if crop is None:
+        if history is not None:
+            history.abort()
+        return
+    if dedup:
+        crop = dedup_rows(crop)
+    if history is not None:
+        crop = tap(crop, history)
+    if delta is not None:
+        crop = delta.added(crop)
+
+    writers = [open_bale(out_file, out_type, True)]
+    if intermediates:
+        writers.append(open_rows(intermediate_file('crop', intermediate_format), intermediate_format))
+    # the history taps the crop above, but is only closed along with the bales
+    finishers = writers + ([history] if history is not None else [])
+    try:
+        crop = tap(crop, *writers)
+
+        harvest = None
+        if enrich or tiq_test:
+            harvest = winnow_rows(crop, shards)
+        if harvest is None:
+            for row in crop:
+                pass
+        else:
+            enriched = [open_bale('enriched.' + output_extension(out_type), out_type, False)]
+            if intermediates:
+                enriched.append(open_rows(intermediate_file('enrich', intermediate_format), intermediate_format))
+            tiq = open_tiq() if tiq_test else None
+            enriched_finishers = enriched + ([tiq] if tiq else [])
+            try:
+                for row, enrichment in harvest:
+                    if tiq:
+                        tiq.write_regular(row)
+                    for e_data in enrichment:
+                        for writer in enriched:
+                            writer.write(e_data)
+                        if tiq:
+                            tiq.write_enriched(e_data)
+            except:
+                abort(enriched_finishers)
+                raise
+            close(enriched_finishers)
+    except:
+        abort(finishers)
+        raise
+    close(finishers)
+
+
+def abort(writers):
+    """ give up on every writer after an error, so none of them publishes a partial harvest"""
+    for writer in writers:
+        try:
+            writer.abort()
+        except Exception as e:
+            logger.error('Could not abort %r: %s' % (writer, e))
+
+
+def close(writers):
+    for writer in writers:
+        writer.close()
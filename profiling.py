@@ -0,0 +1,213 @@
+import argparse
+import cProfile
+import hashlib
+import multiprocessing.util
+import os
+import pstats
+import re
+import signal
+import sys
+import thread
+from contextlib import contextmanager
+
+from logger import get_logger
+
+logger = get_logger('profiling')
+
+STAGES = ('reap', 'thresh', 'dedup', 'history', 'diff', 'winnow', 'bale', 'stream')
+FORMATS = ('pstats', 'collapsed')
+EXTENSIONS = {'pstats': 'prof', 'collapsed': 'collapsed'}
+# seconds of CPU time between two samples of a collapsed stack profile
+SAMPLE_INTERVAL = 0.005
+
+try:
+    import tracemalloc
+except ImportError:
+    # part of Python 3.4 and later; Python 2 needs the pytracemalloc patches
+    tracemalloc = None
+
+
+def profile_name(stage, part=None):
+    """ file name (without extension) for the profile of stage, or of part (a feed, a shard) of it"""
+    if part is None:
+        return stage
+    slug = re.sub(r'[^A-Za-z0-9.-]+', '_', part).strip('_')[:80]
+    if slug == part:
+        return '%s-%s' % (stage, slug)
+    # a hash of the whole URL keeps feeds whose slugs collide apart
+    return '%s-%s-%s' % (stage, slug, hashlib.sha1(part.encode('utf8')).hexdigest()[:8])
+
+
+class FunctionProfile(object):
+    """ deterministic profile of every call, saved as pstats"""
+
+    def __init__(self):
+        self.profile = cProfile.Profile()
+
+    def resume(self):
+        self.profile.enable()
+
+    def pause(self):
+        self.profile.disable()
+
+    def save(self, filename):
+        self.profile.dump_stats(filename)
+
+
+class StackProfile(object):
+    """ sampled stacks of every thread, saved as collapsed stacks for flamegraph.pl
+
+    Samples are taken on SIGPROF, which fires every SAMPLE_INTERVAL seconds
+    of CPU time the process uses; only the innermost running profile takes
+    them.
+    """
+    running = None
+
+    def __init__(self):
+        self.stacks = {}
+
+    @classmethod
+    def sample(cls, signum, frame):
+        profile = cls.running
+        if profile is None:
+            return
+        current = thread.get_ident()
+        for ident, thread_frame in sys._current_frames().items():
+            stack = []
+            # the handler runs on the main thread, on top of the frame it interrupted
+            thread_frame = frame if ident == current else thread_frame
+            while thread_frame is not None:
+                code = thread_frame.f_code
+                stack.append('%s (%s:%d)' % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+                thread_frame = thread_frame.f_back
+            key = ';'.join(reversed(stack))
+            profile.stacks[key] = profile.stacks.get(key, 0) + 1
+
+    def resume(self):
+        if StackProfile.running is None:
+            signal.signal(signal.SIGPROF, StackProfile.sample)
+            # restart interrupted system calls rather than failing them with EINTR
+            signal.siginterrupt(signal.SIGPROF, False)
+            signal.setitimer(signal.ITIMER_PROF, SAMPLE_INTERVAL, SAMPLE_INTERVAL)
+        StackProfile.running = self
+
+    def pause(self):
+        signal.setitimer(signal.ITIMER_PROF, 0)
+        StackProfile.running = None
+
+    def save(self, filename):
+        with open(filename, 'wb') as f:
+            for stack, count in sorted(self.stacks.items()):
+                f.write('%s %d\n' % (stack, count))
+
+
+class Profiler(object):
+    """ profiles the selected stages of a run into one file per stage and part
+
+    Profiles nest: while the profile of a feed runs, the profile of the
+    stage around it is paused, so each file only holds its own work.
+    """
+
+    def __init__(self, stages, directory='profiles', fmt='pstats', memory=False):
+        if fmt not in FORMATS:
+            raise ValueError('Unsupported profile format: %s' % fmt)
+        self.stages = frozenset(stages)
+        self.directory = directory
+        self.fmt = fmt
+        self.memory = memory
+        if memory and tracemalloc is None:
+            logger.warning('tracemalloc is not available on Python %d.%d, profiling without memory snapshots' %
+                           sys.version_info[:2])
+            self.memory = False
+        self.active = []
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        multiprocessing.util.register_after_fork(self, Profiler.forked)
+
+    def forked(self):
+        """ drop the profiles a worker process inherited, they are the parent's to save"""
+        for name, profile, snapshot in self.active:
+            profile.pause()
+        self.active = []
+
+    def start(self, stage, part=None):
+        """ start profiling part of stage, returning a handle for stop(); None when stage is not profiled"""
+        if stage not in self.stages:
+            return None
+        profile = FunctionProfile() if self.fmt == 'pstats' else StackProfile()
+        snapshot = None
+        if self.memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            snapshot = tracemalloc.take_snapshot()
+        if self.active:
+            self.active[-1][1].pause()
+        handle = (profile_name(stage, part), profile, snapshot)
+        self.active.append(handle)
+        profile.resume()
+        return handle
+
+    def stop(self, handle):
+        if handle is None:
+            return
+        name, profile, snapshot = handle
+        profile.pause()
+        self.active.remove(handle)
+        if self.active:
+            self.active[-1][1].resume()
+        filename = os.path.join(self.directory, '%s.%s' % (name, EXTENSIONS[self.fmt]))
+        profile.save(filename)
+        logger.info('Saved the profile of %s to %s' % (name, filename))
+        if snapshot is not None:
+            self.save_memory(name, snapshot)
+
+    def save_memory(self, name, before):
+        after = tracemalloc.take_snapshot()
+        filename = os.path.join(self.directory, '%s.tracemalloc' % name)
+        after.dump(filename)
+        logger.info('Saved the memory snapshot of %s to %s, largest growth:' % (name, filename))
+        for difference in after.compare_to(before, 'lineno')[:5]:
+            logger.info('  %s' % difference)
+
+
+# the Profiler of this run, set up by configure(); worker processes inherit it
+profiler = None
+
+
+def configure(stages, directory='profiles', fmt='pstats', memory=False):
+    global profiler
+    profiler = Profiler(stages, directory, fmt, memory)
+    logger.info('Profiling %s into %s' % (', '.join(sorted(profiler.stages)), directory))
+    return profiler
+
+
+def start(stage, part=None):
+    if profiler is None:
+        return None
+    return profiler.start(stage, part)
+
+
+def stop(handle):
+    if profiler is not None:
+        profiler.stop(handle)
+
+
+@contextmanager
+def stage(name, part=None):
+    """ profile the body of the with statement if stage name is profiled"""
+    handle = start(name, part)
+    try:
+        yield
+    finally:
+        stop(handle)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Show the functions that took longest in a saved pstats profile")
+    parser.add_argument('profile', nargs='+', help="pstats files; several are added up")
+    parser.add_argument('--sort', default='cumulative', help="pstats sort key, e.g. cumulative, tottime, calls")
+    parser.add_argument('--limit', type=int, default=25, help="Number of functions to show")
+    args = parser.parse_args()
+
+    stats = pstats.Stats(*args.profile)
+    stats.sort_stats(args.sort).print_stats(args.limit)
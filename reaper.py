@@ -1,17 +1,233 @@
+from gevent import monkey
+monkey.patch_all(thread=False, select=False)
+
 import ConfigParser
-import grequests
+import gevent
+import hashlib
 import json
+import os
+import requests
 import sys
+import tempfile
+import time
+import urlparse
+from gevent.lock import BoundedSemaphore
 from logger import get_logger
+from metrics import metrics
+from requests.adapters import HTTPAdapter
 import logging
 
 
 logger = get_logger('reaper')
 
-def exception_handler(request, exception):
-    logger.error("Request %r failed: %r" % (request, exception))
+CHUNK_SIZE = 64 * 1024
+VALIDATORS_FILE = 'validators.json'
+
+
+def exception_handler(url, exception):
+    logger.error("Request %r failed: %r" % (url, exception))
+
+
+def store_body(store_dir, chunks):
+    """ stream chunks into the content-addressed store and return the stored path"""
+    digest = hashlib.sha1()
+    fd, tmp_path = tempfile.mkstemp(dir=store_dir, prefix='.partial-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            for chunk in chunks:
+                digest.update(chunk)
+                f.write(chunk)
+    except:
+        os.remove(tmp_path)
+        raise
+    path = os.path.join(store_dir, digest.hexdigest())
+    # identical content always lands on the same name, so replacing is harmless
+    os.rename(tmp_path, path)
+    return path
+
+
+def prune_store(store_dir, keep):
+    """ remove the stored bodies (and leftover partial downloads) that no path in keep refers to"""
+    keep = set(os.path.abspath(path) for path in keep)
+    removed = 0
+    for name in os.listdir(store_dir):
+        path = os.path.join(store_dir, name)
+        if name == VALIDATORS_FILE or os.path.abspath(path) in keep or not os.path.isfile(path):
+            continue
+        os.remove(path)
+        removed += 1
+    if removed:
+        logger.info('Removed %d stored feed bodies from %s' % (removed, store_dir))
+
+
+def load_validators(file_name):
+    """ load the ETag/Last-Modified validators kept from previous runs"""
+    try:
+        with open(file_name, 'rb') as f:
+            return json.load(f)
+    except (EnvironmentError, ValueError):
+        return {}
+
+
+def save_validators(validators, file_name):
+    with open(file_name, 'wb') as f:
+        json.dump(validators, f, indent=2)
+
+
+class FetchScheduler(object):
+    """ one fetch queue for every feed, bounded globally and per host
+
+    All requests share a keep-alive Session. Each fetch gets its own
+    timeout and is retried with exponential backoff on connection errors,
+    429 and 5xx answers. A fetch takes its host's slot before one of the
+    global connection slots, and holds neither while it backs off, so a
+    slow or throttled host never keeps the other hosts waiting.
+    """
+    RETRY_STATUS = (429, 500, 502, 503, 504)
+
+    def __init__(self, store_dir, validators, max_connections=10, max_per_host=2,
+                 timeout=60, retries=3, backoff=1.0):
+        self.store_dir = store_dir
+        self.validators = validators
+        self.max_per_host = max_per_host
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.connections = BoundedSemaphore(max_connections)
+        self.host_slots = {}
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=max_connections, pool_maxsize=max_per_host)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        ## Setting the User-Agent to something spiffy
+        self.session.headers['User-Agent'] = 'MLSecProject-Combine/0.1.2 (+https://github.com/mlsecproject/combine)'
+
+    def host_slot(self, url):
+        host = urlparse.urlsplit(url).netloc
+        if host not in self.host_slots:
+            self.host_slots[host] = BoundedSemaphore(self.max_per_host)
+        return self.host_slots[host]
+
+    def run(self, feeds):
+        """ fetch (url, direction) pairs, returning manifest entries aligned with feeds
+
+        Feeds that could not be fetched at all come back as None.
+        """
+        # local files load alongside the network fetches, outside of the connection cap
+        jobs = [gevent.spawn(self.load_file if url.startswith('file://') else self.fetch_feed, url, direction)
+                for url, direction in feeds]
+        gevent.joinall(jobs)
+        return [job.value for job in jobs]
+
+    def load_file(self, url, direction):
+        file_name = url.partition('://')[2]
+        try:
+            path = store_file(self.store_dir, file_name)
+        except IOError as e:
+            assert isinstance(logger, logging.Logger)
+            logger.error('Reaper: Error while opening "%s" - %s' % (file_name, e.strerror))
+            metrics.add_feed(url, 'fetch_errors')
+            return None
+        metrics.feed(url, status=200, bytes=os.path.getsize(path))
+        return {'url': url, 'status': 200, 'direction': direction, 'unchanged': False,
+                'path': path, 'encoding': 'utf-8'}
+
+    def fetch_feed(self, url, direction):
+        entry = None
+        for attempt in range(self.retries + 1):
+            if attempt:
+                delay = self.backoff * 2 ** (attempt - 1)
+                logger.info('Retrying %s in %.1f seconds' % (url, delay))
+                gevent.sleep(delay)
+            try:
+                with self.host_slot(url), self.connections:
+                    entry = self.fetch_once(url, direction)
+            except (requests.RequestException, EnvironmentError) as e:
+                exception_handler(url, e)
+                metrics.add_feed(url, 'fetch_errors')
+                entry = None
+                continue
+            if entry['status'] not in self.RETRY_STATUS:
+                break
+            logger.error('Request %r answered %d' % (url, entry['status']))
+        return entry
+
+    def fetch_once(self, url, direction):
+        """ fetch one feed, writing the body to the store as it arrives
+
+        If we still hold the body from a previous run, the request is made
+        conditional on its validators and a 304 reuses the stored copy.
+        """
+        headers = {}
+        cached = self.validators.get(url)
+        if cached and os.path.isfile(cached['path']):
+            if cached.get('etag'):
+                headers['If-None-Match'] = cached['etag']
+            if cached.get('last_modified'):
+                headers['If-Modified-Since'] = cached['last_modified']
+        else:
+            cached = None
+
+        start = time.time()
+        response = self.session.get(url, headers=headers, stream=True, timeout=self.timeout)
+        try:
+            if response.status_code == 304 and cached:
+                logger.info('%s unchanged since last run' % url)
+                metrics.feed(url, status=304, bytes=0, fetch_seconds=time.time() - start)
+                return {'url': url, 'status': 304, 'direction': direction, 'unchanged': True,
+                        'path': cached['path'], 'encoding': cached['encoding']}
+            path = store_body(self.store_dir, response.iter_content(CHUNK_SIZE))
+        finally:
+            response.close()
+        elapsed = time.time() - start
+        logger.info('Fetched %s in %.2f seconds' % (url, elapsed))
+        metrics.feed(url, status=response.status_code, bytes=os.path.getsize(path), fetch_seconds=elapsed)
+        if response.url != url:
+            # later stages know the feed by the URL it was redirected to
+            metrics.alias(response.url, url)
+
+        etag = response.headers.get('ETag')
+        last_modified = response.headers.get('Last-Modified')
+        if response.status_code == 200 and (etag or last_modified):
+            self.validators[url] = {'etag': etag, 'last_modified': last_modified,
+                                    'path': path, 'encoding': response.encoding}
+        else:
+            self.validators.pop(url, None)
+        return {'url': response.url, 'status': response.status_code, 'direction': direction, 'unchanged': False,
+                'path': path, 'encoding': response.encoding}
+
+
+def store_file(store_dir, file_name):
+    with open(file_name, 'rb') as f:
+        return store_body(store_dir, iter(lambda: f.read(CHUNK_SIZE), ''))
+
+
+def config_int(config, option, default):
+    if config.has_option('Reaper', option):
+        return config.getint('Reaper', option)
+    return default
+
+
+def config_float(config, option, default):
+    if config.has_option('Reaper', option):
+        return config.getfloat('Reaper', option)
+    return default
+
+
+def read_feeds(file_name, direction):
+    """ read a URL file: one feed per line, optionally followed by the parser to use"""
+    feeds = []
+    with open(file_name, 'rb') as f:
+        for line in f:
+            fields = line.split()
+            if not fields or fields[0].startswith('#'):
+                continue
+            feeds.append((fields[0], direction, fields[1] if len(fields) > 1 else None))
+    return feeds
+
 
 def reap(file_name):
+    """ fetch the feeds into the store and write their manifest to file_name, returning it (None on failure)"""
     config = ConfigParser.SafeConfigParser(allow_no_value=False)
     cfg_success = config.read('combine.cfg')
     if not cfg_success:
@@ -21,63 +237,65 @@ def reap(file_name):
 
     inbound_url_file = config.get('Reaper', 'inbound_urls')
     outbound_url_file = config.get('Reaper', 'outbound_urls')
+    store_dir = store_directory(config)
 
     try:
-        with open(inbound_url_file, 'rb') as f:
-    	    inbound_urls = [url.rstrip('\n') for url in f.readlines()]
+        inbound_feeds = read_feeds(inbound_url_file, 'inbound')
+        outbound_feeds = read_feeds(outbound_url_file, 'outbound')
     except EnvironmentError as e:
-        logger.error('Reaper: Error while opening "%s" - %s' % (inbound_url_file, e.strerror))
+        logger.error('Reaper: Error while opening "%s" - %s' % (e.filename, e.strerror))
         return
 
-    try:
-        with open(outbound_url_file, 'rb') as f:
-            outbound_urls = [url.rstrip('\n') for url in f.readlines()]
-    except EnvironmentError as e:
-        logger.error('Reaper: Error while opening "%s" - %s' % (outbound_url_file, e.strerror))
-        return
+    if not os.path.isdir(store_dir):
+        os.makedirs(store_dir)
 
-    ## Setting the User-Agent to something spiffy
-    headers = {'User-Agent': 'MLSecProject-Combine/0.1.2 (+https://github.com/mlsecproject/combine)'}
-
-    logger.info('Fetching inbound URLs')
-    inbound_files=[]
-    for url in inbound_urls:
-        if url.startswith('file://'):
-            inbound_files.append(url.partition('://')[2])
-            inbound_urls.remove(url)
-    reqs = [grequests.get(url, headers=headers) for url in inbound_urls]
-    inbound_responses = grequests.map(reqs, exception_handler=exception_handler)
-    inbound_harvest = [(response.url, response.status_code, response.text) for response in inbound_responses if response]
-    for each in inbound_files:
-        try:
-            with open(each,'rb') as f:
-                inbound_harvest.append(('file://'+each, 200, f.read()))
-        except IOError as e:
-            assert isinstance(logger, logging.Logger)
-            logger.error('Reaper: Error while opening "%s" - %s' % (each, e.strerror))
-
-    logger.info('Fetching outbound URLs')
-    outbound_files=[]
-    for url in outbound_urls:
-        if url.startswith('file://'):
-            outbound_files.append(url.partition('://')[2])
-            outbound_urls.remove(url)
-    reqs = [grequests.get(url, headers=headers) for url in outbound_urls]
-    outbound_responses = grequests.map(reqs, exception_handler=exception_handler)
-    outbound_harvest = [(response.url, response.status_code, response.text) for response in outbound_responses if response]
-    for each in outbound_files:
-        try:
-            with open(each,'rb') as f:
-                outbound_harvest.append(('file://'+each, 200, f.read()))
-        except IOError as e:
-            assert isinstance(logger, logging.Logger)
-            logger.error('Reaper: Error while opening "%s" - %s' % (each, e.strerror))
+    validators_file = os.path.join(store_dir, VALIDATORS_FILE)
+    scheduler = FetchScheduler(store_dir, load_validators(validators_file),
+                               max_connections=config_int(config, 'max_connections', 10),
+                               max_per_host=config_int(config, 'max_per_host', 2),
+                               timeout=config_float(config, 'timeout', 60),
+                               retries=config_int(config, 'retries', 3),
+                               backoff=config_float(config, 'backoff', 1.0))
 
-    logger.info('Storing raw feeds in %s' % file_name)
-    harvest = {'inbound': inbound_harvest, 'outbound': outbound_harvest}
+    feeds = inbound_feeds + outbound_feeds
+    logger.info('Fetching %d feeds into %s' % (len(feeds), store_dir))
+    start = time.time()
+    harvest = []
+    for (url, direction, parser), entry in zip(feeds, scheduler.run([feed[:2] for feed in feeds])):
+        if entry:
+            if parser:
+                entry['parser'] = parser
+            harvest.append(entry)
+    logger.info('Fetched %d feeds in %.2f seconds' % (len(harvest), time.time() - start))
 
+    save_validators(scheduler.validators, validators_file)
+    unchanged = len([entry for entry in harvest if entry['unchanged']])
+    logger.info('%d of %d feeds unchanged since last run' % (unchanged, len(harvest)))
+
+    logger.info('Storing feed manifest in %s' % file_name)
     with open(file_name, 'wb') as f:
         json.dump(harvest, f, indent=2)
+    # bodies of earlier runs are only kept while the manifest or a validator still needs them
+    prune_store(store_dir, [entry['path'] for entry in harvest] +
+                [cached['path'] for cached in scheduler.validators.values()])
+    return harvest
+
+
+def store_directory(config):
+    if config.has_option('Reaper', 'harvest_directory'):
+        return config.get('Reaper', 'harvest_directory')
+    return 'harvest'
+
+
+def clean_store():
+    """ remove the raw feed bodies of the store, except those a conditional GET can still reuse"""
+    config = ConfigParser.SafeConfigParser(allow_no_value=False)
+    if not config.read('combine.cfg'):
+        return
+    store_dir = store_directory(config)
+    if os.path.isdir(store_dir):
+        validators = load_validators(os.path.join(store_dir, VALIDATORS_FILE))
+        prune_store(store_dir, [cached['path'] for cached in validators.values()])
 
 
 if __name__ == "__main__":
@@ -0,0 +1,201 @@
+#! /usr/bin/env python
+import argparse
+import BaseHTTPServer
+import email.utils
+import hashlib
+import json
+import os
+import random
+import SocketServer
+import threading
+import time
+import urlparse
+
+from logger import get_logger
+
+logger = get_logger('stubs')
+
+
+class ThreadedHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    # a pool of clients connecting at once would overflow the default backlog of 5
+    request_queue_size = 128
+
+
+class StubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """ keep-alive request handler that can be slowed down or made to refuse requests"""
+    protocol_version = 'HTTP/1.1'
+    # answer in one segment, or kept alive connections stall on delayed ACKs
+    wbufsize = -1
+    disable_nagle_algorithm = True
+    # set by make_server()
+    delay = 0
+    throttle = 0
+
+    def log_message(self, format, *args):
+        pass
+
+    def respond(self, status, body, headers=()):
+        self.send_response(status)
+        for header in headers:
+            self.send_header(*header)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class DnsdbHandler(StubHandler):
+    """ answers DNSDB lookups with made up records, for testing enrichment offline
+
+    Names starting with "evil" resolve to two addresses, every PTR lookup
+    finds a host name and everything else is a 404, like DNSDB answers a
+    lookup without results.
+    """
+
+    def records(self, path):
+        parts = path.split('?')[0].split('/')
+        # /lookup/<rrset|rdata>/<name|ip>/<value>[/rrtype]
+        if len(parts) < 5:
+            return []
+        name = parts[4].rstrip('.')
+        now = int(time.time())
+        if parts[2] == 'rdata':
+            return [{'rrname': 'www.%s.' % name, 'rrtype': 'A', 'rdata': '192.0.2.1', 'count': 5,
+                     'time_first': now - 86400 * 10, 'time_last': now}]
+        if name.endswith('in-addr.arpa'):
+            return [{'rrname': name + '.', 'rrtype': 'PTR', 'rdata': ['host-%s.example.net.' % name.split('.')[0]],
+                     'count': 3, 'time_first': now - 86400 * 10, 'time_last': now}]
+        if name.startswith('evil'):
+            return [{'rrname': name + '.', 'rrtype': 'A', 'rdata': ['8.8.8.8', '8.8.4.4'], 'count': 7,
+                     'time_first': now - 86400 * 30, 'time_last': now}]
+        return []
+
+    def do_GET(self):
+        if self.delay:
+            time.sleep(self.delay)
+        if self.throttle and random.random() < self.throttle:
+            self.respond(429, 'Error: rate limit exceeded', [('Retry-After', '0')])
+            return
+        records = self.records(self.path)
+        if not records:
+            self.respond(404, 'Error: no results found for query.')
+            return
+        self.respond(200, ''.join(json.dumps(record) + '\n' for record in records),
+                     [('Content-Type', 'application/json')])
+
+
+class CRITsHandler(StubHandler):
+    """ accepts CRITs API indicator uploads and counts them, for testing baling offline
+
+    Posts to ips/ and domains/ are answered the way CRITs answers a new
+    indicator, or with 400 when the same one was posted before.
+    """
+    seen = set()
+    lock = threading.Lock()
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.getheader('Content-Length', 0)))
+        if self.delay:
+            time.sleep(self.delay)
+        if self.throttle and random.random() < self.throttle:
+            self.respond(503, 'Service Unavailable')
+            return
+        form = urlparse.parse_qs(body)
+        kind = self.path.rstrip('/').split('/')[-1]
+        field = {'ips': 'ip', 'domains': 'domain'}.get(kind)
+        if not field or field not in form or 'api_key' not in form:
+            self.respond(400, json.dumps({'return_code': 1, 'message': 'bad request'}))
+            return
+        key = (kind, form[field][0])
+        with self.lock:
+            new = key not in self.seen
+            self.seen.add(key)
+        if new:
+            self.respond(201, json.dumps({'return_code': 0, 'type': kind, 'id': len(self.seen)}),
+                         [('Content-Type', 'application/json')])
+        else:
+            self.respond(400, json.dumps({'return_code': 1, 'message': 'already exists'}))
+
+
+class FeedHandler(StubHandler):
+    """ serves the files of a directory as feeds, for fetching them offline
+
+    Every file comes with an ETag (a hash of its content) and its
+    Last-Modified time, and a request that still holds either gets a 304.
+    """
+    # set by serve_feeds()
+    directory = '.'
+
+    def do_GET(self):
+        if self.delay:
+            time.sleep(self.delay)
+        if self.throttle and random.random() < self.throttle:
+            self.respond(503, 'Service Unavailable')
+            return
+        path = os.path.join(self.directory, *[part for part in self.path.split('?')[0].split('/')
+                                              if part and part != '..'])
+        if not os.path.isfile(path):
+            self.respond(404, 'Not Found')
+            return
+        with open(path, 'rb') as f:
+            body = f.read()
+        etag = '"%s"' % hashlib.sha1(body).hexdigest()
+        last_modified = email.utils.formatdate(os.path.getmtime(path), usegmt=True)
+        if self.headers.get('If-None-Match') == etag or self.headers.get('If-Modified-Since') == last_modified:
+            self.respond(304, '', [('ETag', etag)])
+            return
+        self.respond(200, body, [('Content-Type', 'text/plain; charset=utf-8'), ('ETag', etag),
+                                 ('Last-Modified', last_modified)])
+
+
+def make_server(handler, port, delay=0, throttle=0):
+    handler.delay = delay
+    handler.throttle = throttle
+    return ThreadedHTTPServer(('127.0.0.1', port), handler)
+
+
+def serve_dnsdb(port, delay=0, throttle=0):
+    server = make_server(DnsdbHandler, port, delay, throttle)
+    logger.info('Serving a DNSDB stand-in on http://127.0.0.1:%d' % port)
+    server.serve_forever()
+
+
+def serve_crits(port, delay=0, throttle=0):
+    server = make_server(CRITsHandler, port, delay, throttle)
+    logger.info('Serving a CRITs stand-in on http://127.0.0.1:%d/api/v1/' % port)
+    server.serve_forever()
+
+
+def serve_feeds(port, directory, delay=0, throttle=0):
+    FeedHandler.directory = directory
+    server = make_server(FeedHandler, port, delay, throttle)
+    logger.info('Serving the files of %s as feeds on http://127.0.0.1:%d/' % (directory, port))
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='service')
+    dnsdb_parser = subparsers.add_parser('dnsdb', help="Serve made up DNSDB lookups")
+    dnsdb_parser.add_argument('--port', type=int, default=8767)
+    dnsdb_parser.add_argument('--delay', type=float, default=0, help="Seconds to wait before every answer")
+    dnsdb_parser.add_argument('--throttle', type=float, default=0,
+                              help="Fraction of requests to answer with 429 Too Many Requests")
+    crits_parser = subparsers.add_parser('crits', help="Accept CRITs indicator uploads")
+    crits_parser.add_argument('--port', type=int, default=8766)
+    crits_parser.add_argument('--delay', type=float, default=0, help="Seconds to wait before every answer")
+    crits_parser.add_argument('--throttle', type=float, default=0,
+                              help="Fraction of requests to answer with 503 Service Unavailable")
+    feeds_parser = subparsers.add_parser('feeds', help="Serve the files of a directory as feeds")
+    feeds_parser.add_argument('directory')
+    feeds_parser.add_argument('--port', type=int, default=8765)
+    feeds_parser.add_argument('--delay', type=float, default=0, help="Seconds to wait before every answer")
+    feeds_parser.add_argument('--throttle', type=float, default=0,
+                              help="Fraction of requests to answer with 503 Service Unavailable")
+    args = parser.parse_args()
+    if args.service == 'dnsdb':
+        serve_dnsdb(args.port, args.delay, args.throttle)
+    elif args.service == 'crits':
+        serve_crits(args.port, args.delay, args.throttle)
+    else:
+        serve_feeds(args.port, args.directory, args.delay, args.throttle)
@@ -0,0 +1,160 @@
+import gzip
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+# imported up front, the stream test runs from a temporary directory with its own combine.cfg
+import parsers.lists
+import pipeline
+from baler import ENRICHED_HEADER, REGULAR_HEADER, CsvBale, JsonLinesBale, bale_rows, open_bale
+
+
+class RecordingBale(object):
+
+    def __init__(self):
+        self.rows = []
+        self.closed = False
+        self.aborted = False
+
+    def write(self, row):
+        self.rows.append(row)
+
+    def close(self):
+        self.closed = True
+
+    def abort(self):
+        self.aborted = True
+
+
+def row(entity):
+    return (entity, 'IPv4', 'inbound', 'http://example.com/feed.txt', 'note', '2014-06-01')
+
+
+class BaleRowsTest(unittest.TestCase):
+
+    def test_complete_harvest_is_closed(self):
+        bale = RecordingBale()
+        bale_rows([row('8.8.8.8'), row('9.9.9.9')], bale)
+        self.assertEqual(len(bale.rows), 2)
+        self.assertTrue(bale.closed)
+        self.assertFalse(bale.aborted)
+
+    def test_failed_harvest_is_aborted(self):
+        def harvest():
+            yield row('8.8.8.8')
+            raise ValueError('bad crop')
+        bale = RecordingBale()
+        self.assertRaises(ValueError, bale_rows, harvest(), bale)
+        self.assertTrue(bale.aborted)
+        self.assertFalse(bale.closed)
+
+
+class CsvBaleTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_threaded_gzip(self):
+        filename = os.path.join(self.directory, 'harvest.csv.gz')
+        bale_rows([row('8.8.8.8'), row(u'b\xfccher.de'), (None, 'FQDN', 'outbound', 's', 3, '2014-06-01')],
+                  CsvBale(filename, REGULAR_HEADER, compress=True, threaded=True))
+        with gzip.open(filename) as f:
+            lines = f.read().splitlines()
+        self.assertEqual(lines[0], '"entity","type","direction","source","notes","date"')
+        self.assertEqual(lines[2], '"b\xc3\xbccher.de","IPv4","inbound","http://example.com/feed.txt","note","2014-06-01"')
+        self.assertEqual(lines[3], '"","FQDN","outbound","s","3","2014-06-01"')
+
+
+class JsonLinesBaleTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_plain(self):
+        filename = os.path.join(self.directory, 'harvest.jsonl')
+        bale_rows([row('8.8.8.8'), row(u'b\xfccher.de\n"x"'), (None, 'FQDN', 'outbound', 's', 3, '2014-06-01')],
+                  JsonLinesBale(filename, REGULAR_HEADER))
+        with open(filename, 'rb') as f:
+            lines = f.read().splitlines()
+        self.assertEqual(len(lines), 3)
+        first = json.loads(lines[0])
+        self.assertEqual(first, {'entity': '8.8.8.8', 'type': 'IPv4', 'direction': 'inbound',
+                                 'source': 'http://example.com/feed.txt', 'notes': 'note', 'date': '2014-06-01'})
+        self.assertEqual(json.loads(lines[1])['entity'], u'b\xfccher.de\n"x"')
+        third = json.loads(lines[2])
+        self.assertIsNone(third['entity'])
+        self.assertEqual(third['notes'], 3)
+
+    def test_enriched_gzip(self):
+        filename = os.path.join(self.directory, 'harvest.jsonl.gz')
+        enriched = row('8.8.8.8') + ('15169', 'GOOGLE', 'US', '', 'dns.google')
+        bale_rows([enriched, enriched], open_bale(filename, 'json.gz', False))
+        with gzip.open(filename) as f:
+            objects = [json.loads(line) for line in f]
+        self.assertEqual(len(objects), 2)
+        self.assertEqual(sorted(objects[0]), sorted(ENRICHED_HEADER))
+        self.assertEqual([objects[0][name] for name in ENRICHED_HEADER], list(enriched))
+
+    def test_regular_keys(self):
+        filename = os.path.join(self.directory, 'harvest.jsonl')
+        bale_rows([row('8.8.8.8')], open_bale(filename, 'json', True))
+        with open(filename, 'rb') as f:
+            self.assertEqual(sorted(json.loads(f.readline())), sorted(REGULAR_HEADER))
+
+
+
+def broken_parser(response, source, direction):
+    raise ValueError('unexpected feed format')
+
+
+class AbortedStreamTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.directory = tempfile.mkdtemp()
+        os.chdir(self.directory)
+        with open('combine.cfg', 'wb') as f:
+            f.write('[Thresher]\nworkers = 1\n')
+        manifest = []
+        for url, parser in (('http://a.example/ssh.txt', 'simple_list'),
+                            ('http://b.example/odd.txt', 'tests.test_baler:broken_parser')):
+            path = os.path.join(self.directory, url.split('/')[2])
+            with open(path, 'wb') as f:
+                f.write('1.2.3.4\n5.6.7.8\n')
+            manifest.append({'url': url, 'status': 200, 'direction': 'inbound', 'unchanged': False,
+                             'path': path, 'encoding': 'utf-8', 'parser': parser})
+        with open('harvest.json', 'wb') as f:
+            json.dump(manifest, f)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.directory)
+
+    def test_no_partial_harvest(self):
+        for out_file, out_type in (('harvest.csv', 'csv'), ('harvest.csv.gz', 'csv.gz'),
+                                   ('harvest.jsonl', 'json'), ('harvest.jsonl.gz', 'json.gz')):
+            # the first feed's rows are written before the second one fails
+            self.assertRaises(ValueError, pipeline.stream, 'harvest.json', out_file, out_type)
+            self.assertEqual(sorted(os.listdir('.')), ['a.example', 'b.example', 'combine.cfg', 'harvest.json'])
+
+    def test_complete_harvest(self):
+        with open('harvest.json', 'rb') as f:
+            manifest = json.load(f)
+        with open('harvest.json', 'wb') as f:
+            json.dump(manifest[:1], f)
+        pipeline.stream('harvest.json', 'harvest.csv', 'csv')
+        self.assertFalse(os.path.exists('harvest.csv.partial'))
+        with open('harvest.csv', 'rb') as f:
+            self.assertEqual(len(f.read().splitlines()), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,37 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import benchmark
+from geodb import ASNIndex
+
+
+class SyntheticDataTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_synthetic_asn_csv_covers_every_address(self):
+        filename = os.path.join(self.directory, 'GeoIPASNum2.csv')
+        benchmark.synthetic_asn_csv(filename, count=100)
+        index = ASNIndex.from_csv(filename)
+        self.assertEqual(len(index), 100)
+        for address in (0, 1, 0x08080808, 0xffffffff):
+            as_num, as_name = index.lookup(address)
+            self.assertTrue(as_num.isdigit())
+            self.assertTrue(as_name.startswith('Synthetic Networks'))
+
+    def test_feeds_parse(self):
+        from parsers import registry
+        for name, feed in sorted(benchmark.FEEDS.items()):
+            rows = registry.load(name)(feed(20, benchmark.random.Random(0)).decode('utf8'), benchmark.SOURCE,
+                                       'inbound')
+            self.assertTrue(rows, name)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import unittest
+
+import classifier
+from classifier import IndicatorClassifier, SuffixIndex, legacy_indicator_type
+
+
+class IndicatorClassifierTest(unittest.TestCase):
+
+    def test_same_answers_as_the_regex(self):
+        indicators = ['8.8.8.8', '8.8.8.8\n', '300.1.2.3', 'example.com', 'EXAMPLE.COM', 'www.example.co.uk',
+                      'foo.com:8080', 'evil.com/path', 'http://evil.com', '-bad.com', 'bad-.com', 'a.com',
+                      'ab.com', 'a.b.com', 'foo.company', 'foo.bar.notatld', 'host_without_tld', '.com',
+                      '..com', 'foo..com', 'xn--bcher-kva.xn--p1ai', 'x-' * 130 + 'x.com',
+                      'x-' * 130 + 'x.y.com', 'caf\xc3\xa9.com', u'caf\xe9.com', u'foo.İt', '', '.']
+        classify = IndicatorClassifier().classify
+        for indicator in indicators + classifier.synthetic_feed(2000):
+            self.assertEqual(classify(indicator), legacy_indicator_type(indicator),
+                             repr(indicator))
+
+    def test_batch(self):
+        feed = classifier.synthetic_feed(2000) + ['evil.com/path', 'evil.com/path', '-bad.com']
+        self.assertEqual(classifier.indicator_types(feed), [classifier.indicator_type(i) for i in feed])
+        self.assertEqual(classifier.indicator_types([]), [])
+
+    def test_url_like_indicators(self):
+        # the thresher always took anything starting with a hostname, the winnower rejects them later
+        self.assertEqual(classifier.indicator_type('evil.com/path'), 'FQDN')
+        self.assertEqual(classifier.indicator_type('foo.com:8080'), 'FQDN')
+        self.assertEqual(classifier.indicator_type('-bad.com'), None)
+
+    def test_loaded_suffixes(self):
+        directory = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(directory, 'tlds.txt')
+            with open(filename, 'wb') as f:
+                f.write('# Version 2015033000\nCOM\n// a public suffix rule\n*.ck\n\xd1\x80\xd1\x84\n')
+            suffixes = SuffixIndex.load(filename)
+        finally:
+            shutil.rmtree(directory)
+        self.assertEqual(len(suffixes), 4)
+        self.assertEqual(IndicatorClassifier(suffixes).classify('example.xn--p1ai'), 'FQDN')
+        self.assertEqual(IndicatorClassifier(suffixes).classify('example.ck'), 'FQDN')
+        self.assertEqual(IndicatorClassifier(suffixes).classify('example.org'), None)
+
+
+if __name__ == '__main__':
+    unittest.main()
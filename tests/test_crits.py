@@ -0,0 +1,66 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from crits import Checkpoint, CRITsUploader
+
+
+class RecordingUploader(CRITsUploader):
+    """ CRITsUploader that answers every POST itself"""
+
+    def __init__(self, *args, **kwargs):
+        super(RecordingUploader, self).__init__('http://crits/api/v1/', 'user', 'key', 'combine', *args, **kwargs)
+        self.posted = []
+
+    def post(self, url, payload):
+        with self.lock:
+            self.posted.append((url, payload.get('ip') or payload.get('domain')))
+        return 200
+
+
+def row(entity, i_type):
+    return (entity, i_type, 'inbound', 'http://example.com/feed.txt', 'note', '2014-06-01')
+
+
+class CheckpointTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, 'checkpoint')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_unknown_types_are_skipped(self):
+        uploader = RecordingUploader(threads=2, checkpoint=Checkpoint(self.filename))
+        harvest = [row('8.8.8.8', 'IPv4'), row(None, None), row('junk', None), row('example.com', 'FQDN')]
+        self.assertTrue(uploader.upload(harvest))
+        self.assertEqual(sorted(entity for url, entity in uploader.posted), ['8.8.8.8', 'example.com'])
+        self.assertEqual(uploader.uploaded, 2)
+
+    def test_resume_skips_uploaded(self):
+        checkpoint = Checkpoint(self.filename)
+        checkpoint.add(row('8.8.8.8', 'IPv4'))
+        checkpoint.add(row(None, None))
+        checkpoint.close(False)
+        uploader = RecordingUploader(threads=1, checkpoint=Checkpoint(self.filename))
+        uploader.upload([row('8.8.8.8', 'IPv4'), row('9.9.9.9', 'IPv4')])
+        self.assertEqual(uploader.posted, [('http://crits/api/v1/ips/', '9.9.9.9')])
+        self.assertFalse(os.path.exists(self.filename))
+
+    def test_failed_harvest_aborts(self):
+        def harvest():
+            yield row('8.8.8.8', 'IPv4')
+            raise IOError('truncated crop')
+        uploader = RecordingUploader(threads=1, checkpoint=Checkpoint(self.filename))
+        self.assertRaises(IOError, uploader.upload, harvest())
+        # queued indicators may or may not have gone out, but nothing after the failure did
+        self.assertIn(uploader.posted, ([], [('http://crits/api/v1/ips/', '8.8.8.8')]))
+        # the checkpoint stays behind with what was added, so the next run only sends the rest
+        self.assertTrue(os.path.exists(self.filename))
+        self.assertEqual(row('8.8.8.8', 'IPv4') in Checkpoint(self.filename), bool(uploader.posted))
+
+
+if __name__ == '__main__':
+    unittest.main()
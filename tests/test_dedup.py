@@ -0,0 +1,60 @@
+import unittest
+
+from dedup import EMPTY, Deduplicator, SlotIndex
+
+
+def row(entity, source='feed', date='2014-06-01', direction='inbound'):
+    return (entity, 'IPv4', direction, source, 'note', date)
+
+
+class SlotIndexTest(unittest.TestCase):
+
+    def test_colliding_hashes(self):
+        keys = ['a', 'b', 'c']
+        index = SlotIndex(lambda slot, key: keys[slot] == key, capacity=4)
+        for slot, key in enumerate(keys):
+            position, found = index.find(42, key)
+            self.assertEqual(found, EMPTY)
+            index.insert(position, 42, slot)
+        # the table grew past its capacity, and every key still finds its own slot
+        self.assertEqual(len(index.slots), 8)
+        self.assertEqual([index.find(42, key)[1] for key in keys], [0, 1, 2])
+        self.assertEqual(index.find(42, 'd')[1], EMPTY)
+
+
+class DeduplicatorTest(unittest.TestCase):
+
+    def test_merges_sightings(self):
+        deduplicator = Deduplicator()
+        for r in (row('8.8.8.8', 'a', '2014-06-02'), row('9.9.9.9'), row('8.8.8.8', 'b', '2014-06-01'),
+                  row('8.8.8.8', 'a', '2014-06-03'), row('8.8.8.8', direction='outbound')):
+            deduplicator.add(r)
+        self.assertEqual(list(deduplicator.rows()),
+                         [('8.8.8.8', 'IPv4', 'inbound', 'a b', 'note; first seen 2014-06-01', '2014-06-03'),
+                          ('9.9.9.9', 'IPv4', 'inbound', 'feed', 'note', '2014-06-01'),
+                          ('8.8.8.8', 'IPv4', 'outbound', 'feed', 'note', '2014-06-01')])
+
+    def test_first_seen(self):
+        deduplicator = Deduplicator()
+        for r in (row('8.8.8.8', date='2014-06-02'), row('8.8.8.8', date='2014-05-30'),
+                  row('8.8.8.8', date='2014-06-05'), row('9.9.9.9', date='2014-06-01'),
+                  (u'9.9.9.9', 'IPv4', 'inbound', 'feed', '', '2014-05-01')):
+            deduplicator.add(r)
+        self.assertEqual([sighting[5:] for sighting in deduplicator.sightings()],
+                         [('2014-05-30', '2014-06-05'), ('2014-05-01', '2014-06-01')])
+        self.assertEqual([r[4:] for r in deduplicator.rows()],
+                         [('note; first seen 2014-05-30', '2014-06-05'), ('note; first seen 2014-05-01', '2014-06-01')])
+
+    def test_many_indicators(self):
+        deduplicator = Deduplicator()
+        addresses = ['10.0.%d.%d' % (i // 256, i % 256) for i in range(5000)]
+        for source in ('a', 'b'):
+            for addr in addresses:
+                deduplicator.add(row(addr, source))
+        self.assertEqual(len(deduplicator), 5000)
+        self.assertEqual([r[0] for r in deduplicator.rows()], addresses)
+        self.assertEqual(set(r[3] for r in deduplicator.rows()), set(['a b']))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,53 @@
+import csv
+import os
+import shutil
+import tempfile
+import unittest
+
+from delta import Delta, bale_removed
+
+
+def row(entity):
+    return (entity, 'IPv4', 'inbound', 'http://example.com/feed.txt', 'note', '2014-06-01')
+
+
+class DeltaTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.state_file = os.path.join(self.directory, 'delta_state.rows')
+        self.removed_file = os.path.join(self.directory, 'removed.csv')
+        delta = Delta(self.state_file)
+        list(delta.added([row('8.8.8.8'), row('9.9.9.9')]))
+        delta.save()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def removed(self):
+        with open(self.removed_file, 'rb') as f:
+            return [fields[0] for fields in list(csv.reader(f))[1:]]
+
+    def test_removed(self):
+        delta = Delta(self.state_file)
+        self.assertEqual(list(delta.added([row('9.9.9.9'), row('1.1.1.1')])), [row('1.1.1.1')])
+        self.assertTrue(bale_removed(delta, self.removed_file, 'csv'))
+        self.assertEqual(self.removed(), ['8.8.8.8'])
+
+    def test_empty_crop(self):
+        delta = Delta(self.state_file)
+        list(delta.added([]))
+        self.assertFalse(bale_removed(delta, self.removed_file, 'csv'))
+        self.assertEqual(self.removed(), [])
+
+    def test_failed_reap(self):
+        # a stale manifest still gives a crop, but it says nothing about this run
+        delta = Delta(self.state_file)
+        list(delta.added([row('9.9.9.9')]))
+        self.assertFalse(bale_removed(delta, self.removed_file, 'csv', reaped=False))
+        self.assertEqual(self.removed(), [])
+        self.assertEqual(len(Delta(self.state_file).previous), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
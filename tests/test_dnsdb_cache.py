@@ -0,0 +1,163 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+import urllib2
+
+import dnsdb_cache
+from dnsdb_cache import CachingDnsdbClient, DnsdbCache
+
+
+class StubClient(CachingDnsdbClient):
+    """ CachingDnsdbClient that answers from a dict of paths instead of DNSDB"""
+
+    def __init__(self, answers, cache=None):
+        super(StubClient, self).__init__('http://dnsdb', 'key', cache)
+        self.answers = answers
+        self.paths = []
+
+    def _fetch(self, path):
+        self.paths.append(path)
+        answer = self.answers.get(path, ())
+        if isinstance(answer, Exception):
+            raise answer
+        for record in answer:
+            yield record
+
+
+class FakeClock(object):
+    """ stands in for the time module in dnsdb_cache"""
+
+    def __init__(self):
+        self.now = 1400000000.0
+
+    def time(self):
+        return self.now
+
+
+GOOGLE = [{'rrname': 'google.com.', 'rdata': '8.8.8.8'}]
+
+
+class DnsdbCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.clock = FakeClock()
+        dnsdb_cache.time = self.clock
+        self.cache = DnsdbCache(os.path.join(self.directory, 'dnsdb.sqlite'), ttl=100, negative_ttl=10, max_entries=3)
+
+    def tearDown(self):
+        dnsdb_cache.time = time
+        self.cache.db.close()
+        shutil.rmtree(self.directory)
+
+    def test_ttl(self):
+        self.cache.put('rdata/name/google.com', GOOGLE)
+        self.clock.now += 99
+        self.assertEqual(self.cache.get('rdata/name/google.com'), GOOGLE)
+        self.clock.now += 1
+        self.assertIsNone(self.cache.get('rdata/name/google.com'))
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+
+    def test_negative_ttl(self):
+        self.cache.put('rdata/name/nothing.example', [])
+        self.cache.put('rdata/name/google.com', GOOGLE)
+        self.clock.now += 9
+        self.assertEqual(self.cache.get('rdata/name/nothing.example'), [])
+        self.clock.now += 1
+        # an empty answer goes stale long before one with records
+        self.assertIsNone(self.cache.get('rdata/name/nothing.example'))
+        self.assertEqual(self.cache.get('rdata/name/google.com'), GOOGLE)
+        self.assertEqual((self.cache.hits, self.cache.negative_hits, self.cache.misses), (1, 1, 1))
+
+    def test_max_entries(self):
+        for i in range(5):
+            self.cache.put('rdata/name/%d.example' % i, GOOGLE)
+            self.clock.now += 1
+        self.cache.evict()
+        # the oldest lookups go first
+        self.assertEqual([self.cache.get('rdata/name/%d.example' % i) is not None for i in range(5)],
+                         [False, False, True, True, True])
+
+    def test_evicts_while_filling(self):
+        self.cache.EVICT_EVERY = 4
+        for i in range(8):
+            self.cache.put('rdata/name/%d.example' % i, GOOGLE)
+        count = self.cache.db.execute('SELECT COUNT(*) FROM lookups').fetchone()[0]
+        self.assertEqual(count, 3)
+
+    def test_expired_entries_are_evicted(self):
+        self.cache.put('rdata/name/nothing.example', [])
+        self.cache.put('rdata/name/google.com', GOOGLE)
+        self.clock.now += 50
+        self.cache.evict()
+        self.assertEqual(self.cache.db.execute('SELECT path FROM lookups').fetchall(), [('rdata/name/google.com',)])
+
+    def test_failures_are_not_cached(self):
+        def broken():
+            yield GOOGLE[0]
+            raise urllib2.URLError('connection reset')
+        dnsdb = StubClient({'rdata/name/google.com': urllib2.HTTPError('http://dnsdb', 500, 'error', {}, None),
+                            'rdata/name/evil.example': broken()}, self.cache)
+        self.assertEqual(list(dnsdb.iter_rdata_name('google.com')), [])
+        # a lookup that failed half way yields what arrived, but that isn't the whole answer
+        self.assertEqual(list(dnsdb.iter_rdata_name('evil.example')), GOOGLE)
+        dnsdb.answers = {'rdata/name/google.com': GOOGLE, 'rdata/name/evil.example': []}
+        self.assertEqual(list(dnsdb.iter_rdata_name('google.com')), GOOGLE)
+        self.assertEqual(list(dnsdb.iter_rdata_name('evil.example')), [])
+        self.assertEqual(list(dnsdb.iter_rdata_name('google.com')), GOOGLE)
+        self.assertEqual(list(dnsdb.iter_rdata_name('evil.example')), [])
+        self.assertEqual(dnsdb.paths, ['rdata/name/google.com', 'rdata/name/evil.example'] * 2)
+
+    def test_long_answers_are_not_cached(self):
+        self.cache.max_records = 2
+        dnsdb = StubClient({'rdata/name/google.com': GOOGLE * 3}, self.cache)
+        self.assertEqual(list(dnsdb.iter_rdata_name('google.com')), GOOGLE * 3)
+        self.assertEqual(list(dnsdb.iter_rdata_name('google.com')), GOOGLE * 3)
+        self.assertEqual(len(dnsdb.paths), 2)
+
+
+class CachingDnsdbClientTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache = DnsdbCache(os.path.join(self.directory, 'dnsdb.sqlite'))
+
+    def tearDown(self):
+        self.cache.db.close()
+        shutil.rmtree(self.directory)
+
+    def test_probe_skips_the_cache(self):
+        self.cache.put('rdata/name/google.com', GOOGLE)
+        dnsdb = StubClient({}, self.cache)
+        # a cached answer must not make a DNSDB that is down look healthy
+        self.assertFalse(dnsdb.probe('google.com'))
+        dnsdb.answers['rdata/name/google.com'] = urllib2.URLError('connection refused')
+        self.assertFalse(dnsdb.probe('google.com'))
+        dnsdb.answers['rdata/name/google.com'] = GOOGLE
+        self.assertTrue(dnsdb.probe('google.com'))
+        self.assertEqual(dnsdb.paths, ['rdata/name/google.com'] * 3)
+        self.assertEqual(self.cache.misses + self.cache.hits, 0)
+
+    def test_stopping_early_reads_no_further(self):
+        read = []
+
+        def answer():
+            for i in range(self.cache.max_records):
+                read.append(i)
+                yield {'rrname': 'www%d.google.com.' % i, 'rdata': '8.8.8.8'}
+        dnsdb = StubClient({'rdata/name/google.com': answer()}, self.cache)
+        records = dnsdb.iter_rdata_name('google.com')
+        next(records)
+        records.close()
+        self.assertEqual(len(read), 1)
+        # the answer is incomplete, so it is not cached and the next lookup asks again
+        dnsdb.answers['rdata/name/google.com'] = GOOGLE
+        self.assertEqual(list(dnsdb.iter_rdata_name('google.com')), GOOGLE)
+        self.assertEqual(list(dnsdb.iter_rdata_name('google.com')), GOOGLE)
+        self.assertEqual(dnsdb.paths, ['rdata/name/google.com'] * 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,82 @@
+import json
+import threading
+import unittest
+
+import requests
+
+from enricher import EnrichmentEngine, PooledDnsdbClient
+from metrics import metrics
+
+
+class Response(object):
+
+    def __init__(self, status_code, records=()):
+        self.status_code = status_code
+        self.headers = {}
+        self.lines = [json.dumps(record) for record in records]
+
+    def iter_lines(self):
+        return iter(self.lines)
+
+    def raise_for_status(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class Session(object):
+    """ requests Session that answers every lookup from a dict of paths"""
+
+    def __init__(self, answers, failures=0):
+        self.answers = answers
+        self.failures = failures
+        self.lock = threading.Lock()
+        self.paths = []
+
+    def get(self, url, **kwargs):
+        path = url.split('/lookup/', 1)[1]
+        with self.lock:
+            self.paths.append(path)
+            if self.failures:
+                self.failures -= 1
+                raise requests.ConnectionError('connection reset by peer')
+        records = self.answers.get(path)
+        return Response(404) if records is None else Response(200, records)
+
+
+def client(answers, cache=None, failures=0):
+    dnsdb = PooledDnsdbClient('http://dnsdb', 'key', cache, backoff=0)
+    dnsdb.session = Session(answers, failures)
+    return dnsdb
+
+
+class PooledDnsdbClientTest(unittest.TestCase):
+
+    def setUp(self):
+        metrics.drain()
+
+    def test_calls_from_threads(self):
+        dnsdb = client({})
+        engine = EnrichmentEngine(8)
+        try:
+            engine.map(lambda n: list(dnsdb.iter_rrset('host%d.example.com' % n)), range(400))
+        finally:
+            engine.close()
+        self.assertEqual(metrics.drain()['counters']['dnsdb_calls'], 400)
+
+    def test_connection_errors_are_retried(self):
+        record = {'rrname': 'example.com.', 'rdata': ['93.184.216.34']}
+        dnsdb = client({'rrset/name/example.com/A': [record]}, failures=2)
+        self.assertEqual(list(dnsdb.iter_rrset('example.com', rrtype='A')), [record])
+        self.assertEqual(dnsdb.session.paths, ['rrset/name/example.com/A'] * 3)
+        self.assertEqual(metrics.drain()['counters']['dnsdb_calls'], 3)
+
+    def test_retries_give_up(self):
+        dnsdb = client({}, failures=10)
+        self.assertEqual(list(dnsdb.iter_rrset('example.com')), [])
+        self.assertEqual(len(dnsdb.session.paths), dnsdb.retries + 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
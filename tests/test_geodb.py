@@ -0,0 +1,132 @@
+import os
+import shutil
+import socket
+import struct
+import tempfile
+import time
+import unittest
+
+from geodb import ASNIndex, OrgTable, compile_asn, open_asn_index
+
+
+def ip(address):
+    return struct.unpack('!I', socket.inet_aton(address))[0]
+
+
+# as strings, 100.x sorts before 10.x before 9.x; the index has to order them by number
+RANGES = [('100.0.0.0', '100.0.255.255', 'AS100 Hundred Net'),
+          ('10.0.0.0', '10.0.0.255', 'AS10 Ten Net'),
+          ('9.0.0.0', '9.0.255.255', 'AS9 Nine Net'),
+          ('10.0.1.0', '10.0.1.255', 'AS10 Ten Net'),
+          ('255.255.255.0', '255.255.255.255', 'AS65535 Last Net')]
+# org names have to come back whole from the compiled blob, whatever their length or bytes
+ORGS = [('1.0.0.0', '1.0.0.255', 'AS13335 Cloudflare, Inc.'),
+        ('1.0.1.0', '1.0.1.255', 'AS4134 Chinanet'),
+        ('1.0.2.0', '1.0.2.255', 'AS3215 Orange S.A. \xc3\x89lectricit\xc3\xa9'),
+        ('1.0.3.0', '1.0.3.255', 'AS1'),
+        ('1.0.4.0', '1.0.4.255', 'AS4134 Chinanet')]
+
+
+def write_csv(filename, ranges):
+    with open(filename, 'wb') as f:
+        for start, end, org in ranges:
+            f.write('%d,%d,"%s"\n' % (ip(start), ip(end), org))
+
+
+class ASNIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.csv_file = os.path.join(self.directory, 'GeoIPASNum2.csv')
+        write_csv(self.csv_file, RANGES)
+        self.index = ASNIndex.from_csv(self.csv_file)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_numeric_order(self):
+        self.assertEqual(self.index.lookup(ip('9.0.1.2')), ('9', 'Nine Net'))
+        self.assertEqual(self.index.lookup(ip('10.0.0.7')), ('10', 'Ten Net'))
+        self.assertEqual(self.index.lookup(ip('100.0.3.4')), ('100', 'Hundred Net'))
+        self.assertEqual(len(self.index), 5)
+        self.assertEqual(len(self.index.orgs), 4)
+
+    def test_gaps(self):
+        for address in ('0.0.0.0', '8.255.255.255', '9.1.0.0', '10.0.2.0', '11.0.0.0', '99.255.255.255',
+                        '100.1.0.0', '255.255.254.255'):
+            self.assertEqual(self.index.lookup(ip(address)), (None, None), address)
+
+    def test_edges(self):
+        for start, end, org in RANGES:
+            expected = ASNIndex.split_org(org)
+            self.assertEqual(self.index.lookup(ip(start)), expected, start)
+            self.assertEqual(self.index.lookup(ip(end)), expected, end)
+        self.assertEqual(self.index.lookup(ip('255.255.255.255')), ('65535', 'Last Net'))
+
+    def test_lookup_many(self):
+        addresses = [ip(start) + offset for start, end, org in RANGES for offset in (-1, 0, 1, 256, 65535, 65536)
+                     if 0 <= ip(start) + offset <= 0xffffffff]
+        addresses += [0, 0xffffffff]
+        self.assertEqual(self.index.lookup_many(addresses), [self.index.lookup(address) for address in addresses])
+        self.assertEqual(self.index.lookup_many([]), [])
+
+
+class CompiledASNIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.csv_file = os.path.join(self.directory, 'GeoIPASNum2.csv')
+        self.compiled_file = os.path.join(self.directory, 'GeoIPASNum2.bin')
+        write_csv(self.csv_file, RANGES + ORGS)
+        self.addresses = range(ip('0.255.255.0'), ip('1.0.5.10'), 7) + [ip(start) + offset for start, end, org in RANGES
+                                                                        for offset in (-1, 0, 1, 65535, 65536)]
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_compiled_matches_csv(self):
+        parsed = ASNIndex.from_csv(self.csv_file)
+        compile_asn(self.csv_file, self.compiled_file)
+        self.assertFalse(os.path.exists(self.compiled_file + '.partial'))
+        compiled = open_asn_index(self.csv_file)
+        # the mapped database, not the csv again
+        self.assertIsInstance(compiled.orgs, OrgTable)
+        self.assertEqual(len(compiled), len(parsed))
+        self.assertEqual(compiled.lookup_many(self.addresses), parsed.lookup_many(self.addresses))
+        self.assertEqual([compiled.lookup(address) for address in self.addresses],
+                         [parsed.lookup(address) for address in self.addresses])
+
+    def test_org_names(self):
+        compile_asn(self.csv_file, self.compiled_file)
+        parsed = ASNIndex.from_csv(self.csv_file)
+        compiled = ASNIndex.load(self.compiled_file)
+        self.assertEqual(len(compiled.orgs), len(parsed.orgs))
+        self.assertEqual([compiled.orgs[org_id] for org_id in range(len(compiled.orgs))], parsed.orgs)
+        self.assertEqual(compiled.lookup(ip('1.0.0.9')), ('13335', u'Cloudflare, Inc.'))
+        self.assertEqual(compiled.lookup(ip('1.0.3.0')), ('1', u''))
+        self.assertEqual(compiled.lookup(ip('1.0.2.255')), parsed.lookup(ip('1.0.2.255')))
+        self.assertIsInstance(compiled.lookup(ip('1.0.2.255'))[1], unicode)
+
+    def test_stale_compiled_database(self):
+        write_csv(self.csv_file, RANGES)
+        compile_asn(self.csv_file, self.compiled_file)
+        # a newer csv wins over the database compiled from the old one
+        write_csv(self.csv_file, ORGS)
+        now = time.time()
+        os.utime(self.compiled_file, (now - 60, now - 60))
+        index = open_asn_index(self.csv_file, self.compiled_file)
+        self.assertIsInstance(index.orgs, list)
+        self.assertEqual(index.lookup(ip('1.0.1.1')), ('4134', u'Chinanet'))
+        self.assertEqual(index.lookup(ip('9.0.0.1')), (None, None))
+        # without the csv the compiled database is all there is
+        os.remove(self.csv_file)
+        self.assertEqual(open_asn_index(self.csv_file, self.compiled_file).lookup(ip('9.0.0.1')), ('9', u'Nine Net'))
+
+    def test_not_a_database(self):
+        with open(self.compiled_file, 'wb') as f:
+            f.write('not compiled at all')
+        self.assertRaises(ValueError, ASNIndex.load, self.compiled_file)
+
+
+if __name__ == '__main__':
+    unittest.main()
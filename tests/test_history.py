@@ -0,0 +1,134 @@
+import datetime as dt
+import os
+import shutil
+import tempfile
+import unittest
+
+from history import COMPACTED, INDEX_FILE, History, HistoryWriter, partition_name, record
+from intermediate import dump_rows
+
+SSH = u'http://www.blocklist.de/lists/ssh.txt'
+MALWARE = u'http://www.nothink.org/blacklist/blacklist_malware'
+
+
+def row(entity, date, source=SSH, direction=u'inbound'):
+    return (entity, u'IPv4', direction, source, u'', date)
+
+
+class HistoryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.store = os.path.join(self.directory, 'history')
+        self.crop_file = os.path.join(self.directory, 'crop.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def add(self, rows, day=None):
+        dump_rows(rows, self.crop_file)
+        record(self.crop_file, HistoryWriter(self.store, day))
+
+    def scan(self, *args, **kwargs):
+        history = History(self.store)
+        try:
+            return [(day, tuple(r)) for day, r in history.scan(*args, **kwargs)]
+        finally:
+            history.close()
+
+    def lookup(self, entity):
+        history = History(self.store)
+        try:
+            return history.lookup(entity)
+        finally:
+            history.close()
+
+    def test_first_and_last_seen(self):
+        self.add([row(u'1.2.3.4', u'2014-06-03'), row(u'1.2.3.4', u'2014-06-01', MALWARE)])
+        self.add([row(u'1.2.3.4', u'2014-06-01'), row(u'1.2.3.4', u'2014-06-02')])
+        self.add([row(u'1.2.3.4', u'2014-06-05', MALWARE)])
+        self.assertEqual(self.lookup(u'1.2.3.4'),
+                         [(u'IPv4', u'inbound', SSH, u'2014-06-01', u'2014-06-03'),
+                          (u'IPv4', u'inbound', MALWARE, u'2014-06-01', u'2014-06-05')])
+        self.assertEqual(self.lookup(u'5.6.7.8'), [])
+
+    def test_rows_are_filed_under_their_date(self):
+        # an old crop added today still lands on the days it was harvested
+        self.add([row(u'1.2.3.4', u'2014-06-01'), row(u'5.6.7.8', u'2014-06-02 13:37:00'),
+                  row(u'9.9.9.9', u'Tue, 03 Jun 2014')])
+        today = dt.date.today().isoformat()
+        self.assertEqual(sorted(os.listdir(self.store)), sorted(['2014-06-01', '2014-06-02', today, INDEX_FILE]))
+        self.assertEqual([(day, r[0]) for day, r in self.scan()],
+                         [(u'2014-06-01', u'1.2.3.4'), (u'2014-06-02', u'5.6.7.8'), (today, u'9.9.9.9')])
+
+    def test_day_overrides_the_row_dates(self):
+        self.add([row(u'1.2.3.4', u'2014-06-01'), row(u'5.6.7.8', u'2014-06-02')], day='2014-07-01')
+        self.assertEqual([(day, r[0]) for day, r in self.scan()],
+                         [(u'2014-07-01', u'1.2.3.4'), (u'2014-07-01', u'5.6.7.8')])
+        self.assertEqual(self.lookup(u'1.2.3.4'), [(u'IPv4', u'inbound', SSH, u'2014-07-01', u'2014-07-01')])
+
+    def test_deduplicated_rows_are_split_per_feed(self):
+        self.add([(u'1.2.3.4', u'IPv4', u'inbound', SSH + u' ' + MALWARE, u'note', u'2014-06-01')])
+        self.assertEqual(self.scan(source=MALWARE),
+                         [(u'2014-06-01', (u'1.2.3.4', u'IPv4', u'inbound', MALWARE, u'note', u'2014-06-01'))])
+        self.assertEqual(len(self.lookup(u'1.2.3.4')), 2)
+
+    def test_scan_only_opens_the_partitions_asked_for(self):
+        self.add([row(u'1.2.3.4', u'2014-06-01'), row(u'5.6.7.8', u'2014-06-02'), row(u'9.9.9.9', u'2014-06-03'),
+                  row(u'8.8.8.8', u'2014-06-02', MALWARE)])
+        # scans outside these days or feeds would fail on the missing files
+        os.remove(os.path.join(self.store, '2014-06-01', partition_name(SSH)))
+        os.remove(os.path.join(self.store, '2014-06-03', partition_name(SSH)))
+        self.assertEqual([r[0] for day, r in self.scan(since='2014-06-02', until='2014-06-02')],
+                         [u'5.6.7.8', u'8.8.8.8'])
+        os.remove(os.path.join(self.store, '2014-06-02', partition_name(SSH)))
+        self.assertEqual([r[0] for day, r in self.scan(source=MALWARE)], [u'8.8.8.8'])
+        self.assertEqual([r[0] for day, r in self.scan(since='2014-06-02', entity=u'8.8.8.8', source=MALWARE)],
+                         [u'8.8.8.8'])
+        self.assertRaises(IOError, self.scan, since='2014-06-02')
+
+    def test_compact(self):
+        first = [row(u'1.2.3.4', u'2014-06-01'), row(u'5.6.7.8', u'2014-06-01', MALWARE)]
+        self.add(first)
+        # a second run on the same day repeats a row and adds one
+        self.add([row(u'1.2.3.4', u'2014-06-01'), row(u'9.9.9.9', u'2014-06-01'), row(u'1.1.1.1', u'2014-06-05')])
+        self.assertEqual(len(os.listdir(os.path.join(self.store, '2014-06-01'))), 3)
+        before = self.scan()
+
+        history = History(self.store)
+        try:
+            self.assertEqual(history.compact('2014-06-05'), 1)
+        finally:
+            history.close()
+        self.assertEqual(os.listdir(os.path.join(self.store, '2014-06-01')), [COMPACTED])
+        self.assertEqual(os.listdir(os.path.join(self.store, '2014-06-05')), [partition_name(SSH)])
+        after = self.scan()
+        self.assertEqual(sorted(after), sorted(set(before)))
+        self.assertEqual(len(after), 4)
+        self.assertEqual([r[0] for day, r in self.scan(source=MALWARE)], [u'5.6.7.8'])
+
+        # compacting again leaves the compacted day alone, and later runs on it are merged in
+        self.add([row(u'1.2.3.4', u'2014-06-01'), row(u'4.4.4.4', u'2014-06-01')])
+        history = History(self.store)
+        try:
+            history.compact('2014-06-05')
+        finally:
+            history.close()
+        self.assertEqual(os.listdir(os.path.join(self.store, '2014-06-01')), [COMPACTED])
+        self.assertEqual(sorted(r[0] for day, r in self.scan(until='2014-06-01')),
+                         [u'1.2.3.4', u'4.4.4.4', u'5.6.7.8', u'9.9.9.9'])
+
+    def test_failed_run_is_not_recorded(self):
+        self.add([row(u'5.6.7.8', u'2014-06-01')])
+        writer = HistoryWriter(self.store)
+        writer.write(row(u'1.2.3.4', u'2014-06-01'))
+        writer.write(row(u'1.2.3.4', u'2014-06-02'))
+        writer.abort()
+        self.assertEqual(os.listdir(os.path.join(self.store, '2014-06-01')), [partition_name(SSH)])
+        self.assertEqual(os.listdir(os.path.join(self.store, '2014-06-02')), [])
+        self.assertEqual(self.lookup(u'1.2.3.4'), [])
+        self.assertEqual([r[0] for day, r in self.scan()], [u'5.6.7.8'])
+
+
+if __name__ == '__main__':
+    unittest.main()
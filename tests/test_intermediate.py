@@ -0,0 +1,110 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import intermediate
+from intermediate import BLOCK_ROWS, FORMATS, MAGIC, dump_rows, iter_rows
+
+
+def row(entity, notes='note'):
+    return [entity, 'IPv4', 'inbound', 'http://example.com/feed.txt', notes, '2014-06-01']
+
+
+class RoundTripTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def round_trip(self, rows, fmt):
+        filename = os.path.join(self.directory, intermediate.intermediate_file('crop', fmt))
+        self.assertEqual(dump_rows(rows, filename, fmt), len(rows))
+        self.assertFalse(os.path.exists(filename + '.partial'))
+        return [list(read) for read in iter_rows(filename)]
+
+    def assertRoundTrip(self, rows):
+        for fmt in FORMATS:
+            self.assertEqual(self.round_trip(rows, fmt), rows, fmt)
+
+    def test_rows(self):
+        self.assertRoundTrip([row('8.8.8.8'), row('9.9.9.9', 'other'), row('8.8.8.8')])
+
+    def test_none_and_other_values(self):
+        self.assertRoundTrip([row(None), [u'a.com', 'FQDN', None, 3, 2.5, True],
+                              [u'b.com', 'FQDN', ['x', 1], {'k': None}, None, False],
+                              row('8.8.8.8', None)])
+
+    def test_nul_characters(self):
+        self.assertRoundTrip([row(u'a\0b'), row(u'\0', u'\0\0'), row(u'', u'note\0')])
+
+    def test_unicode(self):
+        self.assertRoundTrip([row(u'b\xfccher.de'), row(u'\u4f8b\u3048.jp', u'\U0001f600'), row(u'')])
+
+    def test_empty(self):
+        self.assertRoundTrip([])
+
+    def test_enriched_width(self):
+        # rows of another width start a new block
+        self.assertRoundTrip([row('8.8.8.8'), row('8.8.8.8') + [u'15169', u'GOOGLE', u'US', u'', u'dns.google'],
+                              row('9.9.9.9')])
+
+    def test_block_boundary(self):
+        rows = [row(u'10.0.%d.%d' % (i // 256, i % 256), u'note %d' % (i % 7)) for i in range(2 * BLOCK_ROWS + 3)]
+        for count in (BLOCK_ROWS - 1, BLOCK_ROWS, BLOCK_ROWS + 1, len(rows)):
+            self.assertRoundTrip(rows[:count])
+
+    def test_dictionary_overflow(self):
+        max_dictionary = intermediate.MAX_DICTIONARY
+        intermediate.MAX_DICTIONARY = 100
+        try:
+            # every note is new, past the first block they are stored plainly; the types keep repeating
+            rows = [row(u'8.8.8.8', u'note %d' % i) for i in range(3 * BLOCK_ROWS)]
+            rows[-1] = row(u'8.8.8.8', u'note 0')
+            self.assertRoundTrip(rows)
+        finally:
+            intermediate.MAX_DICTIONARY = max_dictionary
+
+    def test_sniffs_format(self):
+        rows = [row('8.8.8.8')]
+        json_file = os.path.join(self.directory, 'crop.json')
+        binary_file = os.path.join(self.directory, 'crop.rows')
+        # the extension doesn't matter, the first bytes do
+        dump_rows(rows, json_file, 'binary')
+        dump_rows(rows, binary_file, 'json')
+        with open(json_file, 'rb') as f:
+            self.assertEqual(f.read(len(MAGIC)), MAGIC)
+        self.assertEqual([list(read) for read in iter_rows(json_file)], rows)
+        self.assertEqual([list(read) for read in iter_rows(binary_file)], rows)
+
+    def test_indented_json(self):
+        filename = os.path.join(self.directory, 'crop.json')
+        with open(filename, 'wb') as f:
+            f.write('[\n    [\n        "8.8.8.8", \n        null\n    ]\n]')
+        self.assertEqual(list(iter_rows(filename)), [[u'8.8.8.8', None]])
+
+    def test_truncated(self):
+        filename = os.path.join(self.directory, 'crop.json')
+        with open(filename, 'wb') as f:
+            f.write('')
+        self.assertRaises(ValueError, list, iter_rows(filename))
+        dump_rows([row('8.8.8.8')], filename, 'binary')
+        with open(filename, 'rb') as f:
+            data = f.read()
+        with open(filename, 'wb') as f:
+            f.write(data[:-3])
+        self.assertRaises(ValueError, list, iter_rows(filename))
+
+    def test_abort(self):
+        filename = os.path.join(self.directory, 'crop.rows')
+        with self.assertRaises(KeyError):
+            with intermediate.open_rows(filename, 'binary') as writer:
+                writer.write(row('8.8.8.8'))
+                raise KeyError('stop')
+        self.assertEqual(os.listdir(self.directory), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,46 @@
+import unittest
+
+from metrics import RunMetrics
+
+
+class RunMetricsTest(unittest.TestCase):
+
+    def test_redirected_feed(self):
+        metrics = RunMetrics()
+        metrics.add_feed('http://example.com/feed', 'fetch_errors')
+        metrics.feed('http://example.com/feed', status=200, bytes=10)
+        metrics.alias('https://example.com/feed.txt', 'http://example.com/feed')
+        metrics.feed('https://example.com/feed.txt', rows=3)
+        metrics.add_feed('https://example.com/feed.txt', 'rejected')
+        self.assertEqual(metrics.report()['feeds'], {'http://example.com/feed': {
+            'fetch_errors': 1, 'status': 200, 'bytes': 10, 'rows': 3, 'rejected': 1}})
+
+    def test_merge_from_worker(self):
+        metrics = RunMetrics()
+        metrics.alias('https://example.com/feed.txt', 'http://example.com/feed')
+        worker = RunMetrics()
+        worker.add_feed('https://example.com/feed.txt', 'rejected', 2)
+        worker.count('dnsdb_cache_hits', 3)
+        worker.count('dnsdb_cache_misses')
+        metrics.merge(worker.drain())
+        report = metrics.report()
+        self.assertEqual(report['feeds'], {'http://example.com/feed': {'rejected': 2}})
+        self.assertEqual(report['dnsdb_cache_hit_rate'], 0.75)
+        self.assertEqual(worker.drain(), {'feeds': {}, 'counters': {}})
+
+    def test_prometheus_labels(self):
+        metrics = RunMetrics()
+        metrics.feed('http://example.com/a"b\\c', rows=1)
+        self.assertIn('combine_feed_rows{feed="http://example.com/a\\"b\\\\c"} 1.0', metrics.prometheus())
+
+    def test_stage_reports_process_peak(self):
+        metrics = RunMetrics()
+        with metrics.stage('dedup'):
+            pass
+        [stage] = metrics.report()['stages']
+        self.assertEqual(sorted(stage), ['cpu_seconds', 'process_peak_rss_bytes', 'stage', 'wall_seconds'])
+        self.assertIn('combine_stage_process_peak_rss_bytes{stage="dedup"}', metrics.prometheus())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,56 @@
+import unittest
+
+from parsers import ParserRegistry, registry
+
+
+def reversed_lines(response, source, direction):
+    return [(line[::-1], None, direction, source, '', '2014-06-01') for line in response.splitlines()]
+
+
+class ParserRegistryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = ParserRegistry(feeds={'example.com': 'simple_list',
+                                              'http://feeds.example.com/special.txt': 'sans',
+                                              'http://feeds.example.com/lists/': 'drg',
+                                              'http://feeds.example.com/lists/ssh': 'alienvault'})
+
+    def test_resolution_order(self):
+        resolve = self.registry.resolve
+        self.assertEqual(resolve('http://feeds.example.com/special.txt', 'rulez'), 'rulez')
+        self.assertEqual(resolve('http://feeds.example.com/special.txt'), 'sans')
+        self.assertEqual(resolve('http://feeds.example.com/lists/ssh_day.txt'), 'alienvault')
+        self.assertEqual(resolve('http://feeds.example.com/lists/mail.txt'), 'drg')
+        self.assertEqual(resolve('https://www.example.com/other.txt'), 'simple_list')
+        self.assertEqual(resolve('http://example.com/other.txt'), 'simple_list')
+        self.assertEqual(resolve('http://notexample.com/other.txt'), None)
+        self.assertEqual(resolve('file:///tmp/local.txt'), 'simple_list')
+
+    def test_plugin_parser(self):
+        self.registry.register('http://plugin.example.org/feed', 'tests.test_parsers:reversed_lines')
+        name = self.registry.resolve('http://plugin.example.org/feed')
+        self.assertEqual(self.registry.load(name)('4.3.2.1', 'feed', 'inbound')[0][0], '1.2.3.4')
+        self.assertIs(self.registry.load(name), self.registry.load(name))
+
+    def test_one_parser_per_feed(self):
+        entries = [{'url': 'http://feeds.example.com/lists/ssh_day.txt'},
+                   {'url': 'http://feeds.example.com/special.txt', 'parser': 'virbl'},
+                   {'url': 'http://unknown.example.org/feed.txt'}]
+        self.assertEqual(self.registry.dispatch_table(entries),
+                         {'http://feeds.example.com/lists/ssh_day.txt': 'alienvault',
+                          'http://feeds.example.com/special.txt': 'virbl'})
+
+    def test_nothink_lists(self):
+        # as before the registry, only the ssh and malware lists of nothink.org have a parser
+        self.assertEqual(registry.resolve('http://www.nothink.org/blacklist/blacklist_ssh_day.txt'), 'simple_list')
+        self.assertEqual(registry.resolve('http://www.nothink.org/blacklist/blacklist_malware_irc.txt'),
+                         'simple_list')
+        self.assertEqual(registry.resolve('http://www.nothink.org/honeypots/honeypot_telnet.txt'), None)
+
+    def test_builtin_parsers_load(self):
+        for name in registry.parsers:
+            self.assertTrue(callable(registry.load(name)), name)
+
+
+if __name__ == '__main__':
+    unittest.main()
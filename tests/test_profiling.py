@@ -0,0 +1,60 @@
+import os
+import pstats
+import shutil
+import tempfile
+import unittest
+
+import profiling
+
+
+def parse():
+    return sum(range(1000))
+
+
+def enrich():
+    return sorted(range(1000), reverse=True)
+
+
+class ProfilerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_profile_names(self):
+        self.assertEqual(profiling.profile_name('bale'), 'bale')
+        self.assertEqual(profiling.profile_name('bale', 'enriched'), 'bale-enriched')
+        inbound = profiling.profile_name('thresh', 'inbound http://example.com/feed')
+        outbound = profiling.profile_name('thresh', 'outbound http://example.com/feed')
+        self.assertTrue(inbound.startswith('thresh-inbound_http_example.com_feed-'))
+        self.assertNotEqual(inbound, outbound)
+
+    def functions(self, name):
+        stats = pstats.Stats(os.path.join(self.directory, name + '.prof'))
+        return set(function for filename, line, function in stats.stats)
+
+    def test_nested_profiles(self):
+        profiler = profiling.Profiler(['thresh'], self.directory)
+        outer = profiler.start('thresh')
+        enrich()
+        inner = profiler.start('thresh', 'feed')
+        parse()
+        profiler.stop(inner)
+        enrich()
+        profiler.stop(outer)
+        self.assertIn('parse', self.functions('thresh-feed'))
+        self.assertNotIn('enrich', self.functions('thresh-feed'))
+        self.assertIn('enrich', self.functions('thresh'))
+        self.assertNotIn('parse', self.functions('thresh'))
+
+    def test_unselected_stage(self):
+        profiler = profiling.Profiler(['thresh'], self.directory)
+        self.assertEqual(profiler.start('winnow'), None)
+        profiler.stop(None)
+        self.assertEqual(os.listdir(self.directory), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
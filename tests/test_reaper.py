@@ -0,0 +1,136 @@
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+import gevent
+
+import reaper
+import stubs
+
+
+class SlowHostScheduler(reaper.FetchScheduler):
+    """ FetchScheduler whose slow.example host keeps failing with a 503"""
+
+    def __init__(self):
+        super(SlowHostScheduler, self).__init__(None, {}, max_connections=2, max_per_host=1, retries=2, backoff=0.2)
+        self.finished = []
+
+    def fetch_once(self, url, direction):
+        gevent.sleep(0.01)
+        self.finished.append(url)
+        status = 503 if 'slow.example' in url else 200
+        return {'url': url, 'status': status, 'direction': direction, 'unchanged': False, 'path': None,
+                'encoding': 'utf-8'}
+
+
+class FetchSchedulerTest(unittest.TestCase):
+
+    def test_backoff_frees_connection_slots(self):
+        scheduler = SlowHostScheduler()
+        feeds = [('http://slow.example/%d' % i, 'inbound') for i in range(4)]
+        feeds += [('http://fast.example/%d' % i, 'inbound') for i in range(4)]
+        entries = scheduler.run(feeds)
+        self.assertEqual([entry['status'] for entry in entries], [503] * 4 + [200] * 4)
+        # while the slow host backs off, the fast host's feeds get through first
+        fast = [index for index, url in enumerate(scheduler.finished) if 'fast.example' in url]
+        self.assertTrue(max(fast) < 8, scheduler.finished)
+
+
+class RecordingFeedHandler(stubs.FeedHandler):
+    """ FeedHandler that remembers the validators every request came with"""
+    validators = []
+
+    def do_GET(self):
+        self.validators.append((self.headers.get('If-None-Match'), self.headers.get('If-Modified-Since')))
+        stubs.FeedHandler.do_GET(self)
+
+
+class ConditionalFetchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.store_dir = os.path.join(self.directory, 'harvest')
+        self.feeds_dir = os.path.join(self.directory, 'www')
+        os.mkdir(self.store_dir)
+        os.mkdir(self.feeds_dir)
+        self.write_feed('1.2.3.4\n')
+        RecordingFeedHandler.directory = self.feeds_dir
+        RecordingFeedHandler.validators = []
+        self.server = stubs.make_server(RecordingFeedHandler, 0)
+        self.url = 'http://127.0.0.1:%d/feed.txt' % self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+        shutil.rmtree(self.directory)
+
+    def write_feed(self, body):
+        with open(os.path.join(self.feeds_dir, 'feed.txt'), 'wb') as f:
+            f.write(body)
+
+    def fetch(self, validators):
+        [entry] = reaper.FetchScheduler(self.store_dir, validators, retries=0).run([(self.url, 'inbound')])
+        return entry
+
+    def test_unchanged_feed_reuses_the_stored_body(self):
+        validators = {}
+        first = self.fetch(validators)
+        self.assertEqual((first['status'], first['unchanged']), (200, False))
+        self.assertTrue(validators[self.url]['etag'] and validators[self.url]['last_modified'])
+
+        second = self.fetch(validators)
+        self.assertEqual((second['status'], second['unchanged']), (304, True))
+        self.assertEqual(second['path'], first['path'])
+        self.assertEqual(RecordingFeedHandler.validators[0], (None, None))
+        self.assertEqual(RecordingFeedHandler.validators[1],
+                         (validators[self.url]['etag'], validators[self.url]['last_modified']))
+
+    def test_changed_feed_is_fetched_again(self):
+        validators = {}
+        first = self.fetch(validators)
+        self.write_feed('5.6.7.8\n')
+        os.utime(os.path.join(self.feeds_dir, 'feed.txt'), (0, 0))
+        second = self.fetch(validators)
+        self.assertEqual((second['status'], second['unchanged']), (200, False))
+        self.assertNotEqual(second['path'], first['path'])
+        with open(second['path'], 'rb') as f:
+            self.assertEqual(f.read(), '5.6.7.8\n')
+
+    def test_lost_body_is_fetched_unconditionally(self):
+        validators = {}
+        os.remove(self.fetch(validators)['path'])
+        self.assertEqual(self.fetch(validators)['status'], 200)
+        self.assertEqual(RecordingFeedHandler.validators[1], (None, None))
+
+
+class PruneStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def store(self, body):
+        return reaper.store_body(self.directory, [body])
+
+    def test_unreferenced_bodies_are_removed(self):
+        current = self.store('1.2.3.4\n')
+        validated = self.store('5.6.7.8\n')
+        old = self.store('9.9.9.9\n')
+        open(os.path.join(self.directory, '.partial-left-behind'), 'wb').close()
+        reaper.save_validators({'http://example.com/feed': {'path': validated}},
+                               os.path.join(self.directory, reaper.VALIDATORS_FILE))
+        reaper.prune_store(self.directory, [current, validated])
+        self.assertEqual(sorted(os.listdir(self.directory)),
+                         sorted([os.path.basename(current), os.path.basename(validated), reaper.VALIDATORS_FILE]))
+        self.assertFalse(os.path.exists(old))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,66 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+# imported up front, the test runs from a temporary directory with its own combine.cfg
+import parsers.lists
+import thresher
+from intermediate import iter_rows
+
+
+FEEDS = [('http://a.example/ssh.txt', 'inbound', 'simple_list',
+          '# blocklist\n1.2.3.4\n5.6.7.8 # brute force\nevil.example.com\n'),
+         ('http://b.example/sans.txt', 'inbound', 'sans',
+          '# sans\n001.002.003.004\t5\t2014-06-01\n010.000.000.009\t1\t2014-06-02\n'),
+         ('http://c.example/reputation.data', 'outbound', 'alienvault',
+          '8.8.8.8#4#2#Malware IP#US#\n9.9.9.9#4#2#Scanning Host#US#\n'),
+         ('http://a.example/ssh.txt', 'outbound', 'simple_list',
+          '# blocklist\n1.2.3.4\n5.6.7.8 # brute force\nevil.example.com\n')]
+
+
+class ThreshTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.directory = tempfile.mkdtemp()
+        os.chdir(self.directory)
+        with open('combine.cfg', 'wb') as f:
+            f.write('[Thresher]\nworkers = 1\n')
+        manifest = []
+        for n, (url, direction, parser, body) in enumerate(FEEDS):
+            path = os.path.join(self.directory, 'feed%d' % n)
+            with open(path, 'wb') as f:
+                f.write(body)
+            manifest.append({'url': url, 'status': 200, 'direction': direction, 'unchanged': False,
+                             'path': path, 'encoding': 'utf-8', 'parser': parser})
+        # a feed the reaper could not fetch is left out either way
+        manifest.insert(1, {'url': 'http://d.example/gone.txt', 'status': 404, 'direction': 'inbound',
+                            'unchanged': False, 'path': None, 'encoding': None})
+        with open('harvest.json', 'wb') as f:
+            json.dump(manifest, f)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.directory)
+
+    def thresh(self, workers):
+        crop_file = 'crop-%d.json' % workers
+        thresher.thresh('harvest.json', crop_file, workers)
+        with open(crop_file, 'rb') as f:
+            return f.read()
+
+    def test_pooled_crop_matches_serial(self):
+        serial = self.thresh(1)
+        self.assertEqual(self.thresh(3), serial)
+        rows = list(iter_rows('crop-1.json'))
+        self.assertEqual([(row[0], row[2]) for row in rows],
+                         [('1.2.3.4', 'inbound'), ('5.6.7.8', 'inbound'), ('evil.example.com', 'inbound'),
+                          ('1.2.3.4', 'inbound'), ('10.0.0.9', 'inbound'),
+                          ('8.8.8.8', 'outbound'), ('9.9.9.9', 'inbound'),
+                          ('1.2.3.4', 'outbound'), ('5.6.7.8', 'outbound'), ('evil.example.com', 'outbound')])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,114 @@
+import os
+import shutil
+import socket
+import struct
+import tempfile
+import unittest
+
+import winnower
+from enricher import EnrichmentEngine
+from intermediate import dump_rows, iter_rows
+from metrics import metrics
+
+REPOSITORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class LocalPlan(winnower.EnrichmentPlan):
+    """ EnrichmentPlan without the ASN and GeoIP databases"""
+
+    def locate(self, addresses):
+        for addr in addresses:
+            self.asns.setdefault(addr, ('AS1', 'Example'))
+            self.countries.setdefault(addr, 'ZZ')
+
+
+def row(addr, addr_type='IPv4', source='feed'):
+    return (addr, addr_type, 'inbound', source, 'note', '2014-06-01')
+
+
+class WinnowChunkTest(unittest.TestCase):
+
+    def winnow(self, chunk):
+        plan = LocalPlan(False, False, None, EnrichmentEngine(1))
+        return [kept[0] for kept, enriched in plan.winnow_chunk(chunk)]
+
+    def test_reserved_after_invalid(self):
+        # an invalid IPv4 row must not shift the reserved flags of the rows after it
+        kept = self.winnow([row('1.2.3.999'), row('10.0.0.1'), row('8.8.8.8')])
+        self.assertEqual(kept, ['8.8.8.8'])
+
+    def test_mixed_types(self):
+        kept = self.winnow([row('example.com', 'FQDN'), row('127.0.0.1'), row('300.1.1.1'),
+                            row('bad_name', 'FQDN'), row('9.9.9.9'), row('192.168.1.1'), row('1.1.1.1')])
+        self.assertEqual(kept, ['example.com', '9.9.9.9', '1.1.1.1'])
+
+    def test_rejections_per_feed(self):
+        metrics.drain()
+        self.winnow([row('10.0.0.1', source='http://a/feed http://b/feed'), row('junk', None, 'http://a/feed')])
+        self.assertEqual(metrics.drain()['feeds'], {'http://a/feed': {'rejected': 2}, 'http://b/feed': {'rejected': 1}})
+
+    def test_enriched_rows(self):
+        plan = LocalPlan(True, False, None, EnrichmentEngine(1))
+        [(kept, enriched)] = plan.winnow_chunk([row('8.8.8.8')])
+        self.assertEqual(enriched, [row('8.8.8.8') + ('AS1', 'Example', 'ZZ', None, None)])
+
+    def test_memo_is_bounded(self):
+        plan = LocalPlan(True, False, None, EnrichmentEngine(1))
+        plan.MEMO_LIMIT = 2
+        for chunk in ([row('8.8.8.8'), row('8.8.4.4'), row('1.1.1.1')], [row('9.9.9.9')]):
+            results = plan.winnow_chunk(chunk)
+        self.assertEqual(sorted(plan.asns), ['9.9.9.9'])
+        self.assertEqual(results[0][1][0][:7], row('9.9.9.9') + ('AS1',))
+
+
+
+class ShardedWinnowTest(unittest.TestCase):
+    """ winnow() on worker processes against the serial winnow, with DNSDB disabled"""
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.directory = tempfile.mkdtemp()
+        os.chdir(self.directory)
+        with open('combine.cfg', 'wb') as f:
+            f.write('[Winnower]\ndnsdb_server = http://127.0.0.1:1/\ndnsdb_api = YOUR_API_KEY_HERE\n'
+                    'enrich_dns = 1\nenrich_ip = 1\ndnsdb_cache =\n')
+        os.mkdir('data')
+        shutil.copy(os.path.join(REPOSITORY, 'data', 'GeoIP.dat'), 'data')
+        with open(winnower.ASN_CSV, 'wb') as f:
+            for start, end, org in (('1.0.0.0', '1.255.255.255', 'AS1 One'), ('8.8.0.0', '8.8.255.255', 'AS15169 Google'),
+                                    ('9.0.0.0', '9.255.255.255', 'AS9 Nine')):
+                f.write('%d,%d,"%s"\n' % (struct.unpack('!I', socket.inet_aton(start))[0],
+                                          struct.unpack('!I', socket.inet_aton(end))[0], org))
+        crop = []
+        for i in range(40):
+            crop.extend([row('1.2.3.%d' % i), row('10.0.0.%d' % i), row('8.8.%d.8' % i), row('300.1.1.%d' % i),
+                         row('host%d.example.com' % i, 'FQDN'), row('bad_name%d' % i, 'FQDN'), row('9.9.9.%d' % i),
+                         row('127.0.0.%d' % i), row('4.4.4.%d' % i)])
+        dump_rows(crop, 'crop.json')
+        self.chunk_size = winnower.EnrichmentPlan.CHUNK_SIZE
+        # several chunks per shard, so the results have to be put back in crop order
+        winnower.EnrichmentPlan.CHUNK_SIZE = 25
+
+    def tearDown(self):
+        winnower.EnrichmentPlan.CHUNK_SIZE = self.chunk_size
+        winnower.asn_index = None
+        winnower.geo_data = None
+        os.chdir(self.cwd)
+        shutil.rmtree(self.directory)
+
+    def winnow(self, shards):
+        winnower.winnow('crop.json', 'wheat-%d.json' % shards, 'enriched-%d.json' % shards, shards)
+        return list(iter_rows('wheat-%d.json' % shards)), list(iter_rows('enriched-%d.json' % shards))
+
+    def test_shards_match_serial(self):
+        wheat, enriched = self.winnow(0)
+        self.assertEqual(len(wheat), 40 * 5)
+        self.assertEqual(wheat[:5], [list(row('1.2.3.0')), list(row('8.8.0.8')), list(row('host0.example.com', 'FQDN')),
+                                     list(row('9.9.9.0')), list(row('4.4.4.0'))])
+        self.assertEqual(enriched[1][6:], [u'15169', u'Google', u'US', None, None])
+        self.assertEqual(self.winnow(1), (wheat, enriched))
+        self.assertEqual(self.winnow(2), (wheat, enriched))
+
+
+if __name__ == '__main__':
+    unittest.main()
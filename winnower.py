@@ -1,99 +1,128 @@
 #! /usr/bin/env python
+import collections
 import ConfigParser
-import csv
 import datetime as dt
 import dnsdb_query
+import itertools
 import json
+import multiprocessing
+import multiprocessing.util
+import os
+import profiling
 import pygeoip
 import re
 import sys
+# imported up front: strptime's lazy import is not thread safe and enrichment runs on threads
+import _strptime
 
-from netaddr import IPAddress, IPRange, IPSet
-from sortedcontainers import SortedDict
+from netaddr import IPAddress, IPSet
 
+from dedup import SOURCE_SEPARATOR
+from dnsdb_cache import DnsdbCache
+from enricher import EnrichmentEngine, PooledDnsdbClient
+from geodb import open_asn_index
+from intermediate import iter_rows, open_rows
+from ipfilter import filter_ipv4, parse_ipv4, reserved_table
 from logger import get_logger
+from metrics import metrics
 
 logger = get_logger('winnower')
 
 # from http://en.wikipedia.org/wiki/Reserved_IP_addresses:
 reserved_ranges = IPSet(['0.0.0.0/8', '100.64.0.0/10', '127.0.0.0/8', '192.88.99.0/24',
                          '198.18.0.0/15', '198.51.100.0/24', '203.0.113.0/24', '233.252.0.0/24'])
-gi_org = SortedDict()
-geo_data = pygeoip.GeoIP('data/GeoIP.dat', pygeoip.MEMORY_CACHE)
+# TODO: make these locations configurable?
+ASN_CSV = 'data/GeoIPASNum2.csv'
+ASN_DB = 'data/GeoIPASNum2.bin'
+COUNTRY_DB = 'data/GeoIP.dat'
 
+# both databases are opened on first use; the mmap'ed files are shared between processes
+asn_index = None
+geo_data = None
+date_windows = {}
 
-def load_gi_org(filename):
-    with open(filename, 'rb') as f:
-        org_reader = csv.DictReader(f, fieldnames=['start', 'end', 'org'])
-        for row in org_reader:
-            gi_org[row['start']] = (IPRange(row['start'], row['end']), unicode(row['org'], errors='replace'))
 
-    return gi_org
+def load_gi_org(filename, compiled_file=None):
+    global asn_index
+    asn_index = open_asn_index(filename, compiled_file)
+    logger.info('Loaded %d ASN ranges' % len(asn_index))
+    return asn_index
+
+
+def load_geo_data(filename):
+    global geo_data
+    geo_data = pygeoip.GeoIP(filename, pygeoip.MMAP_CACHE)
+    return geo_data
 
 
 def org_by_addr(address):
-    as_num = None
-    as_name = None
-    gi_index = gi_org.bisect(str(int(address)))
-    gi_net = gi_org[gi_org.iloc[gi_index - 1]]
-    if address in gi_net[0]:
-        as_num, sep, as_name = gi_net[1].partition(' ')
-        as_num = as_num.replace("AS", "")  # Making sure the variable only has the number
-    return as_num, as_name
+    if asn_index is None:
+        load_gi_org(ASN_CSV, ASN_DB)
+    return asn_index.lookup(int(address))
+
+
+def orgs_by_addrs(addresses):
+    """ (as_num, as_name) for every address in a batch of integer addresses"""
+    if asn_index is None:
+        load_gi_org(ASN_CSV, ASN_DB)
+    return asn_index.lookup_many(addresses)
+
+
+def country_by_addr(address):
+    if geo_data is None:
+        load_geo_data(COUNTRY_DB)
+    return geo_data.country_code_by_addr('%s' % address)
 
 
 def maxhits(dns_records):
-    hmax = 0
-    hostname = None
-    for record in dns_records:
-        #logger.info("examining %s" % record)
-        if record['count'] > hmax:
-            hmax = record['count']
-            hostname = record['rrname'].rstrip('.')
-    return hostname
+    record = dnsdb_query.max_count(dns_records)
+    return record['rrname'].rstrip('.') if record else None
 
 
 def maxhits_rdata(dns_records):
-    hmax = 0
-    hostname = None
-    for record in dns_records:
-        # logger.info("Examining %s" % record)
-        if record['count'] > hmax:
-            hmax = record['count']
-            hostname = record['rdata'][0].rstrip('.')
-    return hostname
+    record = dnsdb_query.max_count(dns_records)
+    return record['rdata'][0].rstrip('.') if record else None
 
 
 def enrich_IPv4(address, dnsdb=None, hostname=None):
     as_num, as_name = org_by_addr(address)
-    country = geo_data.country_code_by_addr('%s' % address)
+    country = country_by_addr(address)
     if dnsdb:
         inaddr = address.reverse_dns
-        rhost = maxhits_rdata(dnsdb.query_rrset('%s' % inaddr))
+        rhost = maxhits_rdata(dnsdb.iter_rrset('%s' % inaddr))
     else:
         rhost = None
     return (as_num, as_name, country, hostname, rhost)
 
 
 def enrich_FQDN(address, date, dnsdb):
-    records = dnsdb.query_rrset(address, rrtype='A')
     yesterday = dt.datetime.strptime(date, '%Y-%m-%d') - dt.timedelta(days=1)
     yesterday_str = yesterday.strftime('%Y-%m-%d')
-    records = filter_date(records, yesterday_str)
+    # only the first record seen that day is used, so stop reading there
+    record = next(date_window(yesterday_str).filter(dnsdb.iter_rrset(address, rrtype='A')), None)
     enrichment = []
-    if not records:
+    if not record:
         return None
-    for ip_addr in records[0]['rdata']:
+    for ip_addr in record['rdata']:
         ip_addr_data = enrich_IPv4(IPAddress(ip_addr), dnsdb, address)
         enrichment.append((ip_addr,) + ip_addr_data)
     return enrichment
 
 
+def date_window(date):
+    """ a TimeWindow covering one YYYY-MM-DD day, built once per day"""
+    try:
+        return date_windows[date]
+    except KeyError:
+        date_dt = dt.datetime.strptime(date, '%Y-%m-%d')
+        start_dt = dt.datetime.combine(date_dt, dt.time.min).strftime('%Y-%m-%d %H:%M:%S')
+        end_dt = dt.datetime.combine(date_dt, dt.time.max).strftime('%Y-%m-%d %H:%M:%S')
+        window = date_windows[date] = dnsdb_query.TimeWindow(after=start_dt, before=end_dt)
+        return window
+
+
 def filter_date(records, date):
-    date_dt = dt.datetime.strptime(date, '%Y-%m-%d')
-    start_dt = dt.datetime.combine(date_dt, dt.time.min).strftime('%Y-%m-%d %H:%M:%S')
-    end_dt = dt.datetime.combine(date_dt, dt.time.max).strftime('%Y-%m-%d %H:%M:%S')
-    return dnsdb_query.filter_before(dnsdb_query.filter_after(records, start_dt), end_dt)
+    return list(date_window(date).filter(records))
 
 
 def reserved(address):
@@ -120,15 +149,59 @@ def is_fqdn(address):
         return False
 
 
-def winnow(in_file, out_file, enr_file):
+def count_rejected(source):
+    # a deduplicated row lists every feed that reported it, each of them counts the rejection
+    for feed in source.split(SOURCE_SEPARATOR):
+        metrics.add_feed(feed, 'rejected')
+
+
+def config_int(config, option, default):
+    if config.has_option('Winnower', option) and config.get('Winnower', option):
+        return config.getint('Winnower', option)
+    return default
+
+
+def config_float(config, option, default):
+    if config.has_option('Winnower', option) and config.get('Winnower', option):
+        return config.getfloat('Winnower', option)
+    return default
+
+
+def read_config():
     config = ConfigParser.SafeConfigParser(allow_no_value=True)
     cfg_success = config.read('combine.cfg')
     if not cfg_success:
         logger.error('Winnower: Could not read combine.cfg.')
         logger.error('HINT: edit combine-example.cfg and save as combine.cfg.')
+        return None
+    return config
+
+
+def open_dnsdb(config, workers, shards=1):
+    """ DNSDB client configured in the Winnower section, with its cache
+
+    With several shards, each one gets an equal part of the request rate.
+    """
+    cache = None
+    if config.has_option('Winnower', 'dnsdb_cache') and config.get('Winnower', 'dnsdb_cache'):
+        cache = DnsdbCache(config.get('Winnower', 'dnsdb_cache'),
+                           ttl=config_int(config, 'dnsdb_cache_ttl', 86400),
+                           negative_ttl=config_int(config, 'dnsdb_cache_negative_ttl', 3600),
+                           max_entries=config_int(config, 'dnsdb_cache_max_entries', 500000),
+                           max_records=config_int(config, 'dnsdb_cache_max_records', 1000))
+
+    # lookups run on a pool of threads sharing one rate limited, keep-alive session
+    return PooledDnsdbClient(config.get('Winnower', 'dnsdb_server'), config.get('Winnower', 'dnsdb_api'), cache,
+                             concurrency=workers, rate=config_float(config, 'dnsdb_rate', 0) / shards,
+                             retries=config_int(config, 'dnsdb_retries', 5))
+
+
+def winnow_rows(crop, shards=1):
+    """ set up enrichment and return a generator of (row, enriched rows) for every row kept"""
+    config = read_config()
+    if config is None:
         return
 
-    server = config.get('Winnower', 'dnsdb_server')
     api = config.get('Winnower', 'dnsdb_api')
     enrich_ip = config.get('Winnower', 'enrich_ip')
     if enrich_ip == '1' or enrich_ip == 'True':
@@ -148,60 +221,257 @@ def winnow(in_file, out_file, enr_file):
 
     logger.info('Setting up DNSDB client')
 
-    # handle the case where we aren't using DNSDB
-    dnsdb = dnsdb_query.DnsdbClient(server, api)
-    if api == 'YOUR_API_KEY_HERE' or len(dnsdb.query_rdata_name('google.com')) == 0:
+    workers = config_int(config, 'dnsdb_workers', 8)
+    dnsdb = open_dnsdb(config, workers)
+    # handle the case where we aren't using DNSDB; a cached answer would not tell whether DNSDB is up
+    if api == 'YOUR_API_KEY_HERE' or not dnsdb.probe('google.com'):
+        dnsdb.close()
         dnsdb = None
         logger.info('Invalid DNSDB configuration found')
 
-    with open(in_file, 'rb') as f:
-        crop = json.load(f)
-
-    # TODO: make these locations configurable?
-    logger.info('Loading GeoIP data')
-    gi_org = load_gi_org('data/GeoIPASNum2.csv')
-
-    wheat = []
-    enriched = []
-
-    logger.info('Beginning winnowing process')
-    for each in crop:
-        (addr, addr_type, direction, source, note, date) = each
-        # this should be refactored into appropriate functions
-        if addr_type == 'IPv4' and is_ipv4(addr):
-            #logger.info('Enriching %s' % addr)
-            ipaddr = IPAddress(addr)
-            if not reserved(ipaddr):
-                wheat.append(each)
-                if enrich_ip:
-                    e_data = (addr, addr_type, direction, source, note, date) + enrich_IPv4(ipaddr, dnsdb)
-                    enriched.append(e_data)
-                else:
-                    e_data = (addr, addr_type, direction, source, note, date) + enrich_IPv4(ipaddr)
-                    enriched.append(e_data)
+    if dnsdb is None:
+        # without DNSDB every lookup is local, so threads would only add overhead
+        workers = 1
+    if shards > 1:
+        # every shard opens its own client
+        if dnsdb:
+            dnsdb.close()
+        return winnow_shards(crop, enrich_ip, enrich_dns, dnsdb is not None, workers, shards)
+    return winnow_crop(crop, enrich_ip, enrich_dns, dnsdb, workers)
+
+
+class EnrichmentPlan(object):
+    """ resolves every lookup the crop needs exactly once, then joins the answers onto the rows
+
+    The crop is planned chunk by chunk: the unique addresses, PTR names and
+    (FQDN, day) pairs of a chunk are collected first, whatever an earlier
+    chunk did not already resolve is looked up in bulk, and then the
+    enriched rows are built from the answers. Addresses that FQDNs resolve
+    to share those answers with the crop's own IPv4 indicators. Answers are
+    forgotten between chunks once there are more than MEMO_LIMIT of a kind.
+    """
+    CHUNK_SIZE = 10000
+    MEMO_LIMIT = 200000
+
+    def __init__(self, enrich_ip, enrich_dns, dnsdb, engine):
+        self.enrich_ip = enrich_ip
+        self.enrich_dns = enrich_dns
+        self.dnsdb = dnsdb
+        self.engine = engine
+        self.asns = {}
+        self.countries = {}
+        self.rhosts = {}
+        self.resolutions = {}
+        self.reserved = reserved_table(reserved_ranges)
+        self.rows = 0
+        self.lookups = {'address': 0, 'PTR': 0, 'FQDN': 0}
+
+    def winnow(self, crop):
+        crop = iter(crop)
+        while True:
+            chunk = list(itertools.islice(crop, self.CHUNK_SIZE))
+            if not chunk:
+                break
+            for result in self.winnow_chunk(chunk):
+                yield result
+
+    def forget(self):
+        """ drop the answers of earlier chunks that outgrew MEMO_LIMIT, so memory stays bounded on large crops"""
+        for memo in (self.asns, self.rhosts, self.resolutions):
+            if len(memo) > self.MEMO_LIMIT:
+                memo.clear()
+        if not self.asns:
+            self.countries.clear()
+
+    def winnow_chunk(self, chunk):
+        self.forget()
+        kept = []
+        addresses = set()
+        reverse = set()
+        names = set()
+        ptr_ip = self.enrich_ip and self.dnsdb
+        resolve_dns = self.enrich_dns and self.dnsdb
+        # every IPv4 indicator of the chunk is validated and range checked in one batch
+        checks = self.check_ipv4([each[0] for each in chunk if each[1] == 'IPv4'])
+        for each in chunk:
+            (addr, addr_type, direction, source, note, date) = each
+            # one (valid, reserved) pair per IPv4 row, whether or not it is valid
+            valid, rejected = next(checks) if addr_type == 'IPv4' else (False, False)
+            if valid:
+                if rejected:
+                    logger.error('Found invalid address: %s from: %s' % (addr, source))
+                    count_rejected(source)
+                    continue
+                addresses.add(addr)
+                if ptr_ip:
+                    reverse.add(addr)
+            elif addr_type == 'FQDN' and is_fqdn(addr):
+                if resolve_dns:
+                    names.add((addr, date))
+            else:
+                logger.error('Could not determine address type for %s listed as %s' % (addr, addr_type))
+                count_rejected(source)
+                continue
+            kept.append(each)
+        self.rows += len(chunk)
+
+        self.resolve(self.resolutions, names, self.resolve_name, 'FQDN')
+        for name in names:
+            for ip_addr in self.resolutions[name]:
+                addresses.add(ip_addr)
+                reverse.add(ip_addr)
+        self.locate(addresses)
+        self.resolve(self.rhosts, reverse, self.reverse_name, 'PTR')
+
+        results = []
+        for each in kept:
+            (addr, addr_type, direction, source, note, date) = each
+            if addr_type == 'IPv4':
+                rhost = self.rhosts[addr] if ptr_ip else None
+                results.append((each, [(addr, addr_type, direction, source, note, date) + self.asns[addr] +
+                                       (self.countries[addr], None, rhost)]))
             else:
-                logger.error('Found invalid address: %s from: %s' % (addr, source))
-        elif addr_type == 'FQDN' and is_fqdn(addr):
-            #logger.info('Enriching %s' % addr)
-            wheat.append(each)
-            if enrich_dns and dnsdb:
-                # print "Enriching %s" % addr
-                e_data = enrich_FQDN(addr, date, dnsdb)
-                if e_data:
-                    for each in e_data:
-                        datum = (each[0], "IPv4", direction, source, note, date) + each[1:]
-                        enriched.append(datum)
-        else:
-            logger.error('Could not determine address type for %s listed as %s' % (addr, addr_type))
+                enriched = []
+                for ip_addr in self.resolutions.get((addr, date), ()):
+                    enriched.append((ip_addr, "IPv4", direction, source, note, date) + self.asns[ip_addr] +
+                                    (self.countries[ip_addr], addr, self.rhosts[ip_addr]))
+                results.append((each, enriched))
+        return results
+
+    def resolve(self, answers, keys, function, kind):
+        """ look up the keys that are not answered yet on the engine's threads"""
+        keys = [key for key in keys if key not in answers]
+        self.lookups[kind] += len(keys)
+        answers.update(zip(keys, self.engine.map(function, keys)))
+
+    def check_ipv4(self, addresses):
+        """ iterator over (valid, reserved) for every address of a batch"""
+        keep, reject, values = filter_ipv4(addresses, self.reserved)
+        return itertools.izip((keep | reject).tolist(), reject.tolist())
+
+    def locate(self, addresses):
+        """ ASN (in one vectorized search) and country of addresses not located yet"""
+        addresses = [addr for addr in addresses if addr not in self.asns]
+        if not addresses:
+            return
+        self.lookups['address'] += len(addresses)
+        self.asns.update(zip(addresses, orgs_by_addrs(parse_ipv4(addresses)[0])))
+        for addr in addresses:
+            self.countries[addr] = country_by_addr(addr)
+
+    def resolve_name(self, key):
+        """ addresses an FQDN had the day before it was reported"""
+        (addr, date) = key
+        yesterday = dt.datetime.strptime(date, '%Y-%m-%d') - dt.timedelta(days=1)
+        record = next(date_window(yesterday.strftime('%Y-%m-%d')).filter(self.dnsdb.iter_rrset(addr, rrtype='A')),
+                      None)
+        return record['rdata'] if record else ()
+
+    def reverse_name(self, addr):
+        return maxhits_rdata(self.dnsdb.iter_rrset('%s' % IPAddress(addr).reverse_dns))
+
+    def report(self):
+        logger.info('Enriched %d rows with %d address, %d PTR and %d FQDN lookups' %
+                    (self.rows, self.lookups['address'], self.lookups['PTR'], self.lookups['FQDN']))
+
+
+def winnow_crop(crop, enrich_ip, enrich_dns, dnsdb, workers=1):
+    logger.info('Beginning winnowing process')
+    engine = EnrichmentEngine(workers)
+    plan = EnrichmentPlan(enrich_ip, enrich_dns, dnsdb, engine)
+    try:
+        for result in plan.winnow(crop):
+            yield result
+        plan.report()
+    finally:
+        engine.close()
+        if dnsdb:
+            dnsdb.close()
+
+
+def load_databases():
+    if asn_index is None:
+        load_gi_org(ASN_CSV, ASN_DB)
+    if geo_data is None:
+        load_geo_data(COUNTRY_DB)
+
+
+# the EnrichmentPlan of a shard worker process and its profile, set up by init_shard
+shard_plan = None
+shard_profile = None
+
+
+def init_shard(enrich_ip, enrich_dns, use_dnsdb, workers, shards):
+    global shard_plan, shard_profile
+    # the worker only hands back what it counts itself, not what it inherited from the parent
+    metrics.drain()
+    dnsdb = open_dnsdb(read_config(), workers, shards) if use_dnsdb else None
+    engine = EnrichmentEngine(workers)
+    shard_plan = EnrichmentPlan(enrich_ip, enrich_dns, dnsdb, engine)
+    shard_profile = profiling.start('winnow', 'shard-%d' % os.getpid())
+    # pool workers run their finalizers when they exit, which flushes the DNSDB cache
+    multiprocessing.util.Finalize(None, close_shard, exitpriority=10)
+
+
+def close_shard():
+    profiling.stop(shard_profile)
+    if shard_plan.rows:
+        shard_plan.report()
+    shard_plan.engine.close()
+    if shard_plan.dnsdb:
+        shard_plan.dnsdb.close()
+
+
+def winnow_shard(chunk):
+    """ winnow a chunk, handing back what the worker counted along with the results"""
+    return shard_plan.winnow_chunk(chunk), metrics.drain()
+
+
+def winnow_shards(crop, enrich_ip, enrich_dns, use_dnsdb, workers, shards):
+    """ winnow chunks of the crop on shards worker processes, yielding results in crop order
+
+    The databases are opened before the workers are forked, so the ASN
+    index and GeoIP data are mapped once and shared by all of them. Only
+    twice as many chunks as there are shards are in flight at a time.
+    """
+    logger.info('Beginning winnowing process on %d shards' % shards)
+    load_databases()
+    pool = multiprocessing.Pool(shards, init_shard, (enrich_ip, enrich_dns, use_dnsdb, workers, shards))
+    try:
+        pending = collections.deque()
+        crop = iter(crop)
+        while True:
+            chunk = list(itertools.islice(crop, EnrichmentPlan.CHUNK_SIZE))
+            if chunk:
+                pending.append(pool.apply_async(winnow_shard, (chunk,)))
+            if pending and (not chunk or len(pending) >= 2 * shards):
+                results, counted = pending.popleft().get()
+                metrics.merge(counted)
+                for result in results:
+                    yield result
+            elif not chunk:
+                break
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+
+def winnow(in_file, out_file, enr_file, shards=1, fmt='json'):
+    harvest = winnow_rows(iter_rows(in_file), shards)
+    if harvest is None:
+        return
 
+    # both writers only replace their files once the whole crop went through,
+    # so out_file may be the same file as in_file
     logger.info('Dumping results')
-    with open(out_file, 'wb') as f:
-        w_data = json.dumps(wheat, indent=2, ensure_ascii=False).encode('utf8')
-        f.write(w_data)
-
-    with open(enr_file, 'wb') as f:
-        e_data = json.dumps(enriched, indent=2, ensure_ascii=False).encode('utf8')
-        f.write(e_data)
+    with open_rows(out_file, fmt) as wheat, open_rows(enr_file, fmt) as enriched:
+        for row, enrichment in harvest:
+            wheat.write(row)
+            for e_data in enrichment:
+                enriched.write(e_data)
 
 
 if __name__ == "__main__":